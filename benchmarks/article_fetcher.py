@@ -0,0 +1,103 @@
+"""Throughput benchmark of the concurrent article fetcher.
+
+Serves synthetic articles from local HTTP servers, one per simulated host,
+each answering after a fixed latency, and fetches them once the way
+`from_urls_to_kb` used to (one url at a time with `newspaper.Article`), then
+with `ArticleFetcher` on a cold and a warm article cache:
+
+    python benchmarks/article_fetcher.py --urls 1000 --hosts 20 --latency 0.1
+"""
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from idealog.article_cache import ArticleCache
+from idealog.article_fetcher import ArticleFetcher, PARSE_WORKERS, PER_HOST_LIMIT, FETCH_WORKERS
+
+PARAGRAPH = ("<p>Paris is the capital and most populous city of France. With an estimated population of "
+             "over two million residents, it is the centre of the Ile-de-France region.</p>")
+
+def make_handler(latency, paragraphs):
+    body = (f"<html><head><title>Benchmark article</title></head>"
+            f"<body><article>{PARAGRAPH * paragraphs}</article></body></html>").encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def start_servers(hosts, latency, paragraphs):
+    servers = []
+    for _ in range(hosts):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(latency, paragraphs))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+def sequential(urls):
+    # What from_urls_to_kb did before: download and parse one article at a time.
+    from newspaper import Article
+    for url in urls:
+        article = Article(url)
+        article.download()
+        article.parse()
+
+def concurrent(urls, **options):
+    failed = sum(1 for result in ArticleFetcher(**options).fetch(urls) if result.article is None)
+    if failed:
+        print(f"  {failed} urls failed")
+
+def measure(label, func, num_urls):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed:8.2f} s  {num_urls / elapsed:8.1f} urls/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--urls', type=int, default=1000)
+    parser.add_argument('--hosts', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds each response takes")
+    parser.add_argument('--paragraphs', type=int, default=30, help="paragraphs per article")
+    parser.add_argument('--sequential-urls', type=int, default=100,
+                        help="urls fetched by the sequential baseline, which is extrapolated to --urls")
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS)
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT)
+    args = parser.parse_args()
+
+    servers = start_servers(args.hosts, args.latency, args.paragraphs)
+    urls = [f"http://127.0.0.1:{servers[i % args.hosts].server_port}/article/{i}" for i in range(args.urls)]
+
+    print(f"{args.urls} urls on {args.hosts} hosts, {args.latency * 1000:.0f} ms latency")
+    baseline = measure(f"sequential ({args.sequential_urls} urls)", lambda: sequential(urls[:args.sequential_urls]),
+                       args.sequential_urls)
+    print(f"{'  extrapolated to ' + str(args.urls) + ' urls':<40} {baseline * args.urls / args.sequential_urls:8.2f} s")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ArticleCache(cache_dir, max_bytes=10 * 1024 ** 3, max_age=3600)
+        options = dict(fetch_workers=args.fetch_workers, parse_workers=args.parse_workers, per_host=args.per_host, cache=cache)
+        elapsed = measure(f"ArticleFetcher ({args.fetch_workers} fetch, {args.parse_workers} parse, {args.per_host}/host)",
+                          lambda: concurrent(urls, **options), args.urls)
+        print(f"speedup: {baseline * args.urls / args.sequential_urls / elapsed:.1f}x")
+        measure("ArticleFetcher, warm article cache", lambda: concurrent(urls, **options), args.urls)
+    finally:
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    main()
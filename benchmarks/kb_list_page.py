@@ -0,0 +1,88 @@
+"""Memory/latency benchmark of the knowledge base list page.
+
+Fills a scratch database with a few hundred multi-megabyte knowledge bases and
+compares listing them with `json_object` deferred (the default) against the
+old behaviour of loading every payload, both at the query level and through
+the `/knowledge-bases` page.
+
+The target database is dropped and recreated, so it must be given explicitly:
+
+    python benchmarks/kb_list_page.py --database-url postgresql:///idealog_bench --kbs 300 --mb 2
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+from sqlalchemy.orm import undefer
+
+from idealog import create_app
+from idealog.models import db, User, KnowledgeBase
+
+def make_payload(megabytes):
+    """A KB JSON document of roughly `megabytes` MB, shaped like KB.to_json() output."""
+    entity = {"url": "https://en.wikipedia.org/wiki/Example", "summary": "x" * 900}
+    count = max(1, megabytes * 1024 * 1024 // 1000)
+    return json.dumps({
+        "entities": {f"Entity {i}": entity for i in range(count)},
+        "relations": [],
+        "sources": {},
+    }, indent=4)
+
+def seed(num_kbs, megabytes, batch_size=20):
+    db.drop_all()
+    db.create_all()
+    admin = User.signup('bench', 'bench@example.com', 'benchpass', 'images/default_profile_pic.jpg', 'admin')
+    db.session.commit()
+
+    payload = make_payload(megabytes)
+    for start in range(0, num_kbs, batch_size):
+        rows = [dict(name=f"Benchmark KB {i}", json_object=payload, privacy='public', status='ready', user_id=admin.id)
+                for i in range(start, min(start + batch_size, num_kbs))]
+        db.session.execute(insert(KnowledgeBase), rows)
+        db.session.commit()
+    return len(payload)
+
+def measure(label, func, repeat):
+    timings = []
+    peak = 0
+    for _ in range(repeat):
+        db.session.expunge_all()
+        tracemalloc.start()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    timings.sort()
+    print(f"{label:<40} median {timings[len(timings) // 2] * 1000:9.1f} ms   peak {peak / 1024 / 1024:9.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True, help="scratch database; it is dropped and recreated")
+    parser.add_argument('--kbs', type=int, default=300)
+    parser.add_argument('--mb', type=int, default=2, help="approximate size of each KB payload in MB")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'WTF_CSRF_ENABLED': False})
+    with app.app_context():
+        size = seed(args.kbs, args.mb)
+        print(f"Seeded {args.kbs} knowledge bases of {size / 1024 / 1024:.1f} MB each\n")
+
+        measure("list query, json_object deferred", lambda: KnowledgeBase.query.all(), args.repeat)
+        measure("list query, json_object loaded",
+                lambda: KnowledgeBase.query.options(undefer(KnowledgeBase.json_object)).all(), args.repeat)
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'benchpass'})
+        measure("GET /knowledge-bases", lambda: client.get('/knowledge-bases'), args.repeat)
+
+        # The session is still in the transaction of the last query, whose locks
+        # would block DROP TABLE on PostgreSQL.
+        db.session.remove()
+        db.drop_all()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""Concurrent load test of a running Idealog deployment.
+
+Each of --clients virtual users logs in as one of the users in the generated
+data (generator/generate_csvs.py, loaded with `flask load-data`), then
+repeatedly picks a route at random from --mix, requests it and immediately
+picks the next one. Throughput and p50/p95/p99 latency are reported per route,
+and the report is written as JSON with --report:
+
+    python benchmarks/load_test.py --start --workers 4 --clients 50 --duration 60 --report load.json
+    python benchmarks/load_test.py --url http://localhost:8080 --mix home=1,kb_json=1
+
+With --start, gunicorn is started locally the way the Dockerfile runs it (the
+app reads DATABASE_URL and the other settings from the environment) and
+stopped at the end. Routes:
+
+    home       GET /
+    ideas      GET /ideas
+    search     GET /users_bp/search?home-query=<word>
+    kb_json    GET /api/knowledge-bases/<id from --kb-ids>?authorized=authorized
+               (the KBs must be ready; this is checked before the test starts)
+    kb_create  GET the knowledge base form, then POST it with a few ideas
+               (admins only, so run by the clients logged in as an admin)
+
+KB creation goes through /knowledge-bases/newkbworker, which queues the
+build on Celery, so run a worker too. Clients are threads, which is fine for
+a few hundred of them; the script prints a warning if it uses most of a CPU,
+since its own latency then shows in the results.
+"""
+import argparse
+import csv
+import glob
+import gzip
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "home=10,ideas=4,search=4,kb_json=6,kb_create=1"
+SEARCH_WORDS = ["time", "people", "world", "history", "science", "market", "health", "energy", "music", "policy"]
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+IDEA_OPTIONS = re.compile(r'<select[^>]*name="ideas"[^>]*>(.*?)</select>', re.S)
+OPTION_VALUE = re.compile(r'<option[^>]*value="(\d+)"')
+
+def csrf_token(html):
+    match = CSRF_TOKEN.search(html)
+    return match.group(1) if match else ''
+
+def read_users(directory):
+    """(username, password, user_type) of the users in the generated data files in `directory`."""
+    users = []
+    for path in sorted(glob.glob(os.path.join(directory, 'users*.csv')) + glob.glob(os.path.join(directory, 'users*.csv.gz'))):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8', newline='') as f:
+            users += [(row['username'], row['password'], row.get('user_type') or 'registered') for row in csv.DictReader(f)]
+    return users
+
+def parse_ids(spec):
+    """Ids from a list of ids and ranges, such as "1-20,25"."""
+    ids = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        ids += range(int(first), int(last or first) + 1)
+    return ids
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route {name!r}; routes are {', '.join(ROUTES)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+class Client():
+    """A logged in user making requests one after another."""
+
+    def __init__(self, options, username, password, admin, seed):
+        self.options = options
+        self.session = requests.Session()
+        self.admin = admin
+        self.rng = random.Random(seed)
+        self.samples = []
+        self.username, self.password = username, password
+
+    def url(self, path):
+        return self.options.url.rstrip('/') + path
+
+    def login(self):
+        page = self.session.get(self.url('/login'), timeout=self.options.timeout)
+        response = self.session.post(self.url('/login'), timeout=self.options.timeout, allow_redirects=False, data={
+            'username': self.username, 'password': self.password, 'csrf_token': csrf_token(page.text)})
+        if response.status_code != 302:
+            raise RuntimeError(f"Couldn't log in as {self.username}: status {response.status_code}")
+
+    def request(self, method, path, **kwargs):
+        return self.session.request(method, self.url(path), timeout=self.options.timeout, allow_redirects=False, **kwargs)
+
+    def run(self, routes, weights, stop, record_after):
+        while not stop.is_set():
+            name = self.rng.choices(routes, weights)[0]
+            start = time.perf_counter()
+            try:
+                status, size = ROUTES[name](self)
+            except requests.RequestException as e:
+                status, size = type(e).__name__, 0
+            if start >= record_after:
+                self.samples.append((name, time.perf_counter() - start, status, size))
+
+def home(client):
+    response = client.request('GET', '/')
+    return response.status_code, len(response.content)
+
+def ideas(client):
+    response = client.request('GET', '/ideas')
+    return response.status_code, len(response.content)
+
+def search(client):
+    response = client.request('GET', '/users_bp/search', params={'home-query': client.rng.choice(SEARCH_WORDS)})
+    return response.status_code, len(response.content)
+
+def kb_json(client):
+    knowledge_base_id = client.rng.choice(client.options.kb_ids)
+    response = client.request('GET', f'/api/knowledge-bases/{knowledge_base_id}', params={'authorized': 'authorized'},
+                              headers={'Accept-Encoding': 'br, gzip'})
+    return response.status_code, len(response.content)
+
+def kb_create(client):
+    form = client.request('GET', '/knowledge-bases/newkbworker')
+    if form.status_code != 200:
+        return form.status_code, len(form.content)
+    select = IDEA_OPTIONS.search(form.text)
+    ids = OPTION_VALUE.findall(select.group(1)) if select else []
+    chosen = client.rng.sample(ids, min(len(ids), client.rng.randint(1, 5)))
+    response = client.request('POST', '/knowledge-bases/newkbworker', data={
+        'name': f"Load test KB {client.rng.randrange(10 ** 9)}", 'ideas': chosen, 'csrf_token': csrf_token(form.text)})
+    # Success redirects to the KB list; a validation error renders the form again.
+    return response.status_code if response.status_code == 302 else f"form {response.status_code}", len(form.content) + len(response.content)
+
+ROUTES = {
+    'home': home,
+    'ideas': ideas,
+    'search': search,
+    'kb_json': kb_json,
+    'kb_create': kb_create,
+}
+ADMIN_ROUTES = {'kb_create'}
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for _, latency, _, _ in samples)
+    statuses = {}
+    for _, _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(count for status, count in statuses.items() if not (status.isdigit() and int(status) < 400))
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "statuses": statuses,
+        "throughput": len(samples) / elapsed if elapsed else 0,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+        **{f"p{p}_ms": 1000 * percentile(latencies, p / 100) if latencies else None for p in (50, 95, 99)},
+        "max_ms": 1000 * latencies[-1] if latencies else None,
+        "bytes": sum(size for _, _, _, size in samples),
+    }
+
+def report(clients, options, elapsed, cpu):
+    samples = [sample for client in clients for sample in client.samples]
+    by_route = {}
+    for sample in samples:
+        by_route.setdefault(sample[0], []).append(sample)
+    return {
+        "url": options.url,
+        "clients": len(clients),
+        "duration": elapsed,
+        "mix": options.mix,
+        "load_generator_cpu": cpu,
+        "routes": {name: summarize(by_route[name], elapsed) for name in ROUTES if name in by_route},
+        "total": summarize(samples, elapsed),
+    }
+
+def print_report(result):
+    print(f"\n{'route':<12} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, summary in list(result["routes"].items()) + [("total", result["total"])]:
+        if not summary["requests"]:
+            continue
+        print(f"{name:<12} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput']:>8.1f} "
+              f"{summary['p50_ms']:>9.1f} {summary['p95_ms']:>9.1f} {summary['p99_ms']:>9.1f} {summary['max_ms']:>9.1f}")
+    for name, summary in result["routes"].items():
+        failed = {status: count for status, count in summary["statuses"].items() if not (status.isdigit() and int(status) < 400)}
+        if failed:
+            print(f"  {name}: {failed}")
+
+def start_server(options):
+    """Start gunicorn on options.url's port and wait until it answers."""
+    port = options.url.rstrip('/').rsplit(':', 1)[-1]
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+                               '--workers', str(options.workers), '--timeout', '360'], cwd=ROOT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            requests.get(options.url, timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("gunicorn didn't answer within 60 s")
+
+def check_knowledge_bases(client, kb_ids):
+    """Exit unless every KB kb_json asks for is ready; otherwise the route would only measure 404s."""
+    not_ready = [knowledge_base_id for knowledge_base_id in kb_ids
+                 if client.request('HEAD', f'/api/knowledge-bases/{knowledge_base_id}',
+                                   params={'authorized': 'authorized'}).status_code != 200]
+    if not_ready:
+        raise SystemExit(f"Knowledge bases {', '.join(map(str, not_ready))} aren't ready. Pass ready ones with --kb-ids "
+                         "(the first 20 KBs of generator/generate_csvs.py's data are ready once loaded).")
+
+def run(options):
+    users = read_users(options.data)
+    if not users:
+        raise SystemExit(f"No users*.csv in {options.data}; generate data with generator/generate_csvs.py first.")
+    admins = [user for user in users if user[2] == 'admin']
+    registered = [user for user in users if user[2] != 'admin'] or users
+    if any(name in ADMIN_ROUTES for name in options.mix) and not admins:
+        raise SystemExit("The mix has admin routes but the data has no admin user.")
+
+    rng = random.Random(options.seed)
+    admin_clients = min(options.clients, options.admin_clients) if admins else 0
+    clients = [Client(options, *(rng.choice(admins if i < admin_clients else registered)[:2]), i < admin_clients, rng.random())
+               for i in range(options.clients)]
+    for client in clients:
+        client.login()
+    if 'kb_json' in options.mix:
+        check_knowledge_bases(clients[0], options.kb_ids)
+
+    stop = threading.Event()
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    record_after = start + options.warmup
+    threads = []
+    for client in clients:
+        routes = [name for name in options.mix if client.admin or name not in ADMIN_ROUTES]
+        if not routes:
+            continue
+        thread = threading.Thread(target=client.run, args=(routes, [options.mix[name] for name in routes], stop, record_after),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+    time.sleep(options.warmup + options.duration)
+    stop.set()
+    elapsed = time.perf_counter() - record_after
+    for thread in threads:
+        thread.join()
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime) / (time.perf_counter() - start)
+    if cpu > 0.8:
+        print(f"Warning: the load generator used {cpu:.0%} of a CPU; latencies include its own queueing.")
+    return report(clients, options, elapsed, cpu)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--start', action='store_true', help="start gunicorn on --url's port for the test")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers with --start")
+    parser.add_argument('--data', default=os.path.join(ROOT, 'generator', 'data'),
+                        help="directory of the generated data, for the users to log in as")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--admin-clients', type=int, default=1, help="clients logged in as admins")
+    parser.add_argument('--duration', type=float, default=30, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help=f"route weights (default {DEFAULT_MIX})")
+    parser.add_argument('--kb-ids', type=parse_ids, default='1-20', help="ids of ready KBs for kb_json (default 1-20, the ready KBs of the generated data)")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds before a request fails")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--report', help="write the report to this JSON file")
+    options = parser.parse_args()
+
+    server = start_server(options) if options.start else None
+    try:
+        result = run(options)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print_report(result)
+    if options.report:
+        with open(options.report, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
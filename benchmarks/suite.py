@@ -0,0 +1,332 @@
+"""Benchmark suite of the KB pipeline and the web hot paths.
+
+Runs each benchmark --rounds times after a warm-up round and records the
+median and fastest time. Results are written as JSON with --save, and with
+--baseline compared against an earlier run: a benchmark whose median is more
+than --tolerance slower than the baseline's is a regression, and the script
+exits with status 1.
+
+    python benchmarks/suite.py --save baseline.json
+    python benchmarks/suite.py --baseline baseline.json --tolerance 0.2
+
+Groups of benchmarks:
+
+- kb: relation parsing, KB.add_relation, KB.merge_with_kb and KB.to_json,
+  with Wikipedia lookups answered locally.
+- model: span chunking in from_text_to_kb, with a stub tokenizer and model
+  (needs torch and transformers, but doesn't load REBEL).
+- web: the KB JSON API and the ideas, knowledge base and search pages, on
+  data from generator/generate_csvs.py. Needs --database-url, a scratch
+  database that is dropped and recreated.
+
+Groups whose requirements are missing are reported as skipped. Compare
+runs made on the same machine only.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = []
+
+class Skip(Exception):
+    pass
+
+def benchmark(group):
+    """Register `func(context)`, which does the setup and returns the function to time."""
+    def register(func):
+        BENCHMARKS.append((group, func.__name__, func))
+        return func
+    return register
+
+##############################################################################
+# kb
+
+def import_class_kb():
+    try:
+        from idealog.ml_functions import class_kb
+    except ImportError as e:
+        raise Skip(f"class_kb can't be imported: {e}")
+    return class_kb
+
+def entity_data(self, name):
+    return {"title": name, "url": f"https://en.wikipedia.org/wiki/{name.replace(' ', '_')}", "summary": "Summary. " * 20}
+
+@contextmanager
+def local_wikipedia(class_kb):
+    """Answer KB.get_wikipedia_data without network access."""
+    lookup = class_kb.KB.get_wikipedia_data
+    class_kb.KB.get_wikipedia_data = entity_data
+    try:
+        yield
+    finally:
+        class_kb.KB.get_wikipedia_data = lookup
+
+def model_output(rng, entities, triplets):
+    """A decoded REBEL prediction of `triplets` relations between `entities` entities."""
+    parts = [f"<triplet> Entity {rng.randrange(entities)} <subj> Entity {rng.randrange(entities)} <obj> related to"
+             for _ in range(triplets)]
+    return "<s>" + " ".join(parts) + "</s><pad><pad>"
+
+def relations(rng, count, entities, urls):
+    """Relations as extract_text_relations returns them, over `entities` entities and `urls` articles."""
+    return [{"head": f"Entity {rng.randrange(entities)}", "type": rng.choice(["part of", "country", "member of"]),
+             "tail": f"Entity {rng.randrange(entities)}",
+             "meta": {f"https://example.com/{rng.randrange(urls)}": {"spans": [[128 * rng.randrange(8), 128 * rng.randrange(1, 9)]]}}}
+            for _ in range(count)]
+
+def filled_kb(class_kb, rng, count, entities, urls):
+    kb = class_kb.KB()
+    with local_wikipedia(class_kb):
+        for relation in relations(rng, count, entities, urls):
+            kb.add_relation(relation, "Article", "2024-01-01")
+    return kb
+
+@benchmark('kb')
+def parse_model_output(context):
+    class_kb = import_class_kb()
+    rng = random.Random(0)
+    outputs = [model_output(rng, 1000, 3) for _ in range(3000)]
+    return lambda: [class_kb.extract_relations_from_model_output(output) for output in outputs]
+
+@benchmark('kb')
+def kb_add_relation(context):
+    class_kb = import_class_kb()
+    rng = random.Random(0)
+    batch = relations(rng, 2000, 300, 50)
+
+    def run():
+        kb = class_kb.KB()
+        with local_wikipedia(class_kb):
+            for relation in batch:
+                # add_relation renames the head and tail in place.
+                kb.add_relation(dict(relation, meta=json.loads(json.dumps(relation["meta"]))), "Article", "2024-01-01")
+    return run
+
+@benchmark('kb')
+def kb_merge_with_kb(context):
+    class_kb = import_class_kb()
+    rng = random.Random(0)
+    first = filled_kb(class_kb, rng, 1000, 300, 50)
+    second = filled_kb(class_kb, rng, 1000, 300, 50)
+    first_json, second_json = first.to_json(), second.to_json()
+
+    def run():
+        kb, other = class_kb.KB(), class_kb.KB()
+        for target, payload in [(kb, first_json), (other, second_json)]:
+            data = json.loads(payload)
+            target.entities, target.relations, target.sources = data["entities"], data["relations"], data["sources"]
+        with local_wikipedia(class_kb):
+            kb.merge_with_kb(other)
+    return run
+
+@benchmark('kb')
+def kb_to_json(context):
+    class_kb = import_class_kb()
+    kb = filled_kb(class_kb, random.Random(0), 5000, 3000, 500)
+    return kb.to_json
+
+##############################################################################
+# model
+
+class StubTokenizer():
+    """One token per word; decodes each generated sequence to a few relations."""
+
+    def __call__(self, texts, return_tensors=None, **kwargs):
+        import torch
+        ids = torch.tensor([[zlib.crc32(word.encode()) % 50000 for word in text.split()] for text in texts])
+        return {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [model_output(random.Random(int(sequence[0])), 1000, 3) for sequence in sequences]
+
+class StubModel():
+    def generate(self, input_ids, attention_mask, num_return_sequences=1, **kwargs):
+        return input_ids[[i for i in range(len(input_ids)) for _ in range(num_return_sequences)]]
+
+@benchmark('model')
+def from_text_to_kb_spans(context):
+    class_kb = import_class_kb()
+    try:
+        import torch
+    except ImportError as e:
+        raise Skip(str(e))
+    rng = random.Random(0)
+    text = " ".join(f"word{rng.randrange(5000)}" for _ in range(20000))
+
+    def run():
+        tokenizer, model = class_kb.tokenizer, class_kb.model
+        class_kb.tokenizer, class_kb.model = StubTokenizer(), StubModel()
+        try:
+            with local_wikipedia(class_kb):
+                class_kb.from_text_to_kb(text, "https://example.com/article", article_title="Article")
+        finally:
+            class_kb.tokenizer, class_kb.model = tokenizer, model
+    return run
+
+##############################################################################
+# web
+
+def kb_payload(rng, entities, count):
+    return json.dumps({
+        "entities": {f"Entity {i}": {"url": f"https://en.wikipedia.org/wiki/Entity_{i}", "summary": "Summary. " * 20}
+                     for i in range(entities)},
+        "relations": relations(rng, count, entities, 100),
+        "sources": {f"https://example.com/{i}": {"article_title": f"Article {i}", "article_publish_date": None} for i in range(100)},
+    })
+
+def web_setup(args):
+    """Fill the scratch database with generated data and return (app, logged in client, id of a public KB with a payload)."""
+    from idealog import create_app
+    from idealog.bulk_load import load_directory
+    from idealog.models import db, User, KnowledgeBase
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url, 'WTF_CSRF_ENABLED': False})
+    directory = tempfile.mkdtemp()
+    try:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'generate_csvs.py'), '--out', directory,
+                        '--scale', str(args.scale), '--seed', '0'], check=True, stdout=subprocess.DEVNULL)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            load_directory(db.engine, directory, replace=True)
+            User.signup('bench', 'bench@example.com', 'benchpass', 'images/default_profile_pic.jpg', 'admin')
+            knowledge_base = db.session.get(KnowledgeBase, 1)
+            knowledge_base.privacy, knowledge_base.status = 'public', 'ready'
+            knowledge_base.set_json_object(kb_payload(random.Random(0), 2000, 5000))
+            db.session.commit()
+            knowledge_base_id = knowledge_base.id
+    finally:
+        shutil.rmtree(directory)
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'benchpass'})
+    return app, client, knowledge_base_id
+
+def web(context):
+    if not context.args.database_url:
+        raise Skip("needs --database-url")
+    if 'web' not in context.cache:
+        context.cache['web'] = web_setup(context.args)
+    return context.cache['web']
+
+def get(client, url):
+    def run():
+        response = client.get(url)
+        assert response.status_code == 200, f"{url}: {response.status_code}"
+    return run
+
+@benchmark('web')
+def api_knowledge_base_json(context):
+    _, client, knowledge_base_id = web(context)
+    return get(client, f'/api/knowledge-bases/{knowledge_base_id}')
+
+@benchmark('web')
+def ideas_page(context):
+    _, client, _ = web(context)
+    return get(client, '/ideas')
+
+@benchmark('web')
+def knowledge_bases_page(context):
+    _, client, _ = web(context)
+    return get(client, '/knowledge-bases')
+
+@benchmark('web')
+def search_page(context):
+    _, client, _ = web(context)
+    return get(client, '/users_bp/search?home-query=time')
+
+##############################################################################
+
+class Context():
+    def __init__(self, args):
+        self.args = args
+        self.cache = {}
+
+def measure(func, rounds):
+    func()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {"median": statistics.median(timings), "min": min(timings), "rounds": rounds}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    context = Context(args)
+    results = {"created": datetime.now(timezone.utc).isoformat(), "commit": git_commit(),
+               "python": platform.python_version(), "machine": platform.node(), "benchmarks": {}, "skipped": {}}
+    for group, name, setup in BENCHMARKS:
+        if args.group and group not in args.group:
+            continue
+        try:
+            func = setup(context)
+        except Skip as e:
+            results["skipped"][name] = str(e)
+            print(f"{name:<32} skipped: {e}")
+            continue
+        results["benchmarks"][name] = measure(func, args.rounds)
+        print(f"{name:<32} median {results['benchmarks'][name]['median'] * 1000:10.2f} ms")
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print each benchmark against the baseline and return the names of the regressions."""
+    regressions = []
+    print(f"\n{'benchmark':<32} {'median':>12} {'baseline':>12} {'change':>8}")
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            print(f"{name:<32} {result['median'] * 1000:9.2f} ms {'new':>12}")
+            continue
+        previous = baseline["benchmarks"][name]["median"]
+        change = result["median"] / previous - 1
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<32} {result['median'] * 1000:9.2f} ms {previous * 1000:9.2f} ms {change:+8.0%}"
+              + ("  REGRESSION" if regressed else ""))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--group', action='append', choices=sorted({group for group, _, _ in BENCHMARKS}),
+                        help="run only this group (repeatable)")
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline (0.2 is 20%%)")
+    parser.add_argument('--database-url', help="scratch database for the web benchmarks; it is dropped and recreated")
+    parser.add_argument('--scale', type=float, default=1.0, help="--scale of the generated data for the web benchmarks")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
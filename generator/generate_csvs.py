@@ -1,93 +1,233 @@
-"""Generate CSVs of random data for  development and testing of Idealog.
+"""Generate CSVs of random data for development and load testing of Idealog.
+
+    python generator/generate_csvs.py --scale 100 --workers 8
+
+writes users, groups, knowledge domains, ideas, knowledge sources and
+knowledge bases, with their association tables, to generator/data as shards
+named <table>-NNNN.csv, ready for `flask --app app load-data generator/data`.
+
+Each (table, shard) is generated in a worker process from its own random
+generator, seeded with --seed, the table and the shard, so the same seed,
+counts and number of shards always produce the same files, whatever the
+number of workers. Rows have explicit ids, so shards can reference each
+other without a database.
+
+Text lengths are log-normal, and users, groups and domains are picked with a
+Zipf-like skew, so a few of them own or contain much more than the others,
+as in real data. Every user's password is "mypass", and user 1 is an admin.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import gzip
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-MAX_IDEA_LENGTH = 140
+from helpers import WORDS, build_corpus, corpus_text, lognormal_length, random_datetime, shard_range, zipf_id, zipf_ids
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'user_type']
-IDEAS_CSV_HEADERS = ['name', 'text', 'publish_date', 'url', 'privacy', 'user_id']
-GROUPS_CSV_HEADERS = ['name', 'idea_id']
-KNOWLEDGE_SOURCES_CSV_HEADERS = ['name', 'text', 'publish_date', 'url', 'privacy', 'user_id']
-KNOWLEDGE_DOMAINS_CSV_HEADERS = ['name', 'knowledge_source_id']
+# Rows at --scale 1.
+COUNTS = {
+    'users': 1000,
+    'groups': 2000,
+    'knowledge_domains': 500,
+    'ideas': 20000,
+    'knowledge_sources': 5000,
+    'knowledge_bases': 200,
+}
 
-NUM_USERS = 5
-NUM_IDEAS = 10
-NUM_GROUPS = 10
-NUM_KNOWLEDGE_SOURCES = 10
-NUM_KNOWLEDGE_DOMAINS = 10
+CORPUS_SIZE = 1024 * 1024
+END_DATE = datetime(2024, 1, 1)
 
-fake = Faker()
-
-# Generate random profile image URLs to use for users
-
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='mypass',
-            user_type='registered',
-        ))
-
-with open('generator/ideas.csv', 'w') as ideas_csv:
-    ideas_writer = csv.DictWriter(ideas_csv, fieldnames=IDEAS_CSV_HEADERS)
-    ideas_writer.writeheader()
-
-    for i in range(NUM_IDEAS):
-        ideas_writer.writerow(dict(
-            name=fake.paragraph()[:25],
-            text=fake.paragraph()[:MAX_IDEA_LENGTH],
-            publish_date=datetime.now().isoformat(),
-            url = fake.url(),
-            privacy='private',
-            user_id=randint(1, NUM_USERS),
-        ))
-
-with open('generator/groups.csv', 'w') as groups_csv:
-    groups_writer = csv.DictWriter(groups_csv, fieldnames=GROUPS_CSV_HEADERS)
-    groups_writer.writeheader()
-
-    for i in range(NUM_GROUPS):
-        groups_writer.writerow(dict(
-            name=fake.paragraph()[:25],
-        ))
-
-with open('generator/knowledge_sources.csv', 'w') as knowledge_sources_csv:
-    knowledge_sources_writer = csv.DictWriter(knowledge_sources_csv, fieldnames=KNOWLEDGE_SOURCES_CSV_HEADERS)
-    knowledge_sources_writer.writeheader()
-
-    for i in range(NUM_KNOWLEDGE_SOURCES):
-        knowledge_sources_writer.writerow(dict(
-            name=fake.paragraph()[:25],
-            text=fake.paragraph()[:MAX_IDEA_LENGTH],
-            publish_date=datetime.now().isoformat(),
-            url = fake.url(),
-            privacy='private',
-            user_id=randint(1, NUM_USERS),
-        ))
-
-with open('generator/knowledge_domains.csv', 'w') as knowledge_domains_csv:
-    knowledge_domains_writer = csv.DictWriter(knowledge_domains_csv, fieldnames=KNOWLEDGE_DOMAINS_CSV_HEADERS)
-    knowledge_domains_writer.writeheader()
-
-    for i in range(NUM_KNOWLEDGE_DOMAINS):
-        knowledge_domains_writer.writerow(dict(
-            name=fake.paragraph()[:25],
-        ))
\ No newline at end of file
+_corpora = {}
+
+def corpus(seed):
+    """The text corpus of `seed`, built once per process."""
+    if seed not in _corpora:
+        _corpora[seed] = build_corpus(random.Random(f"{seed}:corpus"), CORPUS_SIZE)
+    return _corpora[seed]
+
+def title(rng, text):
+    return corpus_text(rng, text, rng.randint(15, 40)).replace('.', '').capitalize()
+
+def privacy(rng):
+    return 'public' if rng.random() < 0.3 else 'private'
+
+def date(rng):
+    return random_datetime(rng, END_DATE).isoformat(timespec='seconds')
+
+class Writers():
+    """One CSV writer per table of a shard."""
+
+    def __init__(self, options, shard):
+        self.options = options
+        self.shard = shard
+        self.files = {}
+        self.writers = {}
+        self.rows = {}
+
+    def __call__(self, table, header):
+        if table not in self.writers:
+            name = os.path.join(self.options.out, f"{table}-{self.shard:04d}.csv")
+            if self.options.gzip:
+                f = gzip.open(name + '.gz', 'wt', encoding='utf-8', newline='', compresslevel=1)
+            else:
+                f = open(name, 'w', encoding='utf-8', newline='')
+            self.files[table] = f
+            self.writers[table] = csv.writer(f)
+            self.writers[table].writerow(header)
+            self.rows[table] = 0
+        return self.writers[table]
+
+    def writerow(self, table, header, row):
+        self(table, header).writerow(row)
+        self.rows[table] += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        return self.rows
+
+def users(rng, ids, counts, text, write):
+    for id in ids:
+        username = f"{rng.choice(WORDS)}{id}"
+        write('users', ['id', 'email', 'username', 'image_url', 'password', 'user_type'],
+              [id, f"{username}@example.com", username, rng.choice(IMAGE_URLS), 'mypass', 'admin' if id == 1 else 'registered'])
+
+def groups(rng, ids, counts, text, write):
+    for id in ids:
+        # Group names are unique.
+        write('groups', ['id', 'name', 'user_id', 'privacy'],
+              [id, f"{title(rng, text)} {id}", zipf_id(rng, counts['users']), privacy(rng)])
+
+def knowledge_domains(rng, ids, counts, text, write):
+    for id in ids:
+        write('knowledge_domains', ['id', 'name', 'user_id', 'privacy'],
+              [id, title(rng, text), zipf_id(rng, counts['users']), privacy(rng)])
+
+def ideas(rng, ids, counts, text, write):
+    for id in ids:
+        write('ideas', ['id', 'name', 'text', 'publish_date', 'url', 'privacy', 'creation_mode', 'user_id'],
+              [id, title(rng, text), corpus_text(rng, text, lognormal_length(rng, 280, 0.6, 20, 5000)), date(rng),
+               f"https://example.com/ideas/{id}" if rng.random() < 0.5 else '', privacy(rng),
+               'manual' if rng.random() < 0.8 else 'automated', zipf_id(rng, counts['users'])])
+        if counts['groups']:
+            for group_id in zipf_ids(rng, counts['groups'], int(rng.expovariate(0.7))):
+                write('idea_groups', ['idea_id', 'group_id'], [id, group_id])
+
+def knowledge_sources(rng, ids, counts, text, write):
+    for id in ids:
+        write('knowledge_sources', ['id', 'name', 'text', 'publish_date', 'url', 'privacy', 'creation_mode', 'user_id'],
+              [id, title(rng, text), corpus_text(rng, text, lognormal_length(rng, 4000, 0.8, 200, 200000)), date(rng),
+               f"https://example.com/articles/{id}", privacy(rng), 'automated', zipf_id(rng, counts['users'])])
+        if counts['knowledge_domains']:
+            for domain_id in zipf_ids(rng, counts['knowledge_domains'], 1 + int(rng.expovariate(1))):
+                write('knowledge_source_knowledge_domains', ['knowledge_source_id', 'knowledge_domain_id'], [id, domain_id])
+
+# (table, column, ids of which table, median number of rows per knowledge base)
+KB_COMPONENTS = [
+    ('knowledge_base_ideas', 'idea_id', 'ideas', 8),
+    ('knowledge_base_knowledge_sources', 'knowledge_source_id', 'knowledge_sources', 20),
+    ('knowledge_base_groups', 'idea_group_id', 'groups', 1),
+    ('knowledge_base_knowledge_domains', 'knowledge_domain_id', 'knowledge_domains', 1),
+]
+
+# The first KBs are ready, with a generated payload, so benchmarks/load_test.py
+# has KB JSON to request; `flask load-data` builds their ETags and graph views.
+# The others are pending, as if their build were queued.
+READY_KNOWLEDGE_BASES = 20
+RELATION_TYPES = ["part of", "country", "instance of", "has part", "located in", "subclass of", "follows", "author"]
+
+def kb_payload(rng, counts, text):
+    """A KB payload of a few hundred entities, shaped like KB.to_json() output."""
+    names = sorted({title(rng, text) for _ in range(lognormal_length(rng, 200, 0.5, 10, 2000))})
+    urls = [f"https://example.com/articles/{rng.randint(1, max(1, counts['knowledge_sources']))}"
+            for _ in range(lognormal_length(rng, 20, 0.5, 1, 200))]
+    relations = {}
+    for _ in range(2 * len(names)):
+        head, tail = rng.sample(names, 2)
+        start = rng.randrange(0, 4096, 128)
+        relations.setdefault((head, rng.choice(RELATION_TYPES), tail), {})[rng.choice(urls)] = {"spans": [[start, start + 128]]}
+    return json.dumps({
+        "entities": {name: {"url": f"https://en.wikipedia.org/wiki/{name.replace(' ', '_')}", "summary": corpus_text(rng, text, 300)}
+                     for name in names},
+        "relations": [{"head": head, "type": type, "tail": tail, "meta": meta} for (head, type, tail), meta in relations.items()],
+        "sources": {url: {"article_title": title(rng, text), "article_publish_date": date(rng)} for url in urls},
+    })
+
+def knowledge_bases(rng, ids, counts, text, write):
+    for id in ids:
+        ready = id <= READY_KNOWLEDGE_BASES
+        write('knowledge_bases', ['id', 'name', 'date_created', 'privacy', 'status', 'creation_mode', 'user_id', 'json_object'],
+              [id, title(rng, text), date(rng), privacy(rng), 'ready' if ready else 'pending', 'automated',
+               zipf_id(rng, counts['users']), kb_payload(rng, counts, text) if ready else ''])
+        for table, column, components, median in KB_COMPONENTS:
+            if counts[components]:
+                k = lognormal_length(rng, median, 0.8, 0, 500)
+                for component_id in sorted({rng.randint(1, counts[components]) for _ in range(k)}):
+                    write(table, ['knowledge_base_id', column], [id, component_id])
+
+GENERATORS = {
+    'users': users,
+    'groups': groups,
+    'knowledge_domains': knowledge_domains,
+    'ideas': ideas,
+    'knowledge_sources': knowledge_sources,
+    'knowledge_bases': knowledge_bases,
+}
+
+def generate_shard(options, counts, table, shard):
+    """Write shard `shard` of `table` and the association rows of its entities. Returns {table: rows}."""
+    rng = random.Random(f"{options.seed}:{table}:{shard}")
+    writers = Writers(options, shard)
+    try:
+        GENERATORS[table](rng, shard_range(counts[table], options.shards, shard), counts, corpus(options.seed), writers.writerow)
+    finally:
+        rows = writers.close()
+    return rows
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Generate random Idealog data as sharded CSVs.")
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'),
+                        help="Output directory (default: generator/data).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Multiplies the default counts: " + ", ".join(f"{count:,} {table}" for table, count in COUNTS.items()) + ".")
+    for table in COUNTS:
+        parser.add_argument('--' + table.replace('_', '-'), type=int, dest=table, metavar='N',
+                            help=f"Number of {table.replace('_', ' ')}, overriding --scale.")
+    parser.add_argument('--shards', type=int, default=8, help="Files per table. Changing it changes the data.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--gzip', action='store_true', help="Write .csv.gz files.")
+    return parser.parse_args(args)
+
+def main(args=None):
+    options = parse_args(args)
+    counts = {table: getattr(options, table) if getattr(options, table) is not None else int(count * options.scale)
+              for table, count in COUNTS.items()}
+    os.makedirs(options.out, exist_ok=True)
+    start = time.perf_counter()
+    totals = {}
+    with ProcessPoolExecutor(options.workers) as pool:
+        futures = [pool.submit(generate_shard, options, counts, table, shard)
+                   for table in COUNTS for shard in range(options.shards)]
+        for future in futures:
+            for table, rows in future.result().items():
+                totals[table] = totals.get(table, 0) + rows
+    elapsed = time.perf_counter() - start
+    for table, rows in totals.items():
+        print(f"{table:<36} {rows:>12,} rows")
+    rows = sum(totals.values())
+    print(f"Wrote {rows:,} rows to {options.out} in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):,.0f} rows/s).")
+
+if __name__ == '__main__':
+    main()
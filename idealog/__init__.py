@@ -7,7 +7,14 @@ from .forms import UserAddForm, UserSignupForm, LoginForm, UserEditForm, IdeaAdd
 from .celery_app import celery_init_app
 from .error_handler import register_error_handlers
 from .helpers import requires_login, requires_admin, do_login, do_logout, CURR_USER_KEY
+from .user_cache import get_cached_user
 from . import users_bp, views, auth, idealog, api
+from .migrations import migrate_command
+from .kb_tables import index_knowledge_bases_command
+from .kb_views import build_graph_views_command
+from .bulk_load import load_data_command
+from .request_metrics import init_request_metrics
+from .profiler import init_profiler
 
 def create_app(test_config=None) -> Flask:
     app = Flask(__name__, instance_relative_config=True)
@@ -18,7 +25,7 @@ def create_app(test_config=None) -> Flask:
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
     url = urlparse(os.environ.get('REDISCLOUD_URL', 'redis://localhost'))
-    r = redis.Redis(host=url.hostname, port=url.port, password=url.password)
+    r = redis.Redis(host=url.hostname, port=url.port or 6379, password=url.password, socket_connect_timeout=1, socket_timeout=1)
 
     app.config.from_mapping(
         SECRET_KEY=os.environ.get('SECRET_KEY', 'devnotcompletelyrandomsecretkey'),
@@ -28,6 +35,31 @@ def create_app(test_config=None) -> Flask:
             result_backend=os.environ.get('REDISCLOUD_URL', 'redis://localhost'),
             task_ignore_result=True,
         ),
+        USER_CACHE_TTL=300,
+        KB_JSON_MAX_AGE=60,
+        KB_STREAM_THRESHOLD=1024 * 1024,
+        KB_STREAM_CHUNK_SIZE=256 * 1024,
+        FRAGMENT_CACHE_TTL=3600,
+        KB_GRAPH_CACHE_DIR=os.path.join(app.instance_path, 'kb_graphs'),
+        KB_REFRESH_DEBOUNCE=30,
+        KB_REFRESH_BATCH_SIZE=20,
+        # Must be shared with the Celery workers, e.g. FLASK_UPLOAD_DIR=/uploads in compose.yaml.
+        UPLOAD_DIR=os.path.join(app.instance_path, 'uploads'),
+        UPLOAD_MAX_AGE=24 * 3600,
+        ARTICLE_CACHE_DIR=os.path.join(app.instance_path, 'article_cache'),
+        ARTICLE_CACHE_MAX_BYTES=1024 * 1024 * 1024,
+        ARTICLE_CACHE_MAX_AGE=7 * 24 * 3600,
+        NEWS_LINKS_CACHE_TTL=6 * 3600,
+        NEWS_SEARCH_FILE=None,
+        MAX_CONTENT_LENGTH=1024 * 1024 * 1024,
+        METRICS_FLUSH_INTERVAL=5,
+        METRICS_TOKEN=None,
+        SLOW_REQUEST_SECONDS=1.0,
+        KB_TRACE_TRACEMALLOC=False,
+        PROFILER_ENABLED=True,
+        PROFILER_POLL_SECONDS=30,
+        PROFILER_INTERVAL=0.01,
+        PROFILER_RESULT_TTL=24 * 3600,
     )
     
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -43,19 +75,25 @@ def create_app(test_config=None) -> Flask:
         app.config.from_mapping(test_config)
 
     db.init_app(app)
+    app.extensions["redis"] = r
+    # First, so the time and queries of loading the user are counted.
+    init_request_metrics(app)
+    init_profiler(app)
 
     #if i wannt to keep app.before_request in a separate file and register it here - how to do it?
     @app.before_request
     def add_user_to_g():
         """If we're logged in, add curr user to Flask global."""
         if CURR_USER_KEY in session:
-            g.user = User.query.get(session[CURR_USER_KEY])
+            g.user = get_cached_user(session[CURR_USER_KEY])
         else:
             g.user = None
 
     @app.after_request
     def add_header(req):
-        """Add non-caching headers on every request."""
+        """Add non-caching headers unless the view set its own cache policy."""
+        if "Cache-Control" in req.headers:
+            return req
         req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
         req.headers["Pragma"] = "no-cache"
         req.headers["Expires"] = "0"
@@ -72,4 +110,9 @@ def create_app(test_config=None) -> Flask:
 
     app.add_url_rule('/', endpoint='index')
 
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(index_knowledge_bases_command)
+    app.cli.add_command(build_graph_views_command)
+    app.cli.add_command(load_data_command)
+
     return app
\ No newline at end of file
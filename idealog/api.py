@@ -1,6 +1,16 @@
-from flask import Blueprint, jsonify, request
-from idealog.models import KnowledgeBase
+from flask import Blueprint, jsonify, request, current_app, g
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import aliased, load_only
+from idealog.models import db, KnowledgeBase, KBEntity, KBRelation, KBProvenance
 from .helpers import requires_login, requires_admin
+from .kb_payload import json_payload_response, payload_data, compute_etag, not_modified
+from .kb_stream import payload_sizes, should_stream, streamed_payload_response
+from .kb_index import GraphIndex, slice_graph, render_slice, ALL_FIELDS, LAYOUT_FIELDS
+from .kb_clusters import ClusterHierarchy, render_level, cluster_id, MAX_CLUSTER_NODES
+from .kb_analytics import top_entities, RANKINGS
+from .kb_paths import load_adjacency, path_relation_ids, render_paths, MAX_PATHS
+from .kb_tables import relation_provenance
+from .fragment_cache import latest_public_knowledge_base_payload, invalidate_knowledge_base_fragments
 
 bp = Blueprint('api', __name__)
 
@@ -18,27 +28,458 @@ def return_all_users():
 
 ##############################################################################
 # KNOWLEDGE BASES
+# Only the columns needed to answer a revalidation are loaded up front; the
+# payload itself is fetched only when a body is actually sent.
+KB_HEADER_COLUMNS = load_only(KnowledgeBase.id, KnowledgeBase.privacy, KnowledgeBase.status, KnowledgeBase.json_etag)
+
+# Query parameters that select part of a KB instead of the whole stored payload.
+SLICE_ARGS = ['fields', 'entity', 'depth', 'offset', 'limit', 'component']
+MAX_NEIGHBORHOOD_DEPTH = 3
+MAX_RELATIONS_PAGE = 5000
+MAX_TOP_ENTITIES = 1000
+
+def payload_ready(knowledge_base, *columns):
+    """True if the KB has a stored payload and the given derived `columns` (graph_index, graph_layout, ...).
+
+    The columns are checked without loading them. A request never builds what is
+    missing (see kb_views.py).
+    """
+    if knowledge_base.json_etag is None:
+        return False
+    if not columns:
+        return True
+    stored = (db.session.query(*(getattr(KnowledgeBase, column).isnot(None) for column in columns))
+              .filter(KnowledgeBase.id == knowledge_base.id).one())
+    return all(stored)
+
+def knowledge_base_cache_control(knowledge_base):
+    if knowledge_base.privacy == "public":
+        return f"public, max-age={current_app.config['KB_JSON_MAX_AGE']}"
+    return "private, no-cache"
+
+def not_ready_response():
+    return {"error": "Knowledge base is not ready"}, 404, {"Cache-Control": "no-store"}
+
+def knowledge_base_json_response(knowledge_base, cache_control=None):
+    """Serve a KB's stored payload with an ETag, honouring If-None-Match and Accept-Encoding."""
+    if not payload_ready(knowledge_base):
+        return not_ready_response()
+
+    if cache_control is None:
+        cache_control = knowledge_base_cache_control(knowledge_base)
+
+    if not not_modified(knowledge_base.json_etag):
+        sizes = payload_sizes(knowledge_base.id)
+        if should_stream(sizes):
+            return streamed_payload_response(knowledge_base.id, knowledge_base.json_etag, sizes, cache_control)
+
+    compressed = {
+        "br": lambda: knowledge_base.json_br,
+        "gzip": lambda: knowledge_base.json_gzip,
+    }
+    return json_payload_response(lambda: knowledge_base.json_object, knowledge_base.json_etag, compressed, cache_control)
+
+def parse_slice_args(args):
+    """Validate the slicing query parameters. Raises ValueError with a client-facing message."""
+    fields = args.get('fields')
+    if fields is None:
+        fields = ALL_FIELDS
+    else:
+        fields = sorted({field for field in fields.split(',') if field})
+        unknown = set(fields) - set(ALL_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Valid fields are {', '.join(ALL_FIELDS)}.")
+
+    try:
+        depth = int(args.get('depth', 1))
+        offset = int(args.get('offset', 0))
+        limit = int(args['limit']) if 'limit' in args else None
+        component = int(args['component']) if 'component' in args else None
+    except ValueError:
+        raise ValueError("depth, offset, limit and component must be integers")
+
+    if not 0 <= depth <= MAX_NEIGHBORHOOD_DEPTH:
+        raise ValueError(f"depth must be between 0 and {MAX_NEIGHBORHOOD_DEPTH}")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    if limit is not None and not 1 <= limit <= MAX_RELATIONS_PAGE:
+        raise ValueError(f"limit must be between 1 and {MAX_RELATIONS_PAGE}")
+    if component is not None and component < 0:
+        raise ValueError("component must not be negative")
+
+    return {"fields": fields, "entity": args.get('entity'), "depth": depth, "offset": offset, "limit": limit,
+            "component": component}
+
+def knowledge_base_slice_response(knowledge_base):
+    """Serve a projection, neighbourhood and/or relation page of a KB from its graph index."""
+    try:
+        params = parse_slice_args(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if not payload_ready(knowledge_base, 'graph_index'):
+        return not_ready_response()
+    if params['component'] is not None and not payload_ready(knowledge_base, 'graph_analytics'):
+        return not_ready_response()
+    # Until the layout is built, entities come without positions; the ETag tells the two apart.
+    with_layout = 'layout' in params['fields'] and payload_ready(knowledge_base, 'graph_layout')
+    if not with_layout:
+        params['fields'] = [field for field in params['fields'] if field != 'layout']
+
+    etag = compute_etag(f"{knowledge_base.json_etag}:{sorted(params.items(), key=str)}")
+    cache_control = knowledge_base_cache_control(knowledge_base)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        index = GraphIndex(knowledge_base.graph_index)
+
+        within = None
+        if params['component'] is not None:
+            within = component_entities(knowledge_base.graph_analytics, params['component'])
+            if not within:
+                return {"error": "Component not found in knowledge base"}, 404
+        sliced = slice_graph(index, params['entity'], params['depth'], params['offset'], params['limit'], within)
+        if sliced is None:
+            return {"error": "Entity not found in knowledge base"}, 404
+        entity_ids, relation_ids, total = sliced
+
+        # Names, triples and positions come from the index and layout; only the other fields need the full stored payload.
+        payload_fields = set(params['fields']) - set(LAYOUT_FIELDS)
+        kb_data = payload_data(knowledge_base.json_object) if payload_fields else None
+        layout = knowledge_base.graph_layout if with_layout else None
+        result = render_slice(index, entity_ids, relation_ids, params['fields'], kb_data, layout)
+        if params['limit'] is not None or params['offset']:
+            result["page"] = {"offset": params['offset'], "limit": params['limit'], "total": total}
+        response = jsonify(result)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
 @bp.route('/api/knowledge-bases/<int:knowledge_base_id>', methods=["GET"])
 def return_knowledge_base_json(knowledge_base_id):
-    """Return a Knowledge Base JSON object if processing of KB has been completed(status = 'ready')."""
+    """Return a Knowledge Base JSON object if processing of KB has been completed(status = 'ready').
+
+    Optional query parameters return only part of the KB:
+    fields=url,summary,meta,sources,layout  optional fields to include (all if omitted, none if empty);
+                                     layout adds each entity's precomputed x/y position, once it is built
+    entity=<name>&depth=<n>          the n-hop neighbourhood of an entity (depth defaults to 1)
+    component=<n>                    one connected component (0 is the largest, see /analytics)
+    offset=<n>&limit=<n>             one page of relations and the entities they touch
+    """
     authorized = request.args.get('authorized')
-    knowledge_base = KnowledgeBase.query.get_or_404(knowledge_base_id)
+    knowledge_base = KnowledgeBase.query.options(KB_HEADER_COLUMNS).get_or_404(knowledge_base_id)
     if (knowledge_base.privacy == "private") and (authorized != 'authorized'):
         return {"error": "No knowledge bases found"}, 404
-    knowledge_base_json=knowledge_base.json_object
-    return knowledge_base_json
+    if any(arg in request.args for arg in SLICE_ARGS):
+        return knowledge_base_slice_response(knowledge_base)
+    return knowledge_base_json_response(knowledge_base)
+
+def component_entities(analytics, component):
+    """Ids of the entities in one connected component."""
+    return {entity_id for entity_id, current in enumerate(analytics['component']) if current == component}
+
+def parse_cluster_args(args, hierarchy):
+    """Return (level, cluster) from `level=<n>` or `cluster=<level>:<index>`. Raises ValueError with a client-facing message."""
+    if 'cluster' in args:
+        try:
+            level, cluster = (int(part) for part in args['cluster'].split(':'))
+        except ValueError:
+            raise ValueError("cluster must look like <level>:<index>")
+        if not 1 <= level <= hierarchy.top_level or not 0 <= cluster < hierarchy.level_size(level):
+            raise ValueError("Unknown cluster")
+        return level, cluster
+
+    try:
+        level = int(args.get('level', hierarchy.top_level))
+    except ValueError:
+        raise ValueError("level must be an integer")
+    if not 0 <= level <= hierarchy.top_level:
+        raise ValueError(f"level must be between 0 and {hierarchy.top_level}")
+    if hierarchy.level_size(level) > MAX_CLUSTER_NODES:
+        raise ValueError(f"Level {level} has {hierarchy.level_size(level)} nodes; expand clusters of level {level + 1} instead")
+    return level, None
+
+@bp.route('/api/knowledge-bases/<int:knowledge_base_id>/clusters', methods=["GET"])
+def return_knowledge_base_clusters(knowledge_base_id):
+    """Return a level-of-detail view of a Knowledge Base graph, never more than MAX_CLUSTER_NODES nodes.
+
+    level=<n>                    every node of level n (0 is entities, the coarsest level by default)
+    cluster=<level>:<index>      the children of one cluster, i.e. the cluster expanded one level
+    """
+    authorized = request.args.get('authorized')
+    knowledge_base = KnowledgeBase.query.options(KB_HEADER_COLUMNS).get_or_404(knowledge_base_id)
+    if (knowledge_base.privacy == "private") and (authorized != 'authorized'):
+        return {"error": "No knowledge bases found"}, 404
+    # The layout is built with the clusters (see kb_views.py).
+    if not payload_ready(knowledge_base, 'graph_index', 'graph_layout', 'graph_clusters'):
+        return not_ready_response()
+
+    etag = compute_etag(f"{knowledge_base.json_etag}:clusters:{sorted(request.args.items())}")
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        index = GraphIndex(knowledge_base.graph_index)
+        hierarchy = ClusterHierarchy(knowledge_base.graph_clusters, index)
+        try:
+            level, cluster = parse_cluster_args(request.args, hierarchy)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        if cluster is None:
+            nodes = range(hierarchy.level_size(level))
+        else:
+            nodes = hierarchy.children(level, cluster)
+            expanded, level = cluster_id(level, cluster), level - 1
+        result = render_level(hierarchy, level, nodes, knowledge_base.graph_layout)
+        result["level"] = level
+        result["levels"] = [hierarchy.level_size(each) for each in range(hierarchy.top_level + 1)]
+        if cluster is not None:
+            result["cluster"] = expanded
+        response = jsonify(result)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = knowledge_base_cache_control(knowledge_base)
+    return response
+
+@bp.route('/api/knowledge-bases/<int:knowledge_base_id>/analytics', methods=["GET"])
+def return_knowledge_base_analytics(knowledge_base_id):
+    """Return precomputed statistics of a Knowledge Base graph and its top ranked entities.
+
+    rank=degree|pagerank     how to rank top_entities (pagerank by default)
+    limit=<n>                how many top entities to return (20 by default)
+    component=<n>            only rank entities of one connected component (0 is the largest)
+    """
+    authorized = request.args.get('authorized')
+    knowledge_base = KnowledgeBase.query.options(KB_HEADER_COLUMNS).get_or_404(knowledge_base_id)
+    if (knowledge_base.privacy == "private") and (authorized != 'authorized'):
+        return {"error": "No knowledge bases found"}, 404
+
+    ranking = request.args.get('rank', 'pagerank')
+    if ranking not in RANKINGS:
+        return {"error": f"rank must be one of {', '.join(RANKINGS)}"}, 400
+    try:
+        limit = int(request.args.get('limit', 20))
+        component = int(request.args['component']) if 'component' in request.args else None
+    except ValueError:
+        return {"error": "limit and component must be integers"}, 400
+    if not 1 <= limit <= MAX_TOP_ENTITIES:
+        return {"error": f"limit must be between 1 and {MAX_TOP_ENTITIES}"}, 400
+
+    if not payload_ready(knowledge_base, 'graph_index', 'graph_analytics'):
+        return not_ready_response()
+
+    etag = compute_etag(f"{knowledge_base.json_etag}:analytics:{ranking}:{limit}:{component}")
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        analytics = knowledge_base.graph_analytics
+        entities = knowledge_base.graph_index['entities']
+        response = jsonify({
+            "entities": len(entities),
+            "relations": len(knowledge_base.graph_index['relations']),
+            "components": len(analytics['component_sizes']),
+            "component_sizes": analytics['component_sizes'][:limit],
+            "relation_types": [{"type": name, "count": count} for name, count in analytics['relation_types']],
+            "top_entities": top_entities(analytics, entities, ranking, limit, component),
+        })
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = knowledge_base_cache_control(knowledge_base)
+    return response
+
+@bp.route('/api/knowledge-bases/<int:knowledge_base_id>/paths', methods=["GET"])
+def return_knowledge_base_paths(knowledge_base_id):
+    """Return the shortest paths between two entities of a Knowledge Base, ignoring relation direction.
+
+    source=<name>&target=<name>  the entities to connect
+    k=<n>                        how many shortest simple paths to return (1 by default, at most MAX_PATHS)
+    provenance=false             leave out each relation's source spans and the sources they cite
+    """
+    authorized = request.args.get('authorized')
+    knowledge_base = KnowledgeBase.query.options(KB_HEADER_COLUMNS).get_or_404(knowledge_base_id)
+    if (knowledge_base.privacy == "private") and (authorized != 'authorized'):
+        return {"error": "No knowledge bases found"}, 404
+
+    source, target = request.args.get('source'), request.args.get('target')
+    if source is None or target is None:
+        return {"error": "source and target are required"}, 400
+    try:
+        k = int(request.args.get('k', 1))
+    except ValueError:
+        return {"error": "k must be an integer"}, 400
+    if not 1 <= k <= MAX_PATHS:
+        return {"error": f"k must be between 1 and {MAX_PATHS}"}, 400
+    provenance = request.args.get('provenance', 'true') != 'false'
+
+    if not payload_ready(knowledge_base, 'graph_index'):
+        return not_ready_response()
+
+    etag = compute_etag(f"{knowledge_base.json_etag}:paths:{source}:{target}:{k}:{provenance}")
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        adjacency = load_adjacency(knowledge_base, lambda: knowledge_base.graph_index)
+        source_id, target_id = adjacency.entity_id(source), adjacency.entity_id(target)
+        if source_id is None or target_id is None:
+            return {"error": "Entity not found in knowledge base"}, 404
+
+        paths = adjacency.k_shortest_paths(source_id, target_id, k)
+        # Provenance of the relations on the paths only, from kb_provenance and kb_sources.
+        path_provenance = relation_provenance(knowledge_base.id, path_relation_ids(paths)) if provenance else None
+        result = render_paths(adjacency, paths, path_provenance)
+        result["source"], result["target"] = source, target
+        response = jsonify(result)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = knowledge_base_cache_control(knowledge_base)
+    return response
 
 @bp.route('/api/knowledge-bases', methods=["GET"])
 def return_latest_knowledge_base_json():
     """Return a Knowledge Base JSON object if processing of KB has been completed(status = 'ready')."""
     content = request.args.get('content')
 
+    if content == 'latest' and g.user is None:
+        # Guests only ever see the latest public KB, which is served from the fragment cache.
+        payload, sizes = latest_public_knowledge_base_payload(), None
+        if payload is not None and "stream" in payload:
+            sizes = payload_sizes(int(payload["id"]))
+            if not should_stream(sizes):
+                # The KB was deleted or its payload cleared after the entry was cached: build it again.
+                invalidate_knowledge_base_fragments()
+                payload = latest_public_knowledge_base_payload()
+                sizes = payload_sizes(int(payload["id"])) if payload is not None and "stream" in payload else None
+        if payload is None:
+            return {"error": "No knowledge bases found"}, 404
+        etag = payload["etag"].decode('utf-8')
+        if "stream" in payload and not not_modified(etag):
+            if not should_stream(sizes):
+                # Changed again since the entry was rebuilt.
+                return not_ready_response()
+            knowledge_base_id = int(payload["id"])
+            return streamed_payload_response(knowledge_base_id, etag, sizes, "no-cache")
+        compressed = {
+            "br": lambda: payload["br"],
+            "gzip": lambda: payload["gzip"],
+        }
+        return json_payload_response(lambda: payload["json"].decode('utf-8'), etag, compressed, "no-cache")
+
     if content == 'latest':
-        knowledge_base = KnowledgeBase.query.order_by(KnowledgeBase.id.desc()).first()
+        knowledge_base = KnowledgeBase.query.options(KB_HEADER_COLUMNS).order_by(KnowledgeBase.id.desc()).first()
         if knowledge_base:
-            knowledge_base_json = knowledge_base.json_object
-            return knowledge_base_json
+            # Which KB is the latest changes over time, so always revalidate.
+            return knowledge_base_json_response(knowledge_base, cache_control="no-cache")
         else:
             return {"error": "No knowledge bases found"}, 404
 
-    return {"error": "Invalid content parameter"}, 400
\ No newline at end of file
+    return {"error": "Invalid content parameter"}, 400
+
+##############################################################################
+# LOOKUPS ACROSS KNOWLEDGE BASES
+# Answered from the kb_entities / kb_relations / kb_provenance tables (see
+# kb_tables.py), so no payload is loaded.
+def visible_knowledge_bases(query):
+    """Restrict `query` (which must involve KnowledgeBase) to ready KBs the current user can see."""
+    query = query.filter(KnowledgeBase.status == 'ready')
+    if g.user is None:
+        return query.filter(KnowledgeBase.privacy == 'public')
+    return query.filter((KnowledgeBase.privacy == 'public') | (KnowledgeBase.user_id == g.user.id))
+
+def parse_page_args(args):
+    """Validate offset and limit. Raises ValueError with a client-facing message."""
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args.get('limit', 100))
+    except ValueError:
+        raise ValueError("offset and limit must be integers")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+    if not 1 <= limit <= MAX_RELATIONS_PAGE:
+        raise ValueError(f"limit must be between 1 and {MAX_RELATIONS_PAGE}")
+    return offset, limit
+
+@bp.route('/api/entities', methods=["GET"])
+def return_entity_knowledge_bases():
+    """Return the Knowledge Bases that mention an entity, with how many relations it has in each.
+
+    name=<name>              the entity, as named in KB payloads (its Wikipedia title)
+    offset=<n>&limit=<n>     page through the matching KBs, newest first
+    """
+    name = request.args.get('name')
+    if name is None:
+        return {"error": "name is required"}, 400
+    try:
+        offset, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    def relation_count(column):
+        return (db.session.query(func.count())
+                .filter(KBRelation.knowledge_base_id == KBEntity.knowledge_base_id, column == KBEntity.entity_id)
+                .scalar_subquery())
+
+    query = (db.session.query(KnowledgeBase.id, KnowledgeBase.name, KBEntity.url,
+                              relation_count(KBRelation.head), relation_count(KBRelation.tail))
+             .join(KBEntity, KBEntity.knowledge_base_id == KnowledgeBase.id)
+             .filter(KBEntity.name == name))
+    rows = visible_knowledge_bases(query).order_by(KnowledgeBase.id.desc()).offset(offset).limit(limit).all()
+    return jsonify({
+        "entity": name,
+        "knowledge_bases": [{"id": knowledge_base_id, "name": knowledge_base_name, "url": url, "relations": heads + tails}
+                            for knowledge_base_id, knowledge_base_name, url, heads, tails in rows],
+        "offset": offset,
+        "limit": limit,
+    })
+
+@bp.route('/api/relations', methods=["GET"])
+def return_relations():
+    """Return relations from all Knowledge Bases, filtered by type and/or entity.
+
+    type=<type>              only relations of this type
+    entity=<name>            only relations with this entity as their head or tail
+    offset=<n>&limit=<n>     page through the matching relations
+    provenance=false         leave out the source spans of each relation
+    """
+    relation_type, entity = request.args.get('type'), request.args.get('entity')
+    if relation_type is None and entity is None:
+        return {"error": "type or entity is required"}, 400
+    try:
+        offset, limit = parse_page_args(request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    provenance = request.args.get('provenance', 'true') != 'false'
+
+    head, tail = aliased(KBEntity), aliased(KBEntity)
+    query = (db.session.query(KBRelation.knowledge_base_id, KBRelation.relation_id,
+                              head.name, KBRelation.type, tail.name)
+             .join(KnowledgeBase, KnowledgeBase.id == KBRelation.knowledge_base_id)
+             .join(head, (head.knowledge_base_id == KBRelation.knowledge_base_id) & (head.entity_id == KBRelation.head))
+             .join(tail, (tail.knowledge_base_id == KBRelation.knowledge_base_id) & (tail.entity_id == KBRelation.tail)))
+    query = visible_knowledge_bases(query)
+    if relation_type is not None:
+        query = query.filter(KBRelation.type == relation_type)
+    if entity is not None:
+        # A union of two lookups on the name index rather than an OR, which
+        # can't use an index across the two joined entities.
+        query = query.filter(head.name == entity).union(query.filter(tail.name == entity))
+    rows = query.order_by(KBRelation.knowledge_base_id, KBRelation.relation_id).offset(offset).limit(limit).all()
+
+    relations = [{"knowledge_base_id": knowledge_base_id, "relation_id": relation_id,
+                  "head": head_name, "type": type_name, "tail": tail_name}
+                 for knowledge_base_id, relation_id, head_name, type_name, tail_name in rows]
+    if provenance and relations:
+        by_key = {(relation["knowledge_base_id"], relation["relation_id"]): relation for relation in relations}
+        for relation in relations:
+            relation["sources"] = {}
+        spans = (db.session.query(KBProvenance.knowledge_base_id, KBProvenance.relation_id, KBProvenance.url,
+                                  KBProvenance.span_start, KBProvenance.span_end)
+                 .filter(tuple_(KBProvenance.knowledge_base_id, KBProvenance.relation_id).in_(list(by_key)))
+                 .order_by(KBProvenance.id))
+        for knowledge_base_id, relation_id, url, start, end in spans:
+            sources = by_key[knowledge_base_id, relation_id]["sources"]
+            sources.setdefault(url, [])
+            if start is not None:
+                sources[url].append([start, end])
+
+    return jsonify({"relations": relations, "offset": offset, "limit": limit})
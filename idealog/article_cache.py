@@ -0,0 +1,153 @@
+"""On-disk cache of downloaded and parsed articles.
+
+Every url the article fetcher downloads is stored under ARTICLE_CACHE_DIR,
+keyed by the SHA-256 of the url, as two files:
+
+    <key>.html.br   the raw page, brotli compressed
+    <key>.json      url, validators (ETag, Last-Modified), SHA-256 of the page,
+                    when it was fetched, and the parsed article
+
+Within ARTICLE_CACHE_MAX_AGE of being fetched an entry is used as is, so
+building KBs again from the same urls does no network I/O and no parsing.
+Older entries are revalidated with If-None-Match / If-Modified-Since; a 304,
+or a 200 with a page identical to the cached one, reuses the parsed article.
+
+Entries are written atomically (scratch file, then rename), so any number of
+workers can share the cache. Reading an entry touches it, and when the cache
+grows past ARTICLE_CACHE_MAX_BYTES the least recently used entries are
+evicted until it is back under 90% of the limit.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import brotli
+from flask import current_app, has_app_context
+
+# Writes between two checks of the cache size.
+EVICTION_INTERVAL = 100
+EVICTION_TARGET = 0.9
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+class ArticleCache():
+    """Article cache rooted at `directory`. See the module docstring."""
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._writes = 0
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], f"{key}{suffix}")
+
+    def get(self, url):
+        """The cached record of `url` (see the module docstring), or None."""
+        path = self._path(url_key(url), ".json")
+        try:
+            with open(path) as f:
+                record = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return record if record.get("url") == url else None
+
+    def is_fresh(self, record):
+        return time.time() - record["fetched_at"] < self.max_age
+
+    def revalidation_headers(self, record):
+        """Conditional request headers for a stale `record`."""
+        headers = {}
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+        return headers
+
+    def content(self, record):
+        """The raw page of a cached record."""
+        with open(self._path(url_key(record["url"]), ".html.br"), 'rb') as f:
+            return brotli.decompress(f.read())
+
+    def _write(self, path, data):
+        """Atomically write `data` to `path`. Returns False if the cache can't be written to,
+        which only costs a later download."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            descriptor, scratch = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        except OSError:
+            return False
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                f.write(data)
+            os.replace(scratch, path)
+        except OSError:
+            os.remove(scratch)
+            return False
+        return True
+
+    def put(self, url, content, etag, last_modified, article):
+        """Store a freshly downloaded page and its parsed article."""
+        key = url_key(url)
+        if self._write(self._path(key, ".html.br"), brotli.compress(content, mode=brotli.MODE_TEXT, quality=5)):
+            self.touch({"url": url, "content_hash": content_hash(content), "etag": etag,
+                        "last_modified": last_modified, "article": article})
+
+    def touch(self, record):
+        """Mark a record as fetched now (after a successful revalidation, or when it is new)."""
+        record = {**record, "fetched_at": time.time()}
+        if not self._write(self._path(url_key(record["url"]), ".json"), json.dumps(record).encode('utf-8')):
+            return record
+        self._writes += 1
+        if self._writes % EVICTION_INTERVAL == 0:
+            self.evict()
+        return record
+
+    def evict(self):
+        """Remove the least recently used entries if the cache is over its size limit."""
+        entries = {}
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue  # Another worker's write in progress.
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                total += stat.st_size
+                key = name.split('.', 1)[0]
+                entry = entries.setdefault(key, [0, 0.0, []])
+                entry[0] += stat.st_size
+                entry[1] = max(entry[1], stat.st_mtime)
+                entry[2].append(path)
+        if total <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for size, _, paths in sorted(entries.values(), key=lambda entry: entry[1]):
+            if total <= self.max_bytes * EVICTION_TARGET:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
+
+def default_article_cache():
+    """The cache configured for the current app, or None outside an app or if ARTICLE_CACHE_DIR is unset."""
+    if not has_app_context() or not current_app.config.get('ARTICLE_CACHE_DIR'):
+        return None
+    config = current_app.config
+    return ArticleCache(config['ARTICLE_CACHE_DIR'], config['ARTICLE_CACHE_MAX_BYTES'], config['ARTICLE_CACHE_MAX_AGE'])
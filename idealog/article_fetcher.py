@@ -0,0 +1,218 @@
+"""Concurrent downloading and parsing of web articles.
+
+Used to build knowledge sources and KBs from lists of urls. Downloading is
+I/O bound and parsing (newspaper's extraction) is CPU bound, so they run in
+separate pools that overlap:
+
+- Downloads run in a thread pool sharing one pooled `requests.Session`. Each
+  host gets at most `per_host` concurrent requests, every request has a
+  connect/read timeout, and connection errors, 429s and 5xx responses are
+  retried with exponential backoff, up to `retries` times per url.
+- Each downloaded page is handed to the parse pool as soon as it arrives.
+  The pool uses processes, except inside daemonic processes (such as Celery's
+  prefork workers), which can't have children; there it uses threads.
+
+With an `ArticleCache` (see article_cache.py), fresh cached articles are
+returned without any request, stale ones are revalidated, and new pages are
+stored once parsed.
+
+`ArticleFetcher.fetch(urls)` yields a `FetchResult` per url in completion
+order, so callers can store results while later urls are still in flight.
+`urls` is read lazily, with at most `2 * fetch_workers` urls between being
+read and their result being taken by the caller, so it can be a generator
+fed by another stage (see kb_pipeline.py) and a slow caller holds back the
+downloads instead of piling up pages in memory.
+"""
+import multiprocessing
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from newspaper import Article
+from requests.adapters import HTTPAdapter
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
+
+from idealog.article_cache import content_hash, default_article_cache
+
+FETCH_WORKERS = 32
+PARSE_WORKERS = 4
+PER_HOST_LIMIT = 4
+TIMEOUT = (5, 20)
+RETRIES = 2
+BACKOFF = 0.5
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+CHUNK_BYTES = 64 * 1024
+USER_AGENT = "Mozilla/5.0 (compatible; Idealog article fetcher)"
+
+# `article` is a dict with url, name, text and publish_date (ISO format or
+# None), or None if the url failed, in which case `error` says why.
+FetchResult = namedtuple('FetchResult', ['url', 'article', 'error'])
+# A downloaded page that still has to be parsed.
+Page = namedtuple('Page', ['url', 'content', 'encoding', 'etag', 'last_modified'])
+
+def parse_article(url, content, encoding):
+    """Extract the title, text and publish date of a downloaded page."""
+    article = Article(url)
+    article.download(input_html=content.decode(encoding or 'utf-8', errors='replace'))
+    article.parse()
+    return {
+        "url": url,
+        "name": article.title or url,
+        "text": article.text,
+        "publish_date": article.publish_date.isoformat() if article.publish_date else None,
+    }
+
+def _ready():
+    return True
+
+# Marks the end of the urls on the completion queue of ArticleFetcher.fetch.
+_FED = object()
+
+class ArticleFetcher():
+    """Downloads and parses articles concurrently. See the module docstring."""
+
+    def __init__(self, fetch_workers=FETCH_WORKERS, parse_workers=PARSE_WORKERS, per_host=PER_HOST_LIMIT,
+                 timeout=TIMEOUT, retries=RETRIES, parse=parse_article, cache=None):
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.parse = parse
+        self.cache = cache
+
+        retry = Retry(total=retries, backoff_factor=BACKOFF, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=['GET'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = USER_AGENT
+
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def download(self, url):
+        """Fetch `url`, going through the cache if there is one.
+
+        Returns (article, None) if the cached article can be used, otherwise (None, Page).
+        Raises on errors and pages over MAX_PAGE_BYTES.
+        """
+        record = self.cache.get(url) if self.cache is not None else None
+        if record is not None and self.cache.is_fresh(record):
+            return record["article"], None
+
+        headers = self.cache.revalidation_headers(record) if record is not None else {}
+        with self._host_slot(url):
+            with self.session.get(url, timeout=self.timeout, stream=True, headers=headers) as response:
+                if record is not None and response.status_code == 304:
+                    self.cache.touch(record)
+                    return record["article"], None
+                response.raise_for_status()
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > MAX_PAGE_BYTES:
+                        raise ValueError(f"Page is larger than {MAX_PAGE_BYTES} bytes")
+                    chunks.append(chunk)
+                encoding = get_encoding_from_headers(response.headers)
+                # requests falls back to ISO-8859-1 for any text/* type; let the parser assume UTF-8 instead.
+                if encoding == 'ISO-8859-1' and 'charset' not in response.headers.get('content-type', '').lower():
+                    encoding = None
+                content = b"".join(chunks)
+                etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        if record is not None and record["content_hash"] == content_hash(content):
+            # Unchanged page from a server that doesn't revalidate.
+            self.cache.touch({**record, "etag": etag, "last_modified": last_modified})
+            return record["article"], None
+        return None, Page(url, content, encoding, etag, last_modified)
+
+    def _parse_pool(self):
+        if self.parse_workers and not multiprocessing.current_process().daemon:
+            pool = ProcessPoolExecutor(self.parse_workers)
+            # Start the processes now: forking once download threads are running could copy held locks.
+            pool.submit(_ready).result()
+            return pool
+        return ThreadPoolExecutor(max(1, self.parse_workers))
+
+    def fetch(self, urls):
+        """Download and parse `urls` (duplicates are fetched once), yielding a FetchResult as each completes."""
+        parses = self._parse_pool()
+        downloads = ThreadPoolExecutor(self.fetch_workers)
+        # (url, None for a download or the Page for a parse, future), or (_FED, number of urls, error)
+        completed = queue.Queue()
+        slots = threading.Semaphore(2 * self.fetch_workers)
+        stop = threading.Event()
+
+        def submit(pool, url, page, *args):
+            pool.submit(*args).add_done_callback(lambda future: completed.put((url, page, future)))
+
+        def feed():
+            seen = set()
+            error = None
+            try:
+                for url in urls:
+                    if url in seen:
+                        continue
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    seen.add(url)
+                    submit(downloads, url, None, self.download, url)
+            except Exception as e:
+                error = e
+            completed.put((_FED, len(seen), error))
+
+        threading.Thread(target=feed, daemon=True).start()
+        try:
+            total = None
+            finished = 0
+            while total is None or finished < total:
+                url, page, future = completed.get()
+                if url is _FED:
+                    if future is not None:
+                        raise future
+                    total = page
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = FetchResult(url, None, f"{type(e).__name__}: {e}")
+                else:
+                    if page is None:
+                        article, page = result
+                        if article is None:
+                            submit(parses, url, page, self.parse, page.url, page.content, page.encoding)
+                            continue
+                        result = FetchResult(url, article, None)
+                    else:
+                        if self.cache is not None:
+                            self.cache.put(url, page.content, page.etag, page.last_modified, result)
+                        result = FetchResult(url, result, None)
+                finished += 1
+                slots.release()
+                yield result
+        finally:
+            stop.set()
+            slots.release()
+            downloads.shutdown(cancel_futures=True)
+            parses.shutdown(cancel_futures=True)
+
+def fetch_articles(urls, **options):
+    """Download and parse `urls` concurrently with a new ArticleFetcher, using the app's
+    article cache unless another `cache` is given. See ArticleFetcher.fetch."""
+    options.setdefault('cache', default_article_cache())
+    return ArticleFetcher(**options).fetch(urls)
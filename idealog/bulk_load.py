@@ -0,0 +1,355 @@
+"""Bulk loading of tables from CSV and NDJSON files.
+
+`flask load-data DIRECTORY` loads every table of the models, association
+tables included, that has files in DIRECTORY:
+
+    <table>.csv or <table>.ndjson, or shards <table>-<anything>.csv/.ndjson,
+    each optionally gzipped (.gz)
+
+CSV files have a header row naming the columns; NDJSON files have one object
+per line. Columns the table doesn't have are ignored, and columns missing
+from a file get the model's default. Empty values are NULL in nullable
+columns and empty strings in the others. Plaintext passwords in `users` are
+bcrypt hashed (once per distinct password, so this is for sample data only).
+
+Tables are loaded parent first (the order of `db.metadata.sorted_tables`),
+each in its own transaction, so a failed table is left as it was. On
+PostgreSQL every file is streamed into the table with COPY, without holding
+more than a chunk of it in memory. CSV files whose columns all exist in the
+table are parsed by the server; other files are converted to CSV on the way,
+which costs about 10 µs a row in Python. The table's secondary indexes are dropped
+before the load and rebuilt once it is done, which is much faster than
+updating them row by row; primary keys, unique and foreign key constraints
+stay in place. With --replace, tables are truncated first and loaded with
+COPY FREEZE. On other databases rows are inserted in batches instead.
+
+Files without a header (empty shards) are skipped.
+
+Knowledge base payloads are loaded as they are. `flask load-data` then builds
+the ETags, compressed variants and graph views of the loaded KBs (see
+kb_views.py), so ready KBs can be served. COPY bypasses the ORM events that
+keep derived data up to date, so it also drops the guest fragment cache and
+queues the loaded ideas and knowledge sources for the global knowledge base
+(see kb_refresh.py), REFRESH_CHUNK_KEYS at a time. Each of them goes through
+the extraction model; --no-refresh leaves them out of the global KB instead.
+"""
+import csv
+import glob
+import gzip
+import io
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+
+import click
+from sqlalchemy import JSON, DateTime, text
+
+from idealog.models import db, bcrypt, DocumentExtract
+from idealog.kb_views import build_missing_graph_views
+from idealog.fragment_cache import invalidate_knowledge_base_fragments
+from idealog.kb_refresh import DOCUMENT_MODELS, document_key, enqueue_documents
+
+FORMATS = ['.csv', '.ndjson']
+INSERT_BATCH_ROWS = 10000
+COPY_CHUNK_BYTES = 1024 * 1024
+INDEX_BUILD_MEMORY = '1GB'
+# Document keys read and sent to Redis per round trip when queueing a refresh.
+REFRESH_CHUNK_KEYS = 10000
+
+def table_files(directory, table_name):
+    """The data files of a table in `directory`, sorted."""
+    files = []
+    for extension in FORMATS:
+        for suffix in (extension, extension + '.gz'):
+            files += glob.glob(os.path.join(directory, glob.escape(table_name) + suffix))
+            files += glob.glob(os.path.join(directory, glob.escape(table_name) + '-*' + suffix))
+    return sorted(files)
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+def _is_csv(path):
+    return path.endswith('.csv') or path.endswith('.csv.gz')
+
+def _records(f, path):
+    """(columns, iterator of rows) of an open data file. CSV rows are lists, NDJSON rows dicts."""
+    if _is_csv(path):
+        reader = csv.reader(f)
+        return next(reader, []), (row for row in reader if row)
+    lines = (line for line in f if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return [], iter(())
+    first = json.loads(first)
+    return list(first), itertools.chain([first], (json.loads(line) for line in lines))
+
+class _Defaults():
+    """Model defaults of the columns a file doesn't have, evaluated once per load."""
+
+    def __init__(self, table):
+        self.values = {}
+        for column in table.columns:
+            default = column.default
+            if default is None or column.primary_key:
+                continue
+            if default.is_scalar:
+                self.values[column.name] = default.arg
+            elif default.is_callable:
+                self.values[column.name] = default.arg(None)
+
+class _Hasher():
+    def __init__(self):
+        self.hashes = {}
+
+    def __call__(self, password):
+        if password is None or password.startswith('$2'):
+            return password
+        if password not in self.hashes:
+            self.hashes[password] = bcrypt.generate_password_hash(password).decode('utf-8')
+        return self.hashes[password]
+
+def _converter(table, file_columns, from_csv, defaults, hasher):
+    """(columns to load, function turning a record into a tuple of their values)."""
+    columns = [column for column in file_columns if column in table.columns]
+    constants = tuple(value for name, value in defaults.values.items() if name not in columns)
+    nullable = [table.columns[column].nullable for column in columns]
+    password = columns.index('password') if table.name == 'users' and 'password' in columns else None
+    if from_csv:
+        positions = [file_columns.index(column) for column in columns]
+        pick = lambda row: [row[position] for position in positions]
+    else:
+        pick = lambda record: [record.get(column) for column in columns]
+
+    def convert(record):
+        values = pick(record)
+        if from_csv:
+            values = [None if value == '' and empty_is_null else value for value, empty_is_null in zip(values, nullable)]
+        if password is not None:
+            values[password] = hasher(values[password])
+        return tuple(values) + constants
+
+    return columns + [name for name in defaults.values if name not in columns], convert
+
+def _json_values(values):
+    # JSON columns (knowledge base payloads) arrive as objects from NDJSON.
+    return tuple(json.dumps(value) if isinstance(value, (dict, list)) else value for value in values)
+
+class _CSVStream(io.RawIOBase):
+    """A read-only file of rows written as CSV, produced as COPY reads it."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = b""
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        size = COPY_CHUNK_BYTES if size is None or size < 0 else size
+        if self.position == len(self.pending):
+            self.writer.writerows(itertools.islice(self.rows, 1000))
+            self.pending = self.buffer.getvalue().encode('utf-8')
+            self.position = 0
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        chunk = self.pending[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+def _secondary_indexes(connection, table):
+    """(name, definition) of the indexes of `table` that don't back a constraint."""
+    return list(connection.execute(text(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint)"
+    ), {"table": table.name}))
+
+def _copy_sql(table, columns, freeze, header=False):
+    # Empty fields are NULL, except in NOT NULL columns, where they are empty strings.
+    options = ["FORMAT csv"] + (["FREEZE"] if freeze else []) + (["HEADER"] if header else [])
+    not_null = [column for column in columns if not table.columns[column].nullable]
+    if not_null:
+        options.append(f"FORCE_NOT_NULL ({', '.join(not_null)})")
+    return f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH ({', '.join(options)})"
+
+def _server_defaults(connection, cursor, table, values):
+    """Make `values` the server defaults of their columns. Returns the statements restoring the old ones."""
+    current = dict(connection.execute(text(
+        "SELECT column_name, column_default FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table"
+    ), {"table": table.name}).fetchall())
+    restore = []
+    for column, value in values.items():
+        literal = cursor.mogrify("%s", (value,)).decode('utf-8')
+        connection.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column} SET DEFAULT {literal}"))
+        previous = current.get(column)
+        restore.append(f"ALTER TABLE {table.name} ALTER COLUMN {column} "
+                       + (f"SET DEFAULT {previous}" if previous is not None else "DROP DEFAULT"))
+    return restore
+
+def _copy_file(connection, table, path, defaults, hasher, freeze):
+    """COPY one file into `table`. Returns the number of rows."""
+    cursor = connection.connection.cursor()
+    try:
+        with _open(path) as f:
+            file_columns, records = _records(f, path)
+            if not file_columns:
+                return 0
+            if _is_csv(path) and all(column in table.columns for column in file_columns) and table.name != 'users':
+                # The file is already what COPY expects, so the server can parse it; the model defaults
+                # of missing columns become server defaults for the duration of the load transaction.
+                restore = _server_defaults(connection, cursor, table,
+                                           {name: value for name, value in defaults.values.items() if name not in file_columns})
+                f.seek(0)
+                cursor.copy_expert(_copy_sql(table, file_columns, freeze, header=True), f, COPY_CHUNK_BYTES)
+                for statement in restore:
+                    connection.execute(text(statement))
+            else:
+                columns, convert = _converter(table, file_columns, _is_csv(path), defaults, hasher)
+                rows = (convert(record) for record in records)
+                if any(isinstance(table.columns[column].type, JSON) for column in columns):
+                    rows = (_json_values(row) for row in rows)
+                cursor.copy_expert(_copy_sql(table, columns, freeze), _CSVStream(rows), COPY_CHUNK_BYTES)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+def _insert_file(connection, table, path, defaults, hasher):
+    """Insert one file into `table` in batches. Returns the number of rows."""
+    rows = 0
+    with _open(path) as f:
+        file_columns, records = _records(f, path)
+        if not file_columns:
+            return 0
+        columns, convert = _converter(table, file_columns, _is_csv(path), defaults, hasher)
+        # COPY parses timestamps server side; DBAPI drivers want datetimes.
+        datetimes = [i for i, column in enumerate(columns) if isinstance(table.columns[column].type, DateTime)]
+        records = iter(records)
+        while True:
+            batch = []
+            for record in itertools.islice(records, INSERT_BATCH_ROWS):
+                values = list(convert(record))
+                for i in datetimes:
+                    if isinstance(values[i], str):
+                        values[i] = datetime.fromisoformat(values[i])
+                batch.append(dict(zip(columns, values)))
+            if not batch:
+                return rows
+            connection.execute(table.insert(), batch)
+            rows += len(batch)
+
+def _reset_sequence(connection, table):
+    # Files may set ids explicitly, which doesn't advance the id sequence.
+    if 'id' in table.columns and table.columns['id'].primary_key:
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+        ))
+
+def load_table(engine, table, paths, replace=False, hasher=None):
+    """Load the files at `paths` into `table` in one transaction. Returns the number of rows."""
+    defaults = _Defaults(table)
+    hasher = hasher or _Hasher()
+    rows = 0
+    with engine.begin() as connection:
+        if engine.dialect.name != 'postgresql':
+            if replace:
+                connection.execute(table.delete())
+            for path in paths:
+                rows += _insert_file(connection, table, path, defaults, hasher)
+            return rows
+
+        if replace:
+            connection.execute(text(f"TRUNCATE {table.name} RESTART IDENTITY CASCADE"))
+        indexes = _secondary_indexes(connection, table)
+        for name, _ in indexes:
+            connection.execute(text(f'DROP INDEX "{name}"'))
+        for path in paths:
+            rows += _copy_file(connection, table, path, defaults, hasher, freeze=replace)
+        connection.execute(text(f"SET LOCAL maintenance_work_mem = '{INDEX_BUILD_MEMORY}'"))
+        for _, definition in indexes:
+            connection.execute(text(definition))
+        _reset_sequence(connection, table)
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(text(f"ANALYZE {table.name}"))
+    return rows
+
+def load_directory(engine, directory, replace=False, report=None):
+    """Load every table with files in `directory`, parents first. Returns {table name: rows}."""
+    loaded = {}
+    hasher = _Hasher()
+    for table in db.metadata.sorted_tables:
+        paths = table_files(directory, table.name)
+        if not paths:
+            continue
+        start = time.perf_counter()
+        loaded[table.name] = load_table(engine, table, paths, replace=replace, hasher=hasher)
+        if report is not None:
+            report(table.name, loaded[table.name], time.perf_counter() - start)
+    return loaded
+
+def loaded_documents(loaded, replace=False):
+    """Yield the keys of the ideas and knowledge sources a load may have changed, for the global KB refresh.
+
+    Appended rows are the documents without an extract yet. After --replace any id
+    may hold a new document, and the extracts of documents that are gone must be removed.
+    """
+    for document_type, model in DOCUMENT_MODELS.items():
+        if model.__tablename__ not in loaded:
+            continue
+        extracted = db.session.query(DocumentExtract.document_id).filter(DocumentExtract.document_type == document_type)
+        if replace:
+            ids = db.session.query(model.id).union(extracted)
+        else:
+            ids = db.session.query(model.id).filter(model.id.notin_(extracted))
+        # Streamed from a server-side cursor: a load may hold millions of documents.
+        for document_id, in ids.yield_per(REFRESH_CHUNK_KEYS):
+            yield document_key(document_type, document_id)
+
+def queue_loaded_documents(loaded, replace=False):
+    """Queue the documents of a load for the global KB refresh, in chunks.
+
+    Returns the number queued, or None if Redis is unavailable.
+    """
+    keys = loaded_documents(loaded, replace=replace)
+    queued = 0
+    while True:
+        chunk = list(itertools.islice(keys, REFRESH_CHUNK_KEYS))
+        if not chunk:
+            return queued
+        if not enqueue_documents(chunk):
+            return None
+        queued += len(chunk)
+
+def _report(table_name, rows, elapsed):
+    click.echo(f"{table_name:<36} {rows:>12,} rows {elapsed:9.1f} s {rows / max(elapsed, 1e-9):>12,.0f} rows/s")
+
+@click.command('load-data')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--replace', is_flag=True, help="Empty the loaded tables (and the tables referencing them) first.")
+@click.option('--no-refresh', is_flag=True, help="Don't queue the loaded ideas and knowledge sources for the global knowledge base.")
+def load_data_command(directory, replace, no_refresh):
+    """Bulk load the CSV and NDJSON files in DIRECTORY into their tables."""
+    db.create_all()
+    start = time.perf_counter()
+    loaded = load_directory(db.engine, directory, replace=replace, report=_report)
+    elapsed = time.perf_counter() - start
+    rows = sum(loaded.values())
+    click.echo(f"Loaded {rows:,} rows into {len(loaded)} table(s) in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):,.0f} rows/s).")
+    if 'knowledge_bases' in loaded:
+        click.echo(f"Built the graph views of {build_missing_graph_views()} knowledge base(s).")
+    invalidate_knowledge_base_fragments()
+    if no_refresh:
+        return
+    queued = queue_loaded_documents(loaded, replace=replace)
+    if queued is None:
+        click.echo("Redis is unavailable, so the global knowledge base won't include the loaded documents.")
+    elif queued:
+        click.echo(f"Queued {queued:,} document(s) for extraction into the global knowledge base "
+                   "(load with --no-refresh to skip this).")
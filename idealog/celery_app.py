@@ -1,6 +1,9 @@
 from celery import Celery, Task
+from celery.signals import worker_process_init
 from flask import Flask
 
+from idealog.profiler import start_profiler
+
 def celery_init_app(app: Flask) -> Celery:
     class FlaskTask(Task):
         def __call__(self, *args, **kwargs):
@@ -14,6 +17,11 @@ def celery_init_app(app: Flask) -> Celery:
     celery_app.conf.worker_prefetch_multiplier = 1
     celery_app.conf.worker_max_tasks_per_child = 1
 
+    @worker_process_init.connect(weak=False)
+    def start_worker_profiler(**kwargs):
+        # Each pool process, so a task's process can be profiled from the admin page.
+        start_profiler(app, 'celery')
+
     celery_app.set_default()
     app.extensions["celery"] = celery_app
     return celery_app
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""Splitting uploaded files into knowledge source documents.
+
+Supported files are plaintext (.txt), Markdown (.md, .markdown) and HTML
+(.html, .htm), on their own or inside .zip and .tar(.gz/.bz2/.xz) archives.
+
+- Markdown files are split at level 1 headings; each heading names a document.
+- Plaintext files are split at form feeds; the first line names a document.
+- HTML files are one document each, extracted the same way as web articles.
+
+Text files are memory-mapped and scanned with `mmap.find`, so only the
+document being decoded is ever in memory, and documents longer than
+MAX_DOCUMENT_BYTES are cut at a line break into parts. Archive members are
+copied to a scratch file next to the archive in chunks and processed like
+plain files. Memory use therefore doesn't grow with the size of an upload.
+"""
+import mmap
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from idealog.article_fetcher import parse_article
+
+TEXT_EXTENSIONS = ['.txt', '.md', '.markdown']
+HTML_EXTENSIONS = ['.html', '.htm']
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz']
+
+MAX_DOCUMENT_BYTES = 256 * 1024
+MAX_HTML_BYTES = 20 * 1024 * 1024
+MAX_MEMBER_BYTES = 2 * 1024 * 1024 * 1024
+MAX_NAME_LENGTH = 200
+COPY_BUFFER_BYTES = 1024 * 1024
+
+def _extension(name):
+    name = name.lower()
+    for extension in ARCHIVE_EXTENSIONS + TEXT_EXTENSIONS + HTML_EXTENSIONS:
+        if name.endswith(extension):
+            return extension
+    return None
+
+def supported_file(name):
+    """Whether `name` is a file or archive the ingestion can read."""
+    return _extension(name) is not None
+
+def _document(name, text, url):
+    return {"name": name[:MAX_NAME_LENGTH], "text": text, "url": url, "publish_date": None}
+
+def _sections(data, size, markdown):
+    """(start, end) byte ranges of the documents in a mapped text file."""
+    separator = b"\n# " if markdown else b"\f"
+    start = 0
+    while start < size:
+        end = data.find(separator, start + 1)
+        end = size if end < 0 else end + (1 if markdown else 0)
+        yield start, end
+        start = end if markdown else end + 1
+
+def _parts(data, start, end):
+    """Cut a section longer than MAX_DOCUMENT_BYTES at line breaks."""
+    while end - start > MAX_DOCUMENT_BYTES:
+        cut = data.rfind(b"\n", start, start + MAX_DOCUMENT_BYTES)
+        cut = start + MAX_DOCUMENT_BYTES if cut <= start else cut + 1
+        yield start, cut
+        start = cut
+    yield start, end
+
+def text_documents(path, name):
+    """Documents of a plaintext or Markdown file."""
+    markdown = _extension(name) != '.txt'
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for number, (start, end) in enumerate(_sections(data, size, markdown)):
+            title = None
+            for part, (part_start, part_end) in enumerate(_parts(data, start, end)):
+                text = data[part_start:part_end].decode('utf-8', errors='replace').strip()
+                if not text:
+                    continue
+                if title is None:
+                    first_line = text.split("\n", 1)[0]
+                    title = first_line.lstrip("#").strip() or f"{name} ({number + 1})"
+                document_name = title if part == 0 else f"{title} (part {part + 1})"
+                yield _document(document_name, text, f"file:{name}#{number + 1}" + (f".{part + 1}" if part else ""))
+
+def html_documents(path, name):
+    """The document of an HTML file; files over MAX_HTML_BYTES are skipped."""
+    if os.path.getsize(path) > MAX_HTML_BYTES:
+        return
+    with open(path, 'rb') as f:
+        article = parse_article(f"file:{name}", f.read(), None)
+    if article["text"].strip():
+        if article["name"] == article["url"]:
+            article["name"] = name
+        yield _document(article["name"], article["text"], article["url"])
+
+def _members(path, extension):
+    """(member name, readable stream) of the regular files in an archive."""
+    if extension == '.zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.file_size <= MAX_MEMBER_BYTES:
+                    with archive.open(info) as stream:
+                        yield info.filename, stream
+    else:
+        # Stream mode reads the archive front to back once, compressed or not.
+        with tarfile.open(path, 'r|*') as archive:
+            for info in archive:
+                if info.isfile() and info.size <= MAX_MEMBER_BYTES:
+                    yield info.name, archive.extractfile(info)
+
+def archive_documents(path, name):
+    """Documents of the supported files inside an archive. Nested archives are skipped."""
+    for member_name, stream in _members(path, _extension(name)):
+        basename = os.path.basename(member_name)
+        extension = _extension(member_name)
+        if basename.startswith('.') or '__MACOSX' in member_name or extension in (None, *ARCHIVE_EXTENSIONS):
+            continue
+        scratch = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+        try:
+            with scratch:
+                shutil.copyfileobj(stream, scratch, COPY_BUFFER_BYTES)
+            yield from file_documents(scratch.name, f"{name}/{member_name}")
+        finally:
+            os.remove(scratch.name)
+
+def file_documents(path, name):
+    """Documents of the file at `path`, uploaded as `name`, as dicts of name, text, url and publish_date."""
+    extension = _extension(name)
+    if extension in ARCHIVE_EXTENSIONS:
+        return archive_documents(path, name)
+    if extension in HTML_EXTENSIONS:
+        return html_documents(path, name)
+    if extension in TEXT_EXTENSIONS:
+        return text_documents(path, name)
+    return iter(())
@@ -1,8 +1,9 @@
 """WTF forms for Idealog."""
 from datetime import datetime
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField, SelectField, SelectMultipleField, DateTimeField
-from wtforms.validators import DataRequired, Email, Length
+from flask_wtf.file import MultipleFileField, FileRequired
+from wtforms import StringField, PasswordField, TextAreaField, SelectField, SelectMultipleField, DateTimeField, IntegerField
+from wtforms.validators import DataRequired, Email, Length, NumberRange
 
 #############################################################################
 # User Model FORMS
@@ -31,6 +32,11 @@ class UserEditForm(UserForm):
 
     user_type = SelectField('User Type', choices=[('admin', 'Administrator'), ('registered', 'Registered')])
 
+class ProfileForm(FlaskForm):
+    """Form for profiling a worker process."""
+    worker = SelectField('Worker', validators=[DataRequired()])
+    seconds = IntegerField('Seconds', default=30, validators=[NumberRange(min=1, max=300)])
+
 #############################################################################
 # IDEA MODEL FORMS
 class IdeaForm(FlaskForm):
@@ -68,6 +74,18 @@ class KnowledgeSourceAddForm(KnowledgeSourceForm):
     """Form for adding knowledge-sources."""
     knowledge_domains = SelectMultipleField('Knowledge Domains', choices=[], coerce=int)
 
+class KnowledgeSourceFilesForm(FlaskForm):
+    """Form for adding knowledge-sources from uploaded files and archives."""
+    files = MultipleFileField('Text, Markdown or HTML files, or archives of them', validators=[FileRequired()])
+    privacy = SelectField('Knowledge Source Privacy', choices=[('private', 'Private'), ('public', 'Public')])
+    knowledge_domains = SelectMultipleField('Knowledge Domains', choices=[], coerce=int)
+
+class KnowledgeSourceInternetForm(FlaskForm):
+    """Form for adding knowledge-sources from articles on the internet."""
+    urls = TextAreaField('Article URLs, one per line', validators=[DataRequired()])
+    privacy = SelectField('Knowledge Source Privacy', choices=[('private', 'Private'), ('public', 'Public')])
+    knowledge_domains = SelectMultipleField('Knowledge Domains', choices=[], coerce=int)
+
 #############################################################################
 # KNOWLEDGE DOMAIN MODEL FORMS
 class KnowledgeDomainAddForm(FlaskForm):
@@ -88,6 +106,15 @@ class KnowledgeBaseAddForm(KnowledgeBaseForm):
     knowledge_sources = SelectMultipleField('Knowledge Sources', choices=[], coerce=int)
     knowledge_domains = SelectMultipleField('Knowledge Domains', choices=[], coerce=int)
 
+class KnowledgeBaseNewsForm(KnowledgeBaseForm):
+    """Form for building knowledge bases from a news search."""
+    query = StringField('News Search Query', validators=[DataRequired()])
+    pages = IntegerField('Pages of Search Results', default=1, validators=[NumberRange(min=1, max=10)])
+
+class KnowledgeBaseMergeForm(KnowledgeBaseForm):
+    """Form for merging knowledge bases."""
+    knowledge_bases = SelectMultipleField('Knowledge Bases', choices=[], coerce=int)
+
 class KnowledgeBaseEditForm(KnowledgeBaseForm):
     """Form for editing knowledge bases."""
     privacy = SelectField('Knowledge Source Privacy', choices=[('private', 'Private'), ('public', 'Public')])
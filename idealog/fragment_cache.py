@@ -0,0 +1,131 @@
+"""Redis-backed fragment cache for anonymous pages.
+
+The guest homepage's list of public knowledge bases and the payload of the
+latest public knowledge base are the same for every visitor, so they are
+built once and kept in Redis until a knowledge base is created, edited,
+deleted or finishes processing. Invalidation hangs off SQLAlchemy events so
+the Celery worker flipping a KB to 'ready' clears the cache as well. The same
+events remove the path query graphs cached on disk (see kb_paths.py) of KBs
+that were deleted or got a new payload.
+"""
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, load_only
+
+from idealog.models import db, KnowledgeBase
+from idealog.kb_payload import payload_text
+from idealog.kb_stream import payload_sizes, should_stream
+from idealog.kb_paths import remove_cached_adjacency
+
+GUEST_KB_LIST_KEY = "idealog:fragment:guest_kb_list"
+LATEST_PUBLIC_KB_KEY = "idealog:fragment:latest_public_kb"
+
+FRAGMENT_KEYS = [GUEST_KB_LIST_KEY, LATEST_PUBLIC_KB_KEY]
+
+def _redis():
+    if not current_app.config.get('FRAGMENT_CACHE_TTL'):
+        return None
+    return current_app.extensions.get('redis')
+
+def cached_fragment(key, build):
+    """Return the cached text at `key`, calling `build()` and caching its result on a miss."""
+    r = _redis()
+    if r is not None:
+        try:
+            cached = r.get(key)
+            if cached is not None:
+                return cached.decode('utf-8')
+        except RedisError:
+            r = None
+
+    fragment = build()
+    if r is not None:
+        try:
+            r.set(key, fragment, ex=current_app.config['FRAGMENT_CACHE_TTL'])
+        except RedisError:
+            pass
+    return fragment
+
+def _build_latest_public_payload():
+    # A KB without an ETag has no stored payload yet, and isn't served by the API either.
+    knowledge_base = (KnowledgeBase.query
+                      .options(load_only(KnowledgeBase.id, KnowledgeBase.json_etag))
+                      .filter(KnowledgeBase.privacy == 'public', KnowledgeBase.status == 'ready',
+                              KnowledgeBase.json_etag.isnot(None))
+                      .order_by(KnowledgeBase.id.desc())
+                      .first())
+    if knowledge_base is None:
+        # Cached too, so an empty site doesn't query on every hit either.
+        return {"id": b""}
+    payload = {"id": str(knowledge_base.id).encode('utf-8'), "etag": knowledge_base.json_etag.encode('utf-8')}
+    if should_stream(payload_sizes(knowledge_base.id)):
+        # Too large to keep in Redis and read whole on every hit; the API streams it from the database.
+        return {**payload, "stream": b"1"}
+    # The representations stored by set_json_object(), copied rather than compressed again.
+    json_object, gzip_body, br_body = (db.session.query(KnowledgeBase.json_object, KnowledgeBase.json_gzip, KnowledgeBase.json_br)
+                                       .filter(KnowledgeBase.id == knowledge_base.id).one())
+    return {**payload, "json": payload_text(json_object).encode('utf-8'), "gzip": gzip_body, "br": br_body}
+
+def latest_public_knowledge_base_payload():
+    """Return the latest ready public KB as a dict of id/etag/json/gzip/br bytes, or None.
+
+    For a KB to stream (see kb_stream.py) there are only id/etag/stream."""
+    r = _redis()
+    payload = None
+    if r is not None:
+        try:
+            payload = {key.decode('utf-8'): value for key, value in r.hgetall(LATEST_PUBLIC_KB_KEY).items()}
+        except RedisError:
+            r = None
+
+    if not payload:
+        payload = _build_latest_public_payload()
+        if r is not None:
+            try:
+                with r.pipeline() as pipe:
+                    pipe.delete(LATEST_PUBLIC_KB_KEY)
+                    pipe.hset(LATEST_PUBLIC_KB_KEY, mapping=payload)
+                    pipe.expire(LATEST_PUBLIC_KB_KEY, current_app.config['FRAGMENT_CACHE_TTL'])
+                    pipe.execute()
+            except RedisError:
+                pass
+
+    if not payload["id"]:
+        return None
+    return payload
+
+def invalidate_knowledge_base_fragments():
+    """Drop every fragment built from knowledge base rows."""
+    r = _redis()
+    if r is None:
+        return
+    try:
+        r.delete(*FRAGMENT_KEYS)
+    except RedisError:
+        pass
+
+##############################################################################
+# Invalidation on knowledge base changes
+@event.listens_for(KnowledgeBase, 'after_insert')
+@event.listens_for(KnowledgeBase, 'after_update')
+@event.listens_for(KnowledgeBase, 'after_delete')
+def _mark_fragments_stale(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info['knowledge_base_fragments_stale'] = True
+        if target in session.deleted or inspect(target).attrs.json_etag.history.has_changes():
+            session.info.setdefault('knowledge_base_graphs_stale', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_stale_fragments(session):
+    stale_graphs = session.info.pop('knowledge_base_graphs_stale', None)
+    if session.info.pop('knowledge_base_fragments_stale', False) and has_app_context():
+        invalidate_knowledge_base_fragments()
+        if stale_graphs:
+            remove_cached_adjacency(stale_graphs)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_stale_fragments(session):
+    session.info.pop('knowledge_base_fragments_stale', None)
+    session.info.pop('knowledge_base_graphs_stale', None)
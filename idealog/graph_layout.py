@@ -0,0 +1,122 @@
+"""Server-side force-directed layout of knowledge base graphs.
+
+A Fruchterman-Reingold layout vectorised with NumPy, run once when a KB is
+built so the browser can draw the graph at its final positions instead of
+running a D3 simulation from random starting points. Runs are seeded, so the
+same KB always gets the same layout.
+
+Repulsion is computed exactly (in row chunks, to bound memory) for graphs of
+up to EXACT_REPULSION_LIMIT entities. Larger graphs use a one-level
+Barnes-Hut approximation: entities are binned into a GRID_SIZE x GRID_SIZE
+grid and repelled by each cell's centre of mass weighted by its population,
+which makes an iteration O(n * cells) instead of O(n^2).
+"""
+import numpy as np
+
+EXACT_REPULSION_LIMIT = 500
+GRID_SIZE = 32
+CHUNK_SIZE = 512
+# Distance between connected entities in the stored coordinates, in SVG pixels.
+EDGE_LENGTH = 80
+GRAVITY = 0.05
+
+def _pull_from(x, y, px, py, weight):
+    """Sum of inverse-distance pushes on points (x, y) away from points (px, py) of the given weight."""
+    dx = x[:, None] - px[None, :]
+    dy = y[:, None] - py[None, :]
+    # k^2 / d along the unit vector, with the ideal distance k = 1.
+    scale = weight / np.maximum(dx * dx + dy * dy, 1e-4)
+    return (dx * scale).sum(axis=1), (dy * scale).sum(axis=1)
+
+def _repulsion_exact(pos):
+    x, y = pos[:, 0], pos[:, 1]
+    disp = np.zeros_like(pos)
+    for start in range(0, len(pos), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        disp[start:stop, 0], disp[start:stop, 1] = _pull_from(x[start:stop], y[start:stop], x, y, 1.0)
+    return disp
+
+def _repulsion_grid(pos):
+    low = pos.min(axis=0)
+    span = np.maximum(pos.max(axis=0) - low, 1e-9)
+    cell_xy = np.minimum(((pos - low) / span * GRID_SIZE).astype(np.int64), GRID_SIZE - 1)
+    cell = cell_xy[:, 0] * GRID_SIZE + cell_xy[:, 1]
+
+    num_cells = GRID_SIZE * GRID_SIZE
+    mass = np.bincount(cell, minlength=num_cells).astype(float)
+    sums = np.stack([np.bincount(cell, weights=pos[:, axis], minlength=num_cells) for axis in (0, 1)], axis=1)
+    occupied = mass > 0
+    mass, sums = mass[occupied], sums[occupied]
+    centroid = sums / mass[:, None]
+    # Position of each entity's own cell among the occupied cells.
+    own = np.cumsum(occupied)[cell] - 1
+
+    disp = np.zeros_like(pos)
+    for start in range(0, len(pos), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        disp[start:stop, 0], disp[start:stop, 1] = _pull_from(pos[start:stop, 0], pos[start:stop, 1],
+                                                              centroid[:, 0], centroid[:, 1], mass)
+
+    # Replace the own-cell term, which counted each entity against a centroid
+    # that includes itself, with the centroid of the other entities in the cell.
+    own_mass = mass[own]
+    delta = pos - centroid[own]
+    disp -= delta * (own_mass / np.maximum((delta ** 2).sum(axis=1), 1e-4))[:, None]
+    others = own_mass > 1
+    rest_mass = own_mass[others] - 1
+    rest_centroid = (sums[own[others]] - pos[others]) / rest_mass[:, None]
+    delta = pos[others] - rest_centroid
+    disp[others] += delta * (rest_mass / np.maximum((delta ** 2).sum(axis=1), 1e-4))[:, None]
+    return disp
+
+def force_layout(num_nodes, edges, iterations=None, seed=0):
+    """Return an (num_nodes, 2) array of positions for a graph given as an (m, 2) array of edges."""
+    if num_nodes == 1:
+        return np.zeros((1, 2))
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(num_nodes)
+    pos = rng.uniform(-side / 2, side / 2, size=(num_nodes, 2))
+
+    exact = num_nodes <= EXACT_REPULSION_LIMIT
+    if iterations is None:
+        iterations = 100 if exact else 50
+    heads, tails = edges[:, 0], edges[:, 1]
+
+    temperature = side / 4
+    cooling = temperature / (iterations + 1)
+    for _ in range(iterations):
+        disp = _repulsion_exact(pos) if exact else _repulsion_grid(pos)
+
+        delta = pos[heads] - pos[tails]
+        dist = np.sqrt((delta ** 2).sum(axis=1))
+        pull = delta * dist[:, None]
+        for axis in (0, 1):
+            disp[:, axis] -= np.bincount(heads, weights=pull[:, axis], minlength=num_nodes)
+            disp[:, axis] += np.bincount(tails, weights=pull[:, axis], minlength=num_nodes)
+
+        # Keeps disconnected components from drifting apart.
+        disp -= GRAVITY * pos
+
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)
+        pos += disp / length[:, None] * np.minimum(length, temperature)[:, None]
+        temperature -= cooling
+
+    return pos - pos.mean(axis=0)
+
+def layout_graph(graph_index, iterations=None, seed=0):
+    """Lay out a KB's graph index. Returns {"x": [...], "y": [...]} aligned with the index's entities."""
+    num_nodes = len(graph_index['entities'])
+    if num_nodes == 0:
+        return {"x": [], "y": []}
+
+    edges = np.array([(head, tail) for head, _, tail in graph_index['relations'] if head != tail], dtype=np.int64).reshape(-1, 2)
+    pos = force_layout(num_nodes, edges, iterations, seed)
+
+    # Scale so that a typical relation is drawn EDGE_LENGTH pixels long.
+    if len(edges):
+        typical = np.median(np.sqrt(((pos[edges[:, 0]] - pos[edges[:, 1]]) ** 2).sum(axis=1)))
+        pos *= EDGE_LENGTH / max(typical, 1e-9)
+    return {
+        "x": np.round(pos[:, 0], 1).tolist(),
+        "y": np.round(pos[:, 1], 1).tolist(),
+    }
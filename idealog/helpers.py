@@ -25,7 +25,7 @@ def requires_login(view_func):
 def requires_admin(view_func):
     @wraps(view_func)
     def wrapper(*args, **kwargs):
-        if 'admin' not in g.user.user_type:
+        if not g.user.is_admin:
             flash("You don't have admin level access.", "danger")
             return redirect(url_for('views.homepage'))
         return view_func(*args, **kwargs)
@@ -1,18 +1,26 @@
+from urllib.parse import urlsplit
 from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, Blueprint, url_for
-from .models import db, User, Idea, Group, KnowledgeSource, KnowledgeDomain, KnowledgeBase
-from .forms import IdeaAddForm, GroupAddForm, KnowledgeSourceAddForm, KnowledgeDomainAddForm, KnowledgeBaseAddForm, KnowledgeBaseEditForm
+from sqlalchemy.orm import undefer
+from .models import db, User, Idea, Group, KnowledgeSource, KnowledgeDomain, KnowledgeBase, DocumentExtract, load_texts
+from .forms import IdeaAddForm, GroupAddForm, KnowledgeSourceAddForm, KnowledgeDomainAddForm, KnowledgeBaseAddForm, KnowledgeBaseEditForm, KnowledgeBaseMergeForm, KnowledgeBaseNewsForm, KnowledgeSourceInternetForm, KnowledgeSourceFilesForm
 from .ml_functions import class_kb
 from .helpers import requires_login, requires_admin
 from . import tasks
+from .kb_refresh import DOCUMENT_MODELS, GLOBAL_CREATION_MODE, document_key, enqueue_documents
+from .file_ingest import supported_file
+from .uploads import save_uploads, remove_finished_batches
 
 bp = Blueprint('idealog', __name__)
 
+# Urls accepted per submission of the new-from-internet form.
+MAX_FETCH_URLS = 1000
+
 ##############################################################################
 # General idea web routes (pages)
 @bp.route('/ideas', methods=["GET"])
 @requires_login
 def render_all_ideas():
-    if 'admin' in g.user.user_type:
+    if g.user.is_admin:
         ideas = Idea.sorted_query()
     else:
         ideas = Idea.query.filter((Idea.privacy == 'public') | (Idea.user_id == g.user.id)).all()
@@ -22,14 +30,14 @@ def render_all_ideas():
 @bp.route('/ideas/<int:idea_id>', methods=["GET"])
 @requires_login
 def detail_idea(idea_id):
-    idea = Idea.query.get_or_404(idea_id)
+    idea = Idea.query.options(undefer(Idea.text)).get_or_404(idea_id)
     return render_template('ideas/detail_idea.html', idea=idea)
 
 @bp.route('/ideas/new', methods=["GET", "POST"])
 @requires_login
 def add_new_idea():
     form = IdeaAddForm()
-    form.idea_groups.choices = [(group.id, group.name) for group in Group.query.all()]
+    form.idea_groups.choices = Group.choices()
 
     if form.validate_on_submit():
         
@@ -67,10 +75,10 @@ def add_new_idea():
 @bp.route('/ideas/<int:idea_id>/edit', methods=["GET", "POST"])
 @requires_login
 def edit_idea(idea_id):
-    idea = Idea.query.get_or_404(idea_id)
+    idea = Idea.query.options(undefer(Idea.text)).get_or_404(idea_id)
 
     form = IdeaAddForm(obj=idea)
-    form.idea_groups.choices = [(group.id, group.name) for group in Group.query.all()]
+    form.idea_groups.choices = Group.choices()
 
     if form.validate_on_submit():
         groups_choices_ids = form.idea_groups.data
@@ -114,7 +122,7 @@ def delete_idea(idea_id):
 @bp.route('/idea-groups', methods=["GET"])
 @requires_login
 def render_all_groups():
-    if 'admin' in g.user.user_type:
+    if g.user.is_admin:
         groups = Group.query.all()
     else:
         groups = Group.query.filter((Group.user_id == g.user.id)).all()
@@ -183,7 +191,7 @@ def delete_group(group_id):
 @bp.route('/knowledge-sources', methods=["GET"])
 @requires_login
 def render_all_knowledge_sources():
-    if 'admin' in g.user.user_type:
+    if g.user.is_admin:
         knowledge_sources = KnowledgeSource.query.all()
     else:
         knowledge_sources = KnowledgeSource.query.filter((KnowledgeSource.privacy == 'public') | (KnowledgeSource.user_id == g.user.id)).all()
@@ -193,7 +201,7 @@ def render_all_knowledge_sources():
 @bp.route('/knowledge-sources/<int:knowledge_source_id>', methods=["GET"])
 @requires_login
 def detail_knowledge_source(knowledge_source_id):
-    knowledge_source = KnowledgeSource.query.get_or_404(knowledge_source_id)
+    knowledge_source = KnowledgeSource.query.options(undefer(KnowledgeSource.text)).get_or_404(knowledge_source_id)
 
     return render_template('knowledge_sources/detail_knowledge_source.html', knowledge_source=knowledge_source)
 
@@ -201,7 +209,7 @@ def detail_knowledge_source(knowledge_source_id):
 @requires_login
 def add_new_knowledge_source():
     form = KnowledgeSourceAddForm()
-    form.knowledge_domains.choices = [(knowledge_domain.id, knowledge_domain.name) for knowledge_domain in KnowledgeDomain.query.all()]
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
 
     if form.validate_on_submit():
         
@@ -240,22 +248,71 @@ def add_new_knowledge_source():
 @requires_login
 @requires_admin
 def add_new_knowledge_source_internet():
-    return redirect(url_for('views.homepage'))
+    """Download articles from a list of urls in the background and add them as knowledge sources."""
+    form = KnowledgeSourceInternetForm()
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
+
+    if form.validate_on_submit():
+        urls = list(dict.fromkeys(line.strip() for line in form.urls.data.splitlines() if line.strip()))
+        invalid = [url for url in urls if urlsplit(url).scheme not in ('http', 'https') or not urlsplit(url).netloc]
+        if invalid:
+            flash(f"Not a valid url: {invalid[0]}", "danger")
+            return render_template('knowledge_sources/new_knowledge_source_internet.html', form=form)
+        if len(urls) > MAX_FETCH_URLS:
+            flash(f"At most {MAX_FETCH_URLS} urls can be added at once.", "danger")
+            return render_template('knowledge_sources/new_knowledge_source_internet.html', form=form)
+
+        knowledge_domain_ids = [knowledge_domain.id for knowledge_domain in
+                                KnowledgeDomain.query.filter(KnowledgeDomain.id.in_(form.knowledge_domains.data)).all()]
+        if len(knowledge_domain_ids) != len(form.knowledge_domains.data):
+            flash("One or more selected knowledge domains do not exist.", "danger")
+            return render_template('knowledge_sources/new_knowledge_source_internet.html', form=form)
+
+        tasks.fetch_knowledge_sources.delay(urls, g.user.id, form.privacy.data, knowledge_domain_ids)
+        flash(f"Downloading {len(urls)} articles. They will appear as knowledge sources as they are processed.", "success")
+        return redirect(url_for('idealog.render_all_knowledge_sources'))
+
+    return render_template('knowledge_sources/new_knowledge_source_internet.html', form=form)
 
 @bp.route('/knowledge-sources/new-from-files', methods=["GET", "POST"])
 @requires_login
 @requires_admin
 def add_new_knowledge_source_files():
-    return redirect(url_for('views.homepage'))
+    """Save uploaded files to shared storage and split them into knowledge sources in the background."""
+    form = KnowledgeSourceFilesForm()
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
+
+    if form.validate_on_submit():
+        uploads = [upload for upload in form.files.data if upload.filename]
+        unsupported = [upload.filename for upload in uploads if not supported_file(upload.filename)]
+        if unsupported:
+            flash(f"Unsupported file: {unsupported[0]}", "danger")
+            return render_template('knowledge_sources/new_knowledge_source_files.html', form=form)
+
+        knowledge_domain_ids = [knowledge_domain.id for knowledge_domain in
+                                KnowledgeDomain.query.filter(KnowledgeDomain.id.in_(form.knowledge_domains.data)).all()]
+        if len(knowledge_domain_ids) != len(form.knowledge_domains.data):
+            flash("One or more selected knowledge domains do not exist.", "danger")
+            return render_template('knowledge_sources/new_knowledge_source_files.html', form=form)
+
+        remove_finished_batches(tasks.ingest_knowledge_source_files)
+        batch, files = save_uploads(uploads)
+        # Named after its batch, so the batch can be removed once the task has finished.
+        tasks.ingest_knowledge_source_files.apply_async((batch, files, g.user.id, form.privacy.data, knowledge_domain_ids),
+                                                        task_id=batch)
+        flash(f"Processing {len(files)} files. Their documents will appear as knowledge sources as they are stored.", "success")
+        return redirect(url_for('idealog.render_all_knowledge_sources'))
+
+    return render_template('knowledge_sources/new_knowledge_source_files.html', form=form)
 
 @bp.route('/knowledge-sources/<int:knowledge_source_id>/edit', methods=["GET", "POST"])
 @requires_login
 def edit_knowledge_source(knowledge_source_id):
-    knowledge_source = KnowledgeSource.query.get_or_404(knowledge_source_id)
+    knowledge_source = KnowledgeSource.query.options(undefer(KnowledgeSource.text)).get_or_404(knowledge_source_id)
 
     form = KnowledgeSourceAddForm(obj=knowledge_source)
 
-    form.knowledge_domains.choices = [(knowledge_domain.id, knowledge_domain.name) for knowledge_domain in KnowledgeDomain.query.all()]
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
 
     if form.validate_on_submit():
         knowledge_domains_choices_ids = form.knowledge_domains.data
@@ -299,7 +356,7 @@ def delete_knowledge_source(knowledge_source_id):
 @bp.route('/knowledge-domains', methods=["GET"])
 @requires_login
 def render_all_knowledge_domains():
-    if 'admin' in g.user.user_type:
+    if g.user.is_admin:
         knowledge_domains = KnowledgeDomain.query.all()
     else:
         knowledge_domains = KnowledgeDomain.query.filter((KnowledgeDomain.user_id == g.user.id)).all()
@@ -361,7 +418,7 @@ def delete_knowledge_domain(knowledge_domain_id):
 @bp.route('/knowledge-bases', methods=["GET"])
 @requires_login
 def render_all_knowledge_bases():
-    if 'admin' in g.user.user_type:
+    if g.user.is_admin:
         knowledge_bases = KnowledgeBase.query.all()
     else:
         knowledge_bases = KnowledgeBase.query.filter((KnowledgeBase.privacy == 'public') | (KnowledgeBase.user_id == g.user.id)).all()
@@ -378,9 +435,28 @@ def detail_knowledge_base(knowledge_base_id):
 @requires_login
 @requires_admin
 def refresh_knowledge_base():
-    """Check whether all existing ideas and knowledge sources are included in the auto generated knowledge base of all ideas and kss
-    and if there isn't one that has all ideas and kss - create a new one and display when ready """
-    return redirect(url_for('views.homepage'))
+    """Check whether all existing ideas and knowledge sources are included in the auto generated knowledge base of all ideas and kss.
+
+    Edits are picked up automatically by change capture (see kb_refresh.py); this queues
+    the documents that were never extracted, e.g. ones created before change capture existed.
+    """
+    missing = []
+    for document_type, model in DOCUMENT_MODELS.items():
+        extracted = db.session.query(DocumentExtract.document_id).filter(DocumentExtract.document_type == document_type)
+        missing.extend(document_key(document_type, document_id)
+                       for (document_id,) in db.session.query(model.id).filter(model.id.not_in(extracted)))
+
+    if not missing:
+        flash("The knowledge base of all ideas and knowledge sources is up to date.", "success")
+    elif enqueue_documents(missing, countdown=0):
+        flash(f"Adding {len(missing)} ideas and knowledge sources to the knowledge base of all ideas and knowledge sources.", "success")
+    else:
+        flash("Could not reach the refresh queue. Try again later.", "danger")
+
+    knowledge_base = KnowledgeBase.query.filter_by(creation_mode=GLOBAL_CREATION_MODE).first()
+    if knowledge_base:
+        return redirect(url_for('idealog.detail_knowledge_base', knowledge_base_id=knowledge_base.id))
+    return redirect(url_for('idealog.render_all_knowledge_bases'))
 
 @bp.route('/knowledge-bases/new', methods=["GET", "POST"])
 @requires_login
@@ -388,10 +464,10 @@ def refresh_knowledge_base():
 def add_new_knowledge_base():
     form = KnowledgeBaseAddForm()
 
-    form.ideas.choices = [(idea.id, idea.name) for idea in Idea.query.all()]
-    form.idea_groups.choices = [(group.id, group.name) for group in Group.query.all()]
-    form.knowledge_sources.choices = [(knowledge_source.id, knowledge_source.name) for knowledge_source in KnowledgeSource.query.all()]
-    form.knowledge_domains.choices = [(knowledge_domain.id, knowledge_domain.name) for knowledge_domain in KnowledgeDomain.query.all()]
+    form.ideas.choices = Idea.choices()
+    form.idea_groups.choices = Group.choices()
+    form.knowledge_sources.choices = KnowledgeSource.choices()
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
 
     if form.validate_on_submit():
         try:
@@ -440,7 +516,8 @@ def add_new_knowledge_base():
                 ideas_from_groups.extend(idea_group.ideas)
             
             for idea in ideas_from_groups:
-                knowledge_base.ideas.append(idea)
+                if idea not in knowledge_base.ideas:
+                    knowledge_base.ideas.append(idea)
 
             for idea_group in idea_groups:
                 knowledge_base.idea_groups.append(idea_group)
@@ -460,20 +537,22 @@ def add_new_knowledge_base():
                 knowledge_sources_from_domains.extend(knowledge_domain.knowledge_sources)
             
             for knowledge_source in knowledge_sources_from_domains:
-                knowledge_base.knowledge_sources.append(knowledge_source)
+                if knowledge_source not in knowledge_base.knowledge_sources:
+                    knowledge_base.knowledge_sources.append(knowledge_source)
             
             for knowledge_domain in knowledge_domains:
                 knowledge_base.knowledge_domains.append(knowledge_domain)
 
-            merged_ideas = ideas + knowledge_sources + ideas_from_groups + knowledge_sources_from_domains
+            merged_ideas = load_texts(ideas + knowledge_sources + ideas_from_groups + knowledge_sources_from_domains)
             knowledge_base_class_object = class_kb.from_ideas_to_kb(merged_ideas,verbose=False)
             jsonified_knowledge_base_object = knowledge_base_class_object.to_json()
 
-            knowledge_base.json_object = jsonified_knowledge_base_object
+            knowledge_base.set_json_object(jsonified_knowledge_base_object)
             knowledge_base.status = 'ready'
             
             db.session.add(knowledge_base)
             db.session.commit()
+            tasks.build_kb_graph_views.delay(knowledge_base.id)
             flash("Successfully added a new knowledge_base.", "success")
         except Exception as e:
             flash(f"Something went wrong. Here's your error: {e}", "danger")
@@ -487,10 +566,10 @@ def add_new_knowledge_base_celery():
     """This is the same as add_new_knowledge_base but it uses celery to create the knowledge base."""
     form = KnowledgeBaseAddForm()
 
-    form.ideas.choices = [(idea.id, idea.name) for idea in Idea.query.all()]
-    form.idea_groups.choices = [(group.id, group.name) for group in Group.query.all()]
-    form.knowledge_sources.choices = [(knowledge_source.id, knowledge_source.name) for knowledge_source in KnowledgeSource.query.all()]
-    form.knowledge_domains.choices = [(knowledge_domain.id, knowledge_domain.name) for knowledge_domain in KnowledgeDomain.query.all()]
+    form.ideas.choices = Idea.choices()
+    form.idea_groups.choices = Group.choices()
+    form.knowledge_sources.choices = KnowledgeSource.choices()
+    form.knowledge_domains.choices = KnowledgeDomain.choices()
 
     if form.validate_on_submit():
         try:
@@ -539,7 +618,8 @@ def add_new_knowledge_base_celery():
                 ideas_from_groups.extend(idea_group.ideas)
             
             for idea in ideas_from_groups:
-                knowledge_base.ideas.append(idea)
+                if idea not in knowledge_base.ideas:
+                    knowledge_base.ideas.append(idea)
 
             for idea_group in idea_groups:
                 knowledge_base.idea_groups.append(idea_group)
@@ -559,7 +639,8 @@ def add_new_knowledge_base_celery():
                 knowledge_sources_from_domains.extend(knowledge_domain.knowledge_sources)
             
             for knowledge_source in knowledge_sources_from_domains:
-                knowledge_base.knowledge_sources.append(knowledge_source)
+                if knowledge_source not in knowledge_base.knowledge_sources:
+                    knowledge_base.knowledge_sources.append(knowledge_source)
             
             for knowledge_domain in knowledge_domains:
                 knowledge_base.knowledge_domains.append(knowledge_domain)
@@ -575,6 +656,28 @@ def add_new_knowledge_base_celery():
         return redirect(url_for('idealog.render_all_knowledge_bases'))
     return render_template('tasks.html', form=form)
 
+@bp.route('/knowledge-bases/new-from-news', methods=["GET", "POST"])
+@requires_login
+@requires_admin
+def add_new_knowledge_base_news():
+    """Build a knowledge base from the news articles found for a search query in the background."""
+    form = KnowledgeBaseNewsForm()
+
+    if form.validate_on_submit():
+        knowledge_base = KnowledgeBase(
+            name=form.name.data,
+            user_id = g.user.id,
+            status = 'pending'
+        )
+        db.session.add(knowledge_base)
+        db.session.commit()
+
+        tasks.create_kb_from_query.delay(knowledge_base.id, form.query.data.strip(), form.pages.data)
+        flash(f"Searching the news for \"{form.query.data.strip()}\". The knowledge base will be ready once the articles are processed.", "success")
+        return redirect(url_for('idealog.render_all_knowledge_bases'))
+
+    return render_template('knowledge_bases/new_knowledge_base_news.html', form=form)
+
 @bp.route('/knowledge-bases/<int:knowledge_base_id>/edit', methods=["GET", "POST"])
 @requires_login
 @requires_admin
@@ -585,7 +688,8 @@ def edit_knowledge_base(knowledge_base_id):
     if form.validate_on_submit():
         knowledge_base.name = form.name.data
         knowledge_base.privacy = form.privacy.data
-        knowledge_base.creation_mode = form.creation_mode.data
+        if knowledge_base.creation_mode != GLOBAL_CREATION_MODE:
+            knowledge_base.creation_mode = form.creation_mode.data
 
         try:
             db.session.commit()
@@ -599,8 +703,54 @@ def edit_knowledge_base(knowledge_base_id):
 @requires_login
 @requires_admin
 def merge_knowledge_bases():
-    """Select knowledge bases and merge them"""
-    return redirect(url_for('views.homepage'))
+    """Select knowledge bases and merge their stored payloads into a new one on the celery worker."""
+    form = KnowledgeBaseMergeForm()
+    form.knowledge_bases.choices = KnowledgeBase.choices(KnowledgeBase.status == 'ready')
+
+    if form.validate_on_submit():
+        try:
+            knowledge_bases_choices_ids = form.knowledge_bases.data
+            if len(knowledge_bases_choices_ids) < 2:
+                flash("Select at least two knowledge bases to merge.", "danger")
+                return render_template('knowledge_bases/merge_knowledge_bases.html', form=form)
+
+            source_knowledge_bases = KnowledgeBase.query.filter(
+                KnowledgeBase.id.in_(knowledge_bases_choices_ids), KnowledgeBase.status == 'ready').all()
+            if len(source_knowledge_bases) != len(knowledge_bases_choices_ids):
+                flash("One or more selected knowledge bases do not exist or are not ready.", "danger")
+                return render_template('knowledge_bases/merge_knowledge_bases.html', form=form)
+
+            knowledge_base = KnowledgeBase(
+                name=form.name.data,
+                user_id = g.user.id,
+                status = 'pending'
+            )
+
+            # The merged knowledge base covers everything its sources were built from.
+            for source_knowledge_base in source_knowledge_bases:
+                for idea in source_knowledge_base.ideas:
+                    if idea not in knowledge_base.ideas:
+                        knowledge_base.ideas.append(idea)
+                for knowledge_source in source_knowledge_base.knowledge_sources:
+                    if knowledge_source not in knowledge_base.knowledge_sources:
+                        knowledge_base.knowledge_sources.append(knowledge_source)
+                for idea_group in source_knowledge_base.idea_groups:
+                    if idea_group not in knowledge_base.idea_groups:
+                        knowledge_base.idea_groups.append(idea_group)
+                for knowledge_domain in source_knowledge_base.knowledge_domains:
+                    if knowledge_domain not in knowledge_base.knowledge_domains:
+                        knowledge_base.knowledge_domains.append(knowledge_domain)
+
+            db.session.add(knowledge_base)
+            db.session.commit()
+
+            result = tasks.merge_kbs.delay(knowledge_base.id, knowledge_bases_choices_ids)
+
+            flash("Successfully started merging the knowledge bases.", "success")
+        except Exception as e:
+            flash(f"Something went wrong. Here's your error: {e}", "danger")
+        return redirect(url_for('idealog.render_all_knowledge_bases'))
+    return render_template('knowledge_bases/merge_knowledge_bases.html', form=form)
 
 @bp.route('/knowledge-bases/<int:knowledge_base_id>/delete', methods=["GET", "POST"])
 @requires_login
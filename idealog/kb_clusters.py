@@ -0,0 +1,183 @@
+"""Community hierarchy of a knowledge base graph, for level-of-detail views.
+
+When a KB is built, its entities are grouped into communities (Louvain, on the
+graph index with relations counted as edge weights). The communities become
+the nodes of the next level and are grouped again, until a level has at most
+MAX_CLUSTER_NODES nodes. Level 0 is the entities themselves and the last level
+is the coarsest. Every cluster has at most MAX_CLUSTER_NODES children, so the
+coarsest level and the expansion of any single cluster are bounded no matter
+how large the KB is.
+
+The stored hierarchy is a small set of integer arrays:
+
+    parents     parents[l][i] is the level l+1 cluster of node i at level l
+    sizes       sizes[l][c] is the number of entities in cluster c at level l+1
+    labels      labels[l][c] is the best connected entity in that cluster, used as its name
+"""
+from collections import Counter
+
+import networkx as nx
+
+CLUSTERS_VERSION = 1
+MAX_CLUSTER_NODES = 200
+
+def _bfs_order(graph, members):
+    """Order `members` so that neighbouring nodes stay close, starting from the best connected one."""
+    subgraph = graph.subgraph(members)
+    ordered = []
+    seen = set()
+    for start in sorted(members, key=lambda node: (-subgraph.degree(node, weight='weight'), node)):
+        if start not in seen:
+            seen.add(start)
+            ordered.append(start)
+            for _, node in nx.bfs_edges(subgraph, start):
+                seen.add(node)
+                ordered.append(node)
+    return ordered
+
+def _partition(graph, seed):
+    """Group the nodes of `graph` into clusters of at most MAX_CLUSTER_NODES nodes."""
+    communities = nx.community.louvain_communities(graph, weight='weight', seed=seed)
+    groups = []
+    singletons = []
+    for community in sorted(communities, key=lambda community: (-len(community), min(community))):
+        if len(community) == 1:
+            # Isolated entities each form a community of their own; pack them
+            # together so they don't dominate the coarser levels.
+            singletons.extend(community)
+            continue
+        ordered = _bfs_order(graph, community)
+        for start in range(0, len(ordered), MAX_CLUSTER_NODES):
+            groups.append(ordered[start:start + MAX_CLUSTER_NODES])
+    singletons.sort()
+    for start in range(0, len(singletons), MAX_CLUSTER_NODES):
+        groups.append(singletons[start:start + MAX_CLUSTER_NODES])
+    return groups
+
+def build_cluster_hierarchy(graph_index, seed=0):
+    """Build the cluster hierarchy of a graph index (see kb_index.build_graph_index)."""
+    num_entities = len(graph_index['entities'])
+    degree = Counter()
+    weights = Counter()
+    for head, _, tail in graph_index['relations']:
+        degree[head] += 1
+        degree[tail] += 1
+        if head != tail:
+            weights[min(head, tail), max(head, tail)] += 1
+
+    parents, sizes, labels = [], [], []
+    # Per node of the current level: entity count and representative entity.
+    node_sizes = [1] * num_entities
+    node_labels = list(range(num_entities))
+    while len(node_sizes) > MAX_CLUSTER_NODES:
+        graph = nx.Graph()
+        graph.add_nodes_from(range(len(node_sizes)))
+        graph.add_weighted_edges_from((a, b, weight) for (a, b), weight in weights.items())
+
+        groups = _partition(graph, seed)
+        parent = [0] * len(node_sizes)
+        for cluster, group in enumerate(groups):
+            for node in group:
+                parent[node] = cluster
+        node_sizes = [sum(node_sizes[node] for node in group) for group in groups]
+        node_labels = [max((node_labels[node] for node in group), key=lambda entity: (degree[entity], -entity))
+                       for group in groups]
+        parents.append(parent)
+        sizes.append(node_sizes)
+        labels.append(node_labels)
+
+        next_weights = Counter()
+        for (a, b), weight in weights.items():
+            if parent[a] != parent[b]:
+                next_weights[min(parent[a], parent[b]), max(parent[a], parent[b])] += weight
+        weights = next_weights
+
+    return {
+        "version": CLUSTERS_VERSION,
+        "parents": parents,
+        "sizes": sizes,
+        "labels": labels,
+    }
+
+class ClusterHierarchy():
+    """Read-only view over a stored cluster hierarchy."""
+
+    def __init__(self, data, index):
+        self.index = index
+        self.parents = data['parents']
+        self.sizes = data['sizes']
+        self.labels = data['labels']
+        self.top_level = len(self.parents)
+
+    def level_size(self, level):
+        return len(self.index.entities) if level == 0 else len(self.sizes[level - 1])
+
+    def entity_nodes(self, level):
+        """The node at `level` of every entity."""
+        nodes = list(range(len(self.index.entities)))
+        for parent in self.parents[:level]:
+            nodes = [parent[node] for node in nodes]
+        return nodes
+
+    def children(self, level, cluster):
+        """Nodes at `level - 1` that belong to `cluster` at `level`."""
+        return [node for node, parent in enumerate(self.parents[level - 1]) if parent == cluster]
+
+def cluster_id(level, cluster):
+    """Client-facing id of a cluster, as accepted by the API's `cluster=` parameter."""
+    return f"{level}:{cluster}"
+
+def render_level(hierarchy, level, nodes, layout=None):
+    """Build the nodes and links among `nodes` at `level`.
+
+    Entities (level 0) are linked by their relations; clusters by the number of
+    relations between their entities. With a `layout`, each node is placed at
+    the mean position of its entities.
+    """
+    index = hierarchy.index
+    if level == 0:
+        node_id = lambda node: index.entities[node]
+    else:
+        node_id = lambda node: cluster_id(level, node)
+    entity_nodes = hierarchy.entity_nodes(level)
+    selected = set(nodes)
+
+    position = {}
+    if layout is not None:
+        totals = {node: [0.0, 0.0, 0] for node in selected}
+        for entity, node in enumerate(entity_nodes):
+            if node in totals:
+                totals[node][0] += layout['x'][entity]
+                totals[node][1] += layout['y'][entity]
+                totals[node][2] += 1
+        position = {node: (round(x / count, 1), round(y / count, 1)) for node, (x, y, count) in totals.items()}
+
+    rendered_nodes = []
+    for node in nodes:
+        if level == 0:
+            rendered = {"id": node_id(node), "label": index.entities[node], "level": 0, "size": 1}
+        else:
+            rendered = {
+                "id": node_id(node),
+                "label": index.entities[hierarchy.labels[level - 1][node]],
+                "level": level,
+                "size": hierarchy.sizes[level - 1][node],
+            }
+        if node in position:
+            rendered["x"], rendered["y"] = position[node]
+        rendered_nodes.append(rendered)
+
+    links = []
+    weights = Counter()
+    for head, type_id, tail in index.relations:
+        source, target = entity_nodes[head], entity_nodes[tail]
+        if source not in selected or target not in selected:
+            continue
+        if level == 0:
+            links.append({"source": node_id(source), "target": node_id(target), "type": index.types[type_id]})
+        elif source != target:
+            weights[source, target] += 1
+    for (source, target), weight in weights.items():
+        links.append({"source": node_id(source), "target": node_id(target), "weight": weight})
+
+    return {"nodes": rendered_nodes, "links": links}
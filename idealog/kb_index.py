@@ -0,0 +1,180 @@
+"""Compact topology index of a knowledge base.
+
+The stored KB payload carries every entity's Wikipedia summary and every
+relation's source spans, while the graph views only need entity names and
+head/type/tail triples. When a KB is built its topology is also stored as a
+small index of integer arrays:
+
+    entities            entity names, in payload order
+    types               relation type names
+    relations           [head, type, tail] triples (entity/type positions), in payload order
+    incidence_offsets   CSR offsets into `incidence`, one slot per entity plus one
+    incidence           relation positions touching each entity
+
+so projections, neighbourhoods and relation pages are sliced from the index,
+and the full payload is read only when a client asks for summaries, meta or
+sources. The `layout` field adds each entity's precomputed x/y position (see
+graph_layout.py), which is stored aligned with `entities`.
+"""
+INDEX_VERSION = 1
+
+# Optional fields a client can ask for with `fields=`; names and triples are always returned.
+ENTITY_FIELDS = ['url', 'summary']
+RELATION_FIELDS = ['meta']
+KB_FIELDS = ['sources']
+LAYOUT_FIELDS = ['layout']
+ALL_FIELDS = ENTITY_FIELDS + RELATION_FIELDS + KB_FIELDS + LAYOUT_FIELDS
+
+def build_graph_index(kb_data):
+    """Build the index for a KB dict as produced by `KB.to_json()`."""
+    entities = list(kb_data.get('entities', {}))
+    entity_ids = {name: i for i, name in enumerate(entities)}
+    types = []
+    type_ids = {}
+    relations = []
+    incident = [[] for _ in entities]
+
+    for i, relation in enumerate(kb_data.get('relations', [])):
+        # Relations always reference known entities in KBs built by KB.add_relation,
+        # but index defensively in case a payload was edited by hand.
+        for name in (relation['head'], relation['tail']):
+            if name not in entity_ids:
+                entity_ids[name] = len(entities)
+                entities.append(name)
+                incident.append([])
+        if relation['type'] not in type_ids:
+            type_ids[relation['type']] = len(types)
+            types.append(relation['type'])
+
+        head, tail = entity_ids[relation['head']], entity_ids[relation['tail']]
+        relations.append([head, type_ids[relation['type']], tail])
+        incident[head].append(i)
+        if tail != head:
+            incident[tail].append(i)
+
+    offsets = [0]
+    incidence = []
+    for relation_ids in incident:
+        incidence.extend(relation_ids)
+        offsets.append(len(incidence))
+
+    return {
+        "version": INDEX_VERSION,
+        "entities": entities,
+        "types": types,
+        "relations": relations,
+        "incidence_offsets": offsets,
+        "incidence": incidence,
+    }
+
+class GraphIndex():
+    """Read-only view over a stored graph index."""
+
+    def __init__(self, data):
+        self.entities = data['entities']
+        self.types = data['types']
+        self.relations = data['relations']
+        self.offsets = data['incidence_offsets']
+        self.incidence = data['incidence']
+        self._entity_ids = None
+
+    def entity_id(self, name):
+        if self._entity_ids is None:
+            self._entity_ids = {entity: i for i, entity in enumerate(self.entities)}
+        return self._entity_ids.get(name)
+
+    def incident_relations(self, entity_id):
+        return self.incidence[self.offsets[entity_id]:self.offsets[entity_id + 1]]
+
+    def neighborhood(self, entity_id, depth):
+        """Entities within `depth` hops of `entity_id` (ignoring direction) and the relations among them."""
+        seen = {entity_id}
+        frontier = [entity_id]
+        for _ in range(depth):
+            next_frontier = []
+            for current in frontier:
+                for relation_id in self.incident_relations(current):
+                    head, _, tail = self.relations[relation_id]
+                    for neighbor in (head, tail):
+                        if neighbor not in seen:
+                            seen.add(neighbor)
+                            next_frontier.append(neighbor)
+            frontier = next_frontier
+            if not frontier:
+                break
+
+        relation_ids = set()
+        for current in seen:
+            for relation_id in self.incident_relations(current):
+                head, _, tail = self.relations[relation_id]
+                if head in seen and tail in seen:
+                    relation_ids.add(relation_id)
+        return seen, sorted(relation_ids)
+
+def slice_graph(index, entity=None, depth=1, offset=0, limit=None, within=None):
+    """Select entities and relations from `index`.
+
+    With `entity`, restricts the graph to its `depth`-hop neighbourhood. With
+    `within` (a set of entity ids closed under relations, such as a connected
+    component), restricts it to those entities. With `limit`, returns one page
+    of relations and only the entities they touch. Returns (entity ids,
+    relation ids, total relations before paging), or None if `entity` is not
+    in the KB or not `within`.
+    """
+    if entity is not None:
+        entity_id = index.entity_id(entity)
+        if entity_id is None or (within is not None and entity_id not in within):
+            return None
+        entity_ids, relation_ids = index.neighborhood(entity_id, depth)
+    elif within is not None:
+        entity_id = None
+        entity_ids = within
+        relation_ids = sorted({relation_id for current in within for relation_id in index.incident_relations(current)})
+    else:
+        entity_id = None
+        entity_ids, relation_ids = None, range(len(index.relations))
+
+    total = len(relation_ids)
+    if limit is None and offset == 0:
+        if entity_ids is None:
+            entity_ids = range(len(index.entities))
+        return sorted(entity_ids), list(relation_ids), total
+
+    relation_ids = list(relation_ids[offset:offset + limit if limit is not None else None])
+    page_entities = set() if entity_id is None else {entity_id}
+    for relation_id in relation_ids:
+        head, _, tail = index.relations[relation_id]
+        page_entities.update((head, tail))
+    return sorted(page_entities), relation_ids, total
+
+def render_slice(index, entity_ids, relation_ids, fields, kb_data=None, layout=None):
+    """Build a KB-shaped dict for a slice, with the optional `fields` taken from `kb_data` and `layout`."""
+    entity_fields = [field for field in ENTITY_FIELDS if field in fields]
+    entities = {}
+    for entity_id in entity_ids:
+        name = index.entities[entity_id]
+        if entity_fields:
+            details = kb_data['entities'].get(name, {})
+            entities[name] = {field: details.get(field) for field in entity_fields}
+        else:
+            entities[name] = {}
+        if 'layout' in fields:
+            entities[name]["x"] = layout['x'][entity_id]
+            entities[name]["y"] = layout['y'][entity_id]
+
+    relations = []
+    for relation_id in relation_ids:
+        head, type_id, tail = index.relations[relation_id]
+        relation = {
+            "head": index.entities[head],
+            "type": index.types[type_id],
+            "tail": index.entities[tail],
+        }
+        if 'meta' in fields:
+            relation["meta"] = kb_data['relations'][relation_id].get('meta', {})
+        relations.append(relation)
+
+    result = {"entities": entities, "relations": relations}
+    if 'sources' in fields:
+        result["sources"] = kb_data.get('sources', {})
+    return result
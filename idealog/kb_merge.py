@@ -0,0 +1,71 @@
+"""Merging stored knowledge base payloads.
+
+KBs are merged from their stored JSON rather than rebuilt from their ideas,
+so no text goes through the relation extraction model and no entity is looked
+up on Wikipedia again: entities in stored payloads are already resolved to
+Wikipedia titles. Payloads are consumed one at a time, and entities,
+relations and spans are deduplicated through hash lookups, so a merge is
+linear in the total size of the inputs.
+"""
+import json
+
+from idealog.kb_payload import payload_data
+
+class KBMerger():
+    """Accumulates KB payloads into one, in the format produced by `KB.to_json()`."""
+
+    def __init__(self):
+        self.entities = {}
+        self.relations = []
+        self.sources = {}
+        # (head, type, tail) -> position in self.relations
+        self._relation_ids = {}
+        # (relation position, article url) -> set of spans already recorded
+        self._spans = {}
+
+    def add(self, kb_data):
+        for name, details in kb_data.get('entities', {}).items():
+            if name in self.entities:
+                # Keep what we have, but fill in anything the first KB was missing.
+                for key, value in details.items():
+                    self.entities[name].setdefault(key, value)
+            else:
+                self.entities[name] = dict(details)
+
+        for relation in kb_data.get('relations', []):
+            key = (relation['head'], relation['type'], relation['tail'])
+            relation_id = self._relation_ids.get(key)
+            if relation_id is None:
+                relation_id = self._relation_ids[key] = len(self.relations)
+                self.relations.append({"head": key[0], "type": key[1], "tail": key[2], "meta": {}})
+
+            meta = self.relations[relation_id]["meta"]
+            for article_url, article_meta in relation.get('meta', {}).items():
+                seen = self._spans.get((relation_id, article_url))
+                if seen is None:
+                    seen = self._spans[relation_id, article_url] = set()
+                    meta[article_url] = {**article_meta, "spans": []}
+                for span in article_meta.get('spans', []):
+                    if tuple(span) not in seen:
+                        seen.add(tuple(span))
+                        meta[article_url]["spans"].append(span)
+
+        for article_url, source in kb_data.get('sources', {}).items():
+            self.sources.setdefault(article_url, source)
+
+    def to_json(self):
+        kb_data = {
+            "entities": self.entities,
+            "relations": self.relations,
+            "sources": self.sources
+        }
+        # Unlike KB.to_json(), no indent: json only uses its C encoder for
+        # compact output, which is ~6x faster on large KBs.
+        return json.dumps(kb_data)
+
+def merge_knowledge_base_payloads(json_objects):
+    """Merge an iterable of stored `json_object`s and return the merged payload as a JSON string."""
+    merger = KBMerger()
+    for json_object in json_objects:
+        merger.add(payload_data(json_object))
+    return merger.to_json()
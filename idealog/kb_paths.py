@@ -0,0 +1,263 @@
+"""Path queries over a knowledge base graph.
+
+Answering "how is A connected to B" needs the KB's adjacency, which is built
+from the graph index as a CSR (compressed sparse row) structure of int32
+arrays, relations taken in both directions:
+
+    offsets         neighbours of entity i are at offsets[i]:offsets[i + 1]
+    neighbors       the entity at the other end of each adjacency entry
+    edge_relations  the relation (position in the payload) of each adjacency entry
+    relations       [head, type, tail] of every relation
+
+The arrays are written once per KB version as .npy files under
+KB_GRAPH_CACHE_DIR/<kb id>-<etag> and memory-mapped on later requests, so
+every worker on a host shares them through the page cache instead of parsing
+the graph index. The entries of a KB are removed once it is deleted or its
+payload replaced (see fragment_cache.py).
+Entity names are stored as one UTF-8 blob with offsets plus a sorted order,
+and looked up by binary search.
+
+Shortest paths are found with a bidirectional BFS that expands a whole
+frontier per step with NumPy, and the k shortest simple paths with Yen's
+algorithm on top of it.
+"""
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from flask import current_app
+
+MAX_PATHS = 5
+ARRAYS = ['offsets', 'neighbors', 'edge_relations', 'relations', 'name_offsets', 'name_order']
+
+class Adjacency():
+    """CSR adjacency of a KB graph, with entity name lookup."""
+
+    def __init__(self, arrays, names, types):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.names = names
+        self.types = types
+
+    @classmethod
+    def from_graph_index(cls, graph_index):
+        num_nodes = len(graph_index['entities'])
+        relations = np.array(graph_index['relations'], dtype=np.int32).reshape(-1, 3)
+        relation_ids = np.arange(len(relations), dtype=np.int32)
+        loops = relations[:, 0] == relations[:, 2]
+        heads, tails, relation_ids = relations[~loops, 0], relations[~loops, 2], relation_ids[~loops]
+
+        sources = np.concatenate([heads, tails])
+        order = np.argsort(sources, kind='stable')
+        offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_nodes), out=offsets[1:])
+
+        encoded = [name.encode('utf-8') for name in graph_index['entities']]
+        name_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+        name_order = np.array(sorted(range(num_nodes), key=encoded.__getitem__), dtype=np.int32)
+
+        arrays = {
+            "offsets": offsets,
+            "neighbors": np.concatenate([tails, heads])[order],
+            "edge_relations": np.concatenate([relation_ids, relation_ids])[order],
+            "relations": relations,
+            "name_offsets": name_offsets,
+            "name_order": name_order,
+        }
+        return cls(arrays, np.frombuffer(b"".join(encoded), dtype=np.uint8), list(graph_index['types']))
+
+    @property
+    def num_nodes(self):
+        return len(self.offsets) - 1
+
+    def name(self, entity_id):
+        return bytes(self.names[self.name_offsets[entity_id]:self.name_offsets[entity_id + 1]]).decode('utf-8')
+
+    def entity_id(self, name):
+        """Binary search over the sorted entity names. Returns None if `name` is not in the KB."""
+        key = name.encode('utf-8')
+        low, high = 0, self.num_nodes
+        while low < high:
+            middle = (low + high) // 2
+            entity_id = int(self.name_order[middle])
+            if bytes(self.names[self.name_offsets[entity_id]:self.name_offsets[entity_id + 1]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.num_nodes and self.name(int(self.name_order[low])) == name:
+            return int(self.name_order[low])
+        return None
+
+    def save(self, path):
+        os.makedirs(path)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(path, "names.npy"), self.names)
+        with open(os.path.join(path, "types.json"), 'w') as f:
+            json.dump(self.types, f)
+
+    @classmethod
+    def load(cls, path):
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in ARRAYS}
+        names = np.load(os.path.join(path, "names.npy"), mmap_mode='r')
+        with open(os.path.join(path, "types.json")) as f:
+            types = json.load(f)
+        return cls(arrays, names, types)
+
+    def _expand(self, frontier):
+        """All adjacency entries of `frontier`, as (from entity, to entity, relation) arrays."""
+        starts = self.offsets[frontier]
+        counts = self.offsets[frontier + 1] - starts
+        total = int(counts.sum())
+        positions = np.arange(total) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return np.repeat(frontier, counts), self.neighbors[positions], self.edge_relations[positions]
+
+    def shortest_path(self, source, target, blocked_nodes=(), blocked_relations=()):
+        """Bidirectional BFS ignoring relation direction. Returns (entity ids, relation ids) or None."""
+        if source == target:
+            return [source], []
+        depth = [np.full(self.num_nodes, -1, dtype=np.int32) for _ in range(2)]
+        parent = [np.full(self.num_nodes, -1, dtype=np.int32) for _ in range(2)]
+        via = [np.full(self.num_nodes, -1, dtype=np.int32) for _ in range(2)]
+        blocked = np.zeros(self.num_nodes, dtype=bool)
+        blocked[list(blocked_nodes)] = True
+        blocked_relations = np.array(sorted(blocked_relations), dtype=np.int32)
+
+        frontiers = [np.array([source]), np.array([target])]
+        depth[0][source] = depth[1][target] = 0
+        while len(frontiers[0]) and len(frontiers[1]):
+            # Grow the side with fewer adjacency entries to expand.
+            sizes = [int((self.offsets[f + 1] - self.offsets[f]).sum()) for f in frontiers]
+            side = 0 if sizes[0] <= sizes[1] else 1
+            other = 1 - side
+
+            from_nodes, to_nodes, relations = self._expand(frontiers[side])
+            keep = (depth[side][to_nodes] < 0) & ~blocked[to_nodes]
+            if len(blocked_relations):
+                keep &= ~np.isin(relations, blocked_relations)
+            to_nodes, first = np.unique(to_nodes[keep], return_index=True)
+            from_nodes, relations = from_nodes[keep][first], relations[keep][first]
+
+            level = depth[side][from_nodes[0]] + 1 if len(from_nodes) else 0
+            depth[side][to_nodes] = level
+            parent[side][to_nodes] = from_nodes
+            via[side][to_nodes] = relations
+
+            met = to_nodes[depth[other][to_nodes] >= 0]
+            if len(met):
+                meeting = int(met[np.argmin(depth[other][met])])
+                return self._join(meeting, parent, via)
+            frontiers[side] = to_nodes
+        return None
+
+    def _join(self, meeting, parent, via):
+        forward, forward_relations = [meeting], []
+        while parent[0][forward[-1]] >= 0:
+            forward_relations.append(int(via[0][forward[-1]]))
+            forward.append(int(parent[0][forward[-1]]))
+        backward, backward_relations = [], []
+        current = meeting
+        while parent[1][current] >= 0:
+            backward_relations.append(int(via[1][current]))
+            current = int(parent[1][current])
+            backward.append(current)
+        return forward[::-1] + backward, forward_relations[::-1] + backward_relations
+
+    def k_shortest_paths(self, source, target, k):
+        """Up to `k` shortest simple paths (Yen's algorithm), shortest first."""
+        first = self.shortest_path(source, target)
+        if first is None:
+            return []
+        paths = [first]
+        candidates = []
+        seen = {tuple(first[1])}
+        while len(paths) < k:
+            nodes, relations = paths[-1]
+            for i in range(len(nodes) - 1):
+                root_nodes, root_relations = nodes[:i + 1], relations[:i]
+                blocked_relations = {path_relations[i] for path_nodes, path_relations in paths
+                                     if path_nodes[:i + 1] == root_nodes and len(path_relations) > i}
+                spur = self.shortest_path(nodes[i], target, root_nodes[:-1], blocked_relations)
+                if spur is None:
+                    continue
+                candidate = (root_nodes[:-1] + spur[0], root_relations + spur[1])
+                if tuple(candidate[1]) not in seen:
+                    seen.add(tuple(candidate[1]))
+                    heapq.heappush(candidates, (len(candidate[1]), candidate[1], candidate[0]))
+            if not candidates:
+                break
+            _, relations, nodes = heapq.heappop(candidates)
+            paths.append((nodes, relations))
+        return paths
+
+def _cache_dir():
+    return current_app.config['KB_GRAPH_CACHE_DIR']
+
+def load_adjacency(knowledge_base, build):
+    """Return the KB's adjacency from the disk cache, building it from `build()` (a graph index) on a miss."""
+    cache_dir = _cache_dir()
+    path = os.path.join(cache_dir, f"{knowledge_base.id}-{knowledge_base.json_etag}")
+    if os.path.isdir(path):
+        return Adjacency.load(path)
+
+    adjacency = Adjacency.from_graph_index(build())
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a scratch directory and rename it into place, so concurrent
+    # requests never read a half written cache entry.
+    scratch = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        adjacency.save(os.path.join(scratch, "graph"))
+        os.rename(os.path.join(scratch, "graph"), path)
+    except OSError:
+        pass  # Another worker got there first.
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    # Drop the entries of older versions of this KB.
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(f"{knowledge_base.id}-") and entry != os.path.basename(path):
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+    return adjacency
+
+def remove_cached_adjacency(knowledge_base_ids):
+    """Remove the disk cache entries of every version of the given KBs."""
+    cache_dir = _cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    prefixes = tuple(f"{knowledge_base_id}-" for knowledge_base_id in knowledge_base_ids)
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(prefixes):
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+def path_relation_ids(paths):
+    """The ids of every relation on `paths`."""
+    return sorted({int(relation_id) for _, relation_ids in paths for relation_id in relation_ids})
+
+def render_paths(adjacency, paths, provenance=None):
+    """Paths as lists of entity names and relations.
+
+    With `provenance`, ({relation id: meta}, {url: source}) as returned by
+    kb_tables.relation_provenance(), each relation gets its source spans.
+    """
+    rendered = []
+    used_sources = set()
+    for nodes, relation_ids in paths:
+        relations = []
+        for relation_id in relation_ids:
+            head, type_id, tail = (int(value) for value in adjacency.relations[relation_id])
+            relation = {"head": adjacency.name(head), "type": adjacency.types[type_id], "tail": adjacency.name(tail)}
+            if provenance is not None:
+                relation["meta"] = provenance[0].get(int(relation_id), {})
+                used_sources.update(relation["meta"])
+            relations.append(relation)
+        rendered.append({"length": len(relation_ids), "entities": [adjacency.name(node) for node in nodes], "relations": relations})
+
+    result = {"paths": rendered}
+    if provenance is not None:
+        sources = provenance[1]
+        result["sources"] = {url: sources[url] for url in sorted(used_sources) if url in sources}
+    return result
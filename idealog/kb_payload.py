@@ -0,0 +1,84 @@
+"""Stored representations of knowledge base JSON payloads.
+
+A ready knowledge base does not change, so its JSON text is hashed and
+compressed once when it is built and the API serves those bytes directly,
+answering `If-None-Match` revalidations with `304 Not Modified`.
+"""
+import gzip
+import hashlib
+import json
+
+import brotli
+from flask import Response, request
+
+# Content codings the API can serve, most preferred first.
+ENCODINGS = ['br', 'gzip']
+
+def payload_text(json_object):
+    """Return the JSON text of a stored `json_object` (a JSON string or a plain dict)."""
+    if json_object is None:
+        return None
+    if isinstance(json_object, str):
+        return json_object
+    return json.dumps(json_object)
+
+def payload_data(json_object):
+    """Return a stored `json_object` as a dict."""
+    if isinstance(json_object, str):
+        return json.loads(json_object)
+    return json_object
+
+def compute_etag(text):
+    """Strong validator for the identity representation of `text`."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def compress_payload(text):
+    """Return (gzip bytes, brotli bytes) for `text`."""
+    data = text.encode('utf-8')
+    # Brotli's default quality (11) is ~20x slower than 9 on KB JSON for a
+    # couple of percent smaller output, which large KBs can't afford inside
+    # create_kb's time limit.
+    return gzip.compress(data, compresslevel=9), brotli.compress(data, mode=brotli.MODE_TEXT, quality=9)
+
+def encoded_etag(etag, encoding):
+    """Each content coding is a distinct representation, so it gets its own strong ETag."""
+    return etag if encoding is None else f"{etag}-{encoding}"
+
+def choose_encoding(available):
+    """Pick the best coding from `available` that the client accepts, or None for identity."""
+    for encoding in ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def not_modified(etag):
+    """True if the request's `If-None-Match` matches any representation of `etag`."""
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return False
+    return any(if_none_match.contains(encoded_etag(etag, encoding)) for encoding in [None] + ENCODINGS)
+
+def json_payload_response(load_text, etag, load_compressed, cache_control):
+    """Build a response for a stored JSON payload.
+
+    `load_text` and the values of `load_compressed` (keyed by content coding)
+    are callables, so only the representation actually sent is read from the
+    database, and nothing is read for a 304.
+    """
+    encoding = choose_encoding(load_compressed)
+
+    if not_modified(etag):
+        response = Response(status=304)
+    else:
+        body = load_compressed[encoding]() if encoding else None
+        if body is None:
+            encoding = None
+            response = Response(payload_text(load_text()), mimetype='application/json')
+        else:
+            response = Response(body, mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(encoded_etag(etag, encoding))
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,137 @@
+"""Building a KB from a search query or a list of urls as a pipeline.
+
+Each stage runs in its own thread and hands its output to the next through
+a bounded queue:
+
+    links ──> fetching ──> span extraction ──> entity linking
+              (article_fetcher)   (the model)     (caller's thread)
+
+- Link discovery (see news_search.py) searches one page of results at a time.
+- Fetching downloads and parses articles concurrently (see article_fetcher.py).
+- Extraction runs the relation extraction model on one article at a time.
+- Entity linking looks the heads and tails of the relations up in a thread
+  pool, once per name for the whole KB, and adds the relations to the KB.
+
+So the model works on one article while the next ones are downloaded and
+the entities of the previous one are looked up. When a stage falls behind,
+the queue in front of it fills up and the stages before it wait, which
+keeps memory bounded however many links a query returns. An error in any
+stage stops the others and is raised to the caller.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+
+from idealog.article_fetcher import fetch_articles
+from idealog.kb_trace import count
+
+URL_QUEUE_SIZE = 100
+ARTICLE_QUEUE_SIZE = 8
+RELATION_QUEUE_SIZE = 8
+LINK_WORKERS = 8
+# Seconds between checks for a stopped pipeline while waiting on a queue.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+class Pipeline():
+    """Generator stages running in threads, connected by bounded queues."""
+
+    def __init__(self):
+        self.app = current_app._get_current_object() if has_app_context() else None
+        self.stopped = threading.Event()
+        self.errors = []
+        self.threads = []
+
+    def _items(self, inbox):
+        while True:
+            try:
+                item = inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _put(self, outbox, item):
+        while not self.stopped.is_set():
+            try:
+                outbox.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, func, items, outbox):
+        try:
+            if self.app is not None:
+                with self.app.app_context():
+                    self._feed(func(items), outbox)
+            else:
+                self._feed(func(items), outbox)
+        except Exception as e:
+            self.errors.append(e)
+            self.stopped.set()
+        finally:
+            self._put(outbox, _DONE)
+
+    def _feed(self, results, outbox):
+        for result in results:
+            if not self._put(outbox, result):
+                return
+
+    def stage(self, func, inbox, maxsize):
+        """Start a thread putting the items of `func(items of inbox)` on a new queue of `maxsize`, and return the queue.
+
+        The first stage gets None instead of items.
+        """
+        outbox = queue.Queue(maxsize)
+        items = self._items(inbox) if inbox is not None else None
+        thread = threading.Thread(target=self._run, args=(func, items, outbox), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return outbox
+
+    def results(self, inbox):
+        """Yield the items of the last stage's queue, then raise the first error of any stage."""
+        try:
+            yield from self._items(inbox)
+        finally:
+            self.stopped.set()
+            for thread in self.threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+def build_kb(kb, links, extract, lookup, link_workers=LINK_WORKERS, fetch_options=None):
+    """Add the relations found in the articles at `links` to `kb` and return it.
+
+    `links` is an iterable of urls, read in its own thread. `extract(article)`
+    returns the relations of an article (see class_kb.extract_article_relations),
+    `lookup(name)` the entity data of a name or None, and `kb` is a class_kb.KB.
+    """
+    pipeline = Pipeline()
+    urls = pipeline.stage(lambda _: links, None, URL_QUEUE_SIZE)
+    articles = pipeline.stage(lambda urls: (result.article for result in fetch_articles(urls, **(fetch_options or {}))
+                                            if result.article is not None and result.article["text"].strip()),
+                              urls, ARTICLE_QUEUE_SIZE)
+    relations = pipeline.stage(lambda articles: ((article, extract(article)) for article in articles),
+                               articles, RELATION_QUEUE_SIZE)
+
+    with ThreadPoolExecutor(link_workers) as lookups:
+        entities = {}
+        for article, article_relations in pipeline.results(relations):
+            for relation in article_relations:
+                for name in (relation["head"], relation["tail"]):
+                    if name not in entities:
+                        entities[name] = lookups.submit(lookup, name)
+                    else:
+                        count('entity_cache_hits')
+            for relation in article_relations:
+                linked = [entities[relation["head"]].result(), entities[relation["tail"]].result()]
+                kb.add_linked_relation(relation, linked, article["name"], article["publish_date"])
+    return kb
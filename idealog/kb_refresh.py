@@ -0,0 +1,167 @@
+"""Change capture for the global knowledge base.
+
+The global knowledge base covers every idea and knowledge source. Rather than
+being rebuilt from scratch, it is patched as documents change:
+
+1. Inserting, deleting, or editing the text/url/name/date of an `Idea` or
+   `KnowledgeSource` records "<type>:<id>" in the Redis set REFRESH_PENDING_KEY
+   once the transaction commits.
+2. The first change in a quiet period schedules `tasks.refresh_global_kb`
+   KB_REFRESH_DEBOUNCE seconds later, so changes made in the meantime are
+   handled by the same run.
+3. The task takes up to KB_REFRESH_BATCH_SIZE pending documents, extracts only
+   those, stores each result as a `DocumentExtract`, and adds their urls to
+   REFRESH_URLS_KEY. While documents are left it schedules another run.
+4. The run that finds none left patches the global payload with
+   `patch_payload` for all the urls changed since the last patch, so the
+   payload is parsed, stored and compressed once however many batches the
+   changes took.
+
+Relations in a payload are attributed to their documents through the article
+url in their `meta`. A patch therefore removes everything attributed to the
+urls of the changed documents, then merges back the stored extracts of every
+document that currently has one of those urls. Documents that share a url with
+a changed one stay correct, and none of them goes through the model again.
+"""
+from flask import current_app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from idealog.models import db, Idea, KnowledgeSource, KnowledgeBase
+from idealog.kb_merge import KBMerger
+from idealog.kb_payload import payload_data
+
+REFRESH_PENDING_KEY = "idealog:kb_refresh:pending"
+REFRESH_SCHEDULED_KEY = "idealog:kb_refresh:scheduled"
+REFRESH_URLS_KEY = "idealog:kb_refresh:urls"
+REFRESH_TASK = "idealog.tasks.refresh_global_kb"
+
+GLOBAL_KB_NAME = "All ideas and knowledge sources"
+GLOBAL_CREATION_MODE = "global"
+
+DOCUMENT_MODELS = {'idea': Idea, 'knowledge_source': KnowledgeSource}
+# Columns that feed extraction; changes to anything else (privacy, owner) don't touch the KB.
+EXTRACTED_COLUMNS = ['text', 'url', 'name', 'publish_date']
+
+def document_key(document_type, document_id):
+    return f"{document_type}:{document_id}"
+
+def parse_document_key(key):
+    document_type, document_id = key.split(':')
+    return document_type, int(document_id)
+
+def _redis():
+    if not current_app.config.get('KB_REFRESH_DEBOUNCE'):
+        return None
+    return current_app.extensions.get('redis')
+
+def schedule_refresh(countdown=None):
+    """Schedule a refresh run unless one is already waiting. Returns False if Redis is unavailable."""
+    r = _redis()
+    if r is None:
+        return False
+    debounce = current_app.config['KB_REFRESH_DEBOUNCE']
+    try:
+        # Only the first change of a quiet period schedules a run. The flag
+        # outlives the countdown so a slow broker can't cause a second run.
+        if r.set(REFRESH_SCHEDULED_KEY, 1, nx=True, ex=debounce * 10):
+            current_app.extensions['celery'].send_task(REFRESH_TASK, countdown=debounce if countdown is None else countdown)
+    except RedisError:
+        return False
+    return True
+
+def enqueue_documents(keys, countdown=None):
+    """Mark documents as changed and make sure a refresh run is scheduled. Returns False if Redis is unavailable."""
+    r = _redis()
+    if r is None or not keys:
+        return False
+    try:
+        r.sadd(REFRESH_PENDING_KEY, *keys)
+    except RedisError:
+        return False
+    return schedule_refresh(countdown)
+
+def take_pending_documents(batch_size):
+    """Pop up to `batch_size` pending document keys. Returns (keys, whether more are left)."""
+    r = current_app.extensions['redis']
+    # Clear the flag first: anything enqueued from now on schedules a new run.
+    r.delete(REFRESH_SCHEDULED_KEY)
+    keys = [key.decode('utf-8') for key in r.spop(REFRESH_PENDING_KEY, batch_size) or []]
+    return keys, r.scard(REFRESH_PENDING_KEY) > 0
+
+def add_changed_urls(urls):
+    """Record the urls of extracted documents for the next patch of the global payload."""
+    if urls:
+        current_app.extensions['redis'].sadd(REFRESH_URLS_KEY, *urls)
+
+def take_changed_urls():
+    """Pop every url recorded since the last patch."""
+    r = current_app.extensions['redis']
+    return {url.decode('utf-8') for url in r.spop(REFRESH_URLS_KEY, r.scard(REFRESH_URLS_KEY)) or []}
+
+def global_knowledge_base():
+    """Return the global knowledge base, creating it (pending) if it doesn't exist yet."""
+    knowledge_base = KnowledgeBase.query.filter_by(creation_mode=GLOBAL_CREATION_MODE).first()
+    if knowledge_base is None:
+        knowledge_base = KnowledgeBase(name=GLOBAL_KB_NAME, creation_mode=GLOBAL_CREATION_MODE, status='pending')
+        db.session.add(knowledge_base)
+    return knowledge_base
+
+def patch_payload(json_object, urls, extracts):
+    """Replace everything attributed to `urls` in a stored payload with the given extracts.
+
+    `extracts` are the stored payloads of all documents whose url is in `urls`.
+    Returns the patched payload as a JSON string.
+    """
+    kb_data = payload_data(json_object) if json_object is not None else {}
+    relations = []
+    for relation in kb_data.get('relations', []):
+        meta = {url: value for url, value in relation.get('meta', {}).items() if url not in urls}
+        if meta:
+            relations.append({**relation, "meta": meta})
+
+    # Entities only enter a KB through relations, so drop the ones no relation uses anymore.
+    referenced = {name for relation in relations for name in (relation['head'], relation['tail'])}
+    merger = KBMerger()
+    merger.add({
+        "entities": {name: details for name, details in kb_data.get('entities', {}).items() if name in referenced},
+        "relations": relations,
+        "sources": {url: source for url, source in kb_data.get('sources', {}).items() if url not in urls},
+    })
+    for extract in extracts:
+        merger.add(payload_data(extract))
+    return merger.to_json()
+
+##############################################################################
+# Change capture
+@event.listens_for(Idea, 'after_insert')
+@event.listens_for(KnowledgeSource, 'after_insert')
+@event.listens_for(Idea, 'after_delete')
+@event.listens_for(KnowledgeSource, 'after_delete')
+def _capture_document(mapper, connection, target):
+    _record_change(target)
+
+@event.listens_for(Idea, 'after_update')
+@event.listens_for(KnowledgeSource, 'after_update')
+def _capture_document_update(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[column].history.has_changes() for column in EXTRACTED_COLUMNS):
+        _record_change(target)
+
+def _record_change(target):
+    session = Session.object_session(target)
+    if session is None:
+        return
+    document_type = 'idea' if isinstance(target, Idea) else 'knowledge_source'
+    session.info.setdefault('kb_refresh_changes', set()).add(document_key(document_type, target.id))
+
+@event.listens_for(Session, 'after_commit')
+def _enqueue_changes(session):
+    changes = session.info.pop('kb_refresh_changes', None)
+    if changes and has_app_context():
+        enqueue_documents(sorted(changes))
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('kb_refresh_changes', None)
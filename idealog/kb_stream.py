@@ -0,0 +1,85 @@
+"""Streaming the stored payloads of large knowledge bases.
+
+A driver returns a column as one value, so serving the JSON of a large KB
+whole costs several copies of it in worker memory. Payloads whose stored
+gzip representation is at least KB_STREAM_THRESHOLD bytes are instead read
+KB_STREAM_CHUNK_SIZE bytes at a time with substr() while the response is
+written, so a request holds about one chunk whatever the size of the KB:
+
+- br and gzip clients get the precompressed column as stored, with its
+  Content-Length,
+- other clients get the gzip column decompressed on the fly (a JSON column
+  can't be read in slices), in chunked encoding.
+
+Each chunk is a short query of its own, so a slow client doesn't hold a
+database connection, and it checks json_etag, so a payload replaced during
+a download ends the response early instead of mixing two versions. The
+precompressed columns are stored without Postgres' own compression (STORAGE
+EXTERNAL, see migrations.py), so substr() only reads the TOAST chunks of
+its slice.
+"""
+import zlib
+
+from flask import Response, current_app
+from sqlalchemy import func, select
+
+from idealog.models import db, KnowledgeBase
+from idealog.kb_payload import choose_encoding, encoded_etag
+
+# Content coding: column holding the payload in it.
+STREAM_COLUMNS = {'br': KnowledgeBase.json_br, 'gzip': KnowledgeBase.json_gzip}
+
+class PayloadChanged(Exception):
+    """The payload being streamed was replaced or deleted."""
+
+def payload_sizes(knowledge_base_id):
+    """Stored sizes of a KB's precompressed payloads by content coding, None where missing."""
+    row = db.session.execute(select(*[func.length(column) for column in STREAM_COLUMNS.values()])
+                             .where(KnowledgeBase.id == knowledge_base_id)).first()
+    return dict(zip(STREAM_COLUMNS, row)) if row is not None else {}
+
+def should_stream(sizes):
+    threshold = current_app.config['KB_STREAM_THRESHOLD']
+    return threshold is not None and (sizes.get('gzip') or 0) >= threshold
+
+def read_chunks(engine, knowledge_base_id, etag, column, size, chunk_size):
+    """Yield the `size` bytes of `column` of a KB, `chunk_size` bytes at a time."""
+    for start in range(0, size, chunk_size):
+        with engine.connect() as connection:
+            chunk = connection.execute(select(func.substr(column, start + 1, chunk_size))
+                                       .where(KnowledgeBase.id == knowledge_base_id, KnowledgeBase.json_etag == etag)).scalar()
+        if chunk is None:
+            raise PayloadChanged(f"Payload of knowledge base {knowledge_base_id} changed while it was sent")
+        yield bytes(chunk)
+
+def gunzip_chunks(chunks, chunk_size):
+    """Decompress a stream of gzip chunks, yielding at most `chunk_size` bytes at a time."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, chunk_size)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def streamed_payload_response(knowledge_base_id, etag, sizes, cache_control):
+    """kb_payload.json_payload_response for a payload sent as it is read. Callers answer revalidations first."""
+    encoding = choose_encoding({coding for coding, size in sizes.items() if size})
+    chunk_size = current_app.config['KB_STREAM_CHUNK_SIZE']
+    # The generators run after the request, so they get the engine rather than the session.
+    chunks = read_chunks(db.engine, knowledge_base_id, etag, STREAM_COLUMNS[encoding or 'gzip'],
+                         sizes[encoding or 'gzip'], chunk_size)
+    if encoding:
+        response = Response(chunks, mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding
+        response.content_length = sizes[encoding]
+    else:
+        response = Response(gunzip_chunks(chunks, chunk_size), mimetype='application/json')
+
+    response.set_etag(encoded_etag(etag, encoding))
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
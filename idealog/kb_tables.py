@@ -0,0 +1,132 @@
+"""Relational copies of knowledge base payloads, for queries across KBs.
+
+A KB's payload is a single JSON document, which is what its graph views need
+but not what a question like "which KBs mention Paris" needs. Whenever a KB's
+`json_object` changes, its content is also written to three indexed tables:
+
+    kb_entities     (knowledge_base_id, entity_id) -> name, Wikipedia url
+    kb_relations    (knowledge_base_id, relation_id) -> head, type, tail entity ids
+    kb_provenance   one row per (relation, article url, span)
+    kb_sources      (knowledge_base_id, article url) -> the article's details
+
+Entity and relation ids are positions in the KB's graph index and payload, so
+rows can be matched back to the graph API. The payload stays the source of
+truth: the rows of a KB are replaced as a whole every time it changes.
+
+Rows are written with COPY on PostgreSQL, which is an order of magnitude
+faster than INSERTs for KBs with tens of thousands of relations, and with a
+multi-row INSERT elsewhere.
+"""
+import csv
+import io
+import json
+
+import click
+from sqlalchemy import event, inspect
+
+from idealog.models import db, KnowledgeBase, KBEntity, KBRelation, KBProvenance, KBSource
+from idealog.kb_index import build_graph_index
+from idealog.kb_payload import payload_data
+
+# (table, columns written) in insertion order.
+TABLES = [
+    (KBEntity.__table__, ['knowledge_base_id', 'entity_id', 'name', 'url']),
+    (KBRelation.__table__, ['knowledge_base_id', 'relation_id', 'head', 'type', 'tail']),
+    (KBProvenance.__table__, ['knowledge_base_id', 'relation_id', 'url', 'span_start', 'span_end']),
+    (KBSource.__table__, ['knowledge_base_id', 'url', 'source']),
+]
+
+def table_rows(knowledge_base_id, kb_data, graph_index):
+    """Rows of kb_entities, kb_relations, kb_provenance and kb_sources for a KB, as tuples in TABLES column order."""
+    details = kb_data.get('entities', {})
+    entities = [(knowledge_base_id, entity_id, name, details.get(name, {}).get('url'))
+                for entity_id, name in enumerate(graph_index['entities'])]
+    types = graph_index['types']
+    relations = [(knowledge_base_id, relation_id, head, types[type_id], tail)
+                 for relation_id, (head, type_id, tail) in enumerate(graph_index['relations'])]
+
+    provenance = []
+    for relation_id, relation in enumerate(kb_data.get('relations', [])):
+        for url, meta in relation.get('meta', {}).items():
+            for span in meta.get('spans') or [[None, None]]:
+                provenance.append((knowledge_base_id, relation_id, url, span[0], span[1]))
+    sources = [(knowledge_base_id, url, source) for url, source in kb_data.get('sources', {}).items()]
+    return [entities, relations, provenance, sources]
+
+def copy_rows(connection, table, columns, rows):
+    """Bulk insert `rows` into `table`."""
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        # JSON columns (a source's details) are written as JSON text.
+        rows = ([json.dumps(value) if isinstance(value, (dict, list)) else value for value in row] for row in rows)
+        # QUOTE_NONNUMERIC writes None as a quoted empty string, which COPY
+        # would insert as '' (or reject, in an integer column); FORCE_NULL
+        # reads it back as NULL in the columns that may hold one.
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+        buffer.seek(0)
+        options = 'FORMAT csv'
+        nullable = [column for column in columns if table.c[column].nullable]
+        if nullable:
+            options += f", FORCE_NULL ({', '.join(nullable)})"
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH ({options})", buffer)
+        finally:
+            cursor.close()
+    else:
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+def write_knowledge_base_tables(connection, knowledge_base_id, json_object, graph_index=None):
+    """Replace the rows of a KB with the content of `json_object`."""
+    for table, _ in TABLES:
+        connection.execute(table.delete().where(table.c.knowledge_base_id == knowledge_base_id))
+    kb_data = payload_data(json_object) if json_object is not None else None
+    if not kb_data:
+        return
+    if graph_index is None:
+        graph_index = build_graph_index(kb_data)
+    for (table, columns), rows in zip(TABLES, table_rows(knowledge_base_id, kb_data, graph_index)):
+        copy_rows(connection, table, columns, rows)
+
+@event.listens_for(KnowledgeBase, 'after_insert')
+@event.listens_for(KnowledgeBase, 'after_update')
+def _write_tables(mapper, connection, target):
+    state = inspect(target)
+    if state.attrs.json_object.history.has_changes():
+        # set_json_object() has just built the graph index; don't load it if it hasn't.
+        write_knowledge_base_tables(connection, target.id, target.json_object, state.dict.get('graph_index'))
+
+@click.command('index-knowledge-bases')
+def index_knowledge_bases_command():
+    """Fill the entity, relation and provenance tables of KBs built before they existed."""
+    indexed = db.session.query(KBEntity.knowledge_base_id).distinct()
+    knowledge_base_ids = [row[0] for row in db.session.query(KnowledgeBase.id)
+                          .filter(KnowledgeBase.json_object.isnot(None), KnowledgeBase.id.not_in(indexed))
+                          .order_by(KnowledgeBase.id)]
+    for knowledge_base_id in knowledge_base_ids:
+        json_object, graph_index = (db.session.query(KnowledgeBase.json_object, KnowledgeBase.graph_index)
+                                    .filter(KnowledgeBase.id == knowledge_base_id).one())
+        write_knowledge_base_tables(db.session.connection(), knowledge_base_id, json_object, graph_index)
+        db.session.commit()
+    click.echo(f"Indexed {len(knowledge_base_ids)} knowledge base(s).")
+
+def relation_provenance(knowledge_base_id, relation_ids):
+    """The provenance of some relations of a KB, read from kb_provenance and kb_sources.
+
+    Returns ({relation id: meta as stored in the payload}, {url: source details}),
+    without loading the payload.
+    """
+    meta = {}
+    spans = (db.session.query(KBProvenance.relation_id, KBProvenance.url, KBProvenance.span_start, KBProvenance.span_end)
+             .filter(KBProvenance.knowledge_base_id == knowledge_base_id, KBProvenance.relation_id.in_(relation_ids))
+             .order_by(KBProvenance.id))
+    for relation_id, url, start, end in spans:
+        url_meta = meta.setdefault(relation_id, {}).setdefault(url, {"spans": []})
+        if start is not None:
+            url_meta["spans"].append([start, end])
+    urls = {url for relation_meta in meta.values() for url in relation_meta}
+    sources = dict(db.session.query(KBSource.url, KBSource.source)
+                   .filter(KBSource.knowledge_base_id == knowledge_base_id, KBSource.url.in_(urls)))
+    return meta, sources
@@ -0,0 +1,175 @@
+"""Per-stage tracing of the jobs that build knowledge bases.
+
+A job (see tasks.py) runs inside `trace_job(task)`, and the KB code marks its
+stages with `stage(name)` and its counts with `count(name)`:
+
+- load: reading the texts of the ideas and knowledge sources,
+- tokenization, generation and decoding: the model in extract_text_relations,
+  counting the tokens, spans and relations it produced,
+- entity_resolution: Wikipedia lookups, counting the lookups made and those
+  answered by the entity cache of the KB,
+- merge: adding linked relations to the KB,
+- serialization and storing: KB.to_json and set_json_object,
+- graph_views: the layout, clusters and analytics built once the payload is stored.
+
+A stage records its calls, total time and the highest resident memory of the
+process at the end of a call. Stages running in the pipeline's threads (see
+kb_pipeline.py) overlap, so their times can add up to more than the job's.
+The job records its peak resident memory and, with KB_TRACE_TRACEMALLOC, the
+peak of the memory allocated by Python; tracemalloc slows allocation-heavy
+code down noticeably, so it is off by default.
+
+The trace is stored on the knowledge base, also when the job fails or hits its
+soft time limit, and added to the metrics (see request_metrics.py). Only one
+job per process is traced at a time, as in Celery's prefork pool; outside a
+traced job `stage` and `count` do nothing.
+"""
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_active = None
+_active_lock = threading.Lock()
+
+def _rss():
+    """Resident memory of this process in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _reset_peak_rss():
+    """Reset the peak resident memory (VmHWM) of this process to its current value. Returns whether it could."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+class JobTrace():
+    """Stage timings, counts and memory of a job."""
+
+    def __init__(self, task):
+        self.task = task
+        self.lock = threading.Lock()
+        self.started = datetime.utcnow()
+        self.start = time.perf_counter()
+        # Dicts keep the stages in the order they first ran.
+        self.stages = {}
+        self.counters = {}
+        self.peak_rss_reset = _reset_peak_rss()
+        self.sampled_peak_rss = _rss()
+        self.tracemalloc_started = False
+        if current_app.config['KB_TRACE_TRACEMALLOC']:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self.tracemalloc_started = True
+
+    def add_stage(self, name, seconds):
+        rss = _rss()
+        with self.lock:
+            entry = self.stages.setdefault(name, {"name": name, "calls": 0, "seconds": 0.0, "peak_rss": None})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            if rss is not None:
+                entry["peak_rss"] = max(entry["peak_rss"] or 0, rss)
+                self.sampled_peak_rss = max(self.sampled_peak_rss or 0, rss)
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def result(self, error=None):
+        """The trace as stored in KnowledgeBase.build_trace."""
+        # Without a reset, VmHWM is the peak since the process started, not of this job.
+        peak_rss = _peak_rss() if self.peak_rss_reset else None
+        if peak_rss is None:
+            peak_rss = self.sampled_peak_rss
+        peak_python_memory = None
+        if tracemalloc.is_tracing():
+            peak_python_memory = tracemalloc.get_traced_memory()[1]
+            if self.tracemalloc_started:
+                tracemalloc.stop()
+        with self.lock:
+            counters = dict(self.counters)
+            stages = [dict(entry) for entry in self.stages.values()]
+        hits, lookups = counters.get('entity_cache_hits', 0), counters.get('entity_lookups', 0)
+        return {
+            "task": self.task,
+            "status": "failed" if error is not None else "ok",
+            "error": f"{type(error).__name__}: {error}" if error is not None else None,
+            "started": self.started.isoformat(),
+            "seconds": time.perf_counter() - self.start,
+            "stages": stages,
+            "counters": counters,
+            "entity_cache_hit_rate": hits / (hits + lookups) if hits + lookups else None,
+            "peak_rss": peak_rss,
+            "peak_python_memory": peak_python_memory,
+        }
+
+@contextmanager
+def trace_job(task):
+    """Trace the job run in the block. Yields its JobTrace, or None if another job is already traced."""
+    global _active
+    with _active_lock:
+        if _active is not None:
+            trace = None
+        else:
+            trace = _active = JobTrace(task)
+    try:
+        yield trace
+    finally:
+        if trace is not None:
+            with _active_lock:
+                _active = None
+
+def finish_trace(trace, error=None):
+    """Return the result of `trace` and add it to the metrics; None for no trace."""
+    if trace is None:
+        return None
+    result = trace.result(error)
+    metrics = current_app.extensions['metrics']
+    metrics.record_kb_job(result)
+    # A worker serves no requests, which would otherwise flush the counts.
+    metrics.flush(current_app.extensions.get('redis'), force=True)
+    return result
+
+@contextmanager
+def stage(name):
+    """Time the block as a call of stage `name` of the traced job."""
+    trace = _active
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, time.perf_counter() - start)
+
+def count(name, value=1):
+    """Add `value` to counter `name` of the traced job."""
+    trace = _active
+    if trace is not None:
+        trace.count(name, value)
@@ -0,0 +1,48 @@
+"""Graph views derived from a knowledge base's graph index.
+
+The layout, clusters and analytics of a KB take seconds for a few thousand
+entities (Louvain clustering most of all), so they are not computed when its
+payload is stored (`set_json_object`) but by the job that built the KB, once
+the payload is committed and can be served. Until a KB has its views the API
+serves its graph without positions, and answers requests that need a view with
+"not ready". Requests never compute or store anything: `flask
+build-graph-views` fills in the KBs stored without them.
+"""
+import click
+
+from idealog.models import db, KnowledgeBase
+from idealog.graph_layout import layout_graph
+from idealog.kb_clusters import build_cluster_hierarchy
+from idealog.kb_analytics import build_analytics
+
+# Columns computed from graph_index by build_graph_views().
+GRAPH_VIEW_COLUMNS = ['graph_layout', 'graph_clusters', 'graph_analytics']
+
+def build_graph_views(knowledge_base):
+    """Compute the graph views of a KB from its graph index."""
+    knowledge_base.graph_layout = layout_graph(knowledge_base.graph_index)
+    knowledge_base.graph_clusters = build_cluster_hierarchy(knowledge_base.graph_index)
+    knowledge_base.graph_analytics = build_analytics(knowledge_base.graph_index)
+
+def build_missing_graph_views():
+    """Fill in the ETag, index and graph views of KBs whose payload was stored without them
+    (before they were precomputed, or by `flask load-data`). Returns how many KBs were built."""
+    missing = [KnowledgeBase.json_etag.is_(None), KnowledgeBase.graph_index.is_(None)]
+    missing += [getattr(KnowledgeBase, column).is_(None) for column in GRAPH_VIEW_COLUMNS]
+    knowledge_base_ids = [row[0] for row in db.session.query(KnowledgeBase.id)
+                          .filter(KnowledgeBase.json_object.isnot(None), db.or_(*missing))
+                          .order_by(KnowledgeBase.id)]
+    for knowledge_base_id in knowledge_base_ids:
+        knowledge_base = db.session.get(KnowledgeBase, knowledge_base_id)
+        if knowledge_base.json_etag is None or knowledge_base.graph_index is None:
+            knowledge_base.set_json_object(knowledge_base.json_object)
+        build_graph_views(knowledge_base)
+        db.session.commit()
+        # One KB's payload and views in memory at a time.
+        db.session.expunge_all()
+    return len(knowledge_base_ids)
+
+@click.command('build-graph-views')
+def build_graph_views_command():
+    """Fill in the ETag, index and graph views of KBs stored before they were precomputed."""
+    click.echo(f"Built the graph views of {build_missing_graph_views()} knowledge base(s).")
@@ -0,0 +1,199 @@
+"""Schema migrations for Idealog.
+
+`db.create_all()` only creates missing tables, so indexes and constraints added
+to the models later never reach a database that already exists (including the
+one built by init_idealog.sh). Each migration below is a numbered list of SQL
+statements; applied versions are recorded in the `schema_migrations` table so
+`flask migrate` can be run repeatedly and only applies what is new.
+"""
+import click
+from sqlalchemy import text
+
+from idealog.models import db
+
+# Tables filtered with `privacy == 'public' OR user_id == ?` in the list and search views.
+PRIVACY_FILTERED_TABLES = ['ideas', 'groups', 'knowledge_sources', 'knowledge_domains', 'knowledge_bases']
+
+# Association tables as (table, left column, right column). The unique constraint
+# on (left, right) also serves lookups by the left column, so only the right one
+# needs its own index. user_knowledge_sources is left out because its second
+# column is named differently by the models and by init_idealog.sh.
+ASSOCIATION_TABLES = [
+    ('user_knowledge_bases', 'user_id', 'knowledge_base_id'),
+    ('idea_groups', 'idea_id', 'group_id'),
+    ('connections', 'idea_id_1', 'idea_id_2'),
+    ('knowledge_source_knowledge_domains', 'knowledge_source_id', 'knowledge_domain_id'),
+    ('knowledge_base_groups', 'knowledge_base_id', 'idea_group_id'),
+    ('knowledge_base_knowledge_domains', 'knowledge_base_id', 'knowledge_domain_id'),
+    ('knowledge_base_ideas', 'knowledge_base_id', 'idea_id'),
+    ('knowledge_base_knowledge_sources', 'knowledge_base_id', 'knowledge_source_id'),
+    ('idea_tags', 'idea_id', 'tag_id'),
+]
+
+def _privacy_filter_indexes():
+    statements = []
+    for table in PRIVACY_FILTERED_TABLES:
+        statements.append(f"CREATE INDEX IF NOT EXISTS ix_{table}_user_id ON {table} (user_id)")
+        statements.append(f"CREATE INDEX IF NOT EXISTS ix_{table}_public ON {table} (id) WHERE privacy = 'public'")
+    statements.append("CREATE INDEX IF NOT EXISTS ix_artifacts_idea_id ON artifacts (idea_id)")
+    return statements
+
+def _association_constraints():
+    statements = []
+    for table, left, right in ASSOCIATION_TABLES:
+        # The views used to append the same idea/source twice when it was picked
+        # directly and through a group/domain, so drop duplicates before the
+        # unique constraint goes on.
+        statements.append(
+            f"DELETE FROM {table} a USING {table} b "
+            f"WHERE a.id > b.id AND a.{left} = b.{left} AND a.{right} = b.{right}"
+        )
+        statements.append(
+            f"DO $$ BEGIN "
+            f"ALTER TABLE {table} ADD CONSTRAINT uq_{table} UNIQUE ({left}, {right}); "
+            f"EXCEPTION WHEN duplicate_object OR duplicate_table THEN NULL; END $$"
+        )
+        statements.append(f"CREATE INDEX IF NOT EXISTS ix_{table}_{right} ON {table} ({right})")
+    return statements
+
+def _knowledge_base_payload_columns():
+    return [
+        "ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS json_etag TEXT",
+        "ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS json_gzip BYTEA",
+        "ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS json_br BYTEA",
+    ]
+
+def _knowledge_base_graph_index_column():
+    return ["ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS graph_index JSON"]
+
+def _knowledge_base_graph_layout_column():
+    return ["ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS graph_layout JSON"]
+
+def _knowledge_base_graph_clusters_column():
+    return ["ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS graph_clusters JSON"]
+
+def _knowledge_base_graph_analytics_column():
+    return ["ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS graph_analytics JSON"]
+
+def _document_extracts_table():
+    return [
+        "CREATE TABLE IF NOT EXISTS document_extracts ("
+        "id SERIAL PRIMARY KEY, "
+        "document_type TEXT NOT NULL, "
+        "document_id INTEGER NOT NULL, "
+        "url TEXT NOT NULL, "
+        "json_object JSON, "
+        "date_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        "CONSTRAINT uq_document_extracts UNIQUE (document_type, document_id))",
+        "CREATE INDEX IF NOT EXISTS ix_document_extracts_url ON document_extracts (url)",
+    ]
+
+def _knowledge_base_tables():
+    return [
+        "CREATE TABLE IF NOT EXISTS kb_entities ("
+        "knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE, "
+        "entity_id INTEGER, "
+        "name TEXT NOT NULL, "
+        "url TEXT, "
+        "PRIMARY KEY (knowledge_base_id, entity_id))",
+        "CREATE INDEX IF NOT EXISTS ix_kb_entities_name ON kb_entities (name)",
+        "CREATE TABLE IF NOT EXISTS kb_relations ("
+        "knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE, "
+        "relation_id INTEGER, "
+        "head INTEGER NOT NULL, "
+        "type TEXT NOT NULL, "
+        "tail INTEGER NOT NULL, "
+        "PRIMARY KEY (knowledge_base_id, relation_id))",
+        "CREATE INDEX IF NOT EXISTS ix_kb_relations_type ON kb_relations (type)",
+        "CREATE INDEX IF NOT EXISTS ix_kb_relations_head ON kb_relations (knowledge_base_id, head)",
+        "CREATE INDEX IF NOT EXISTS ix_kb_relations_tail ON kb_relations (knowledge_base_id, tail)",
+        "CREATE TABLE IF NOT EXISTS kb_provenance ("
+        "id SERIAL PRIMARY KEY, "
+        "knowledge_base_id INTEGER NOT NULL REFERENCES knowledge_bases(id) ON DELETE CASCADE, "
+        "relation_id INTEGER NOT NULL, "
+        "url TEXT NOT NULL, "
+        "span_start INTEGER, "
+        "span_end INTEGER)",
+        "CREATE INDEX IF NOT EXISTS ix_kb_provenance_relation ON kb_provenance (knowledge_base_id, relation_id)",
+        "CREATE INDEX IF NOT EXISTS ix_kb_provenance_url ON kb_provenance (url)",
+    ]
+
+def _knowledge_base_sources_table():
+    # Filled from the payloads already stored; json_object holds either a JSON
+    # object or a string of JSON text, and #>> '{}' gives the text of both.
+    return [
+        "CREATE TABLE IF NOT EXISTS kb_sources ("
+        "knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE, "
+        "url TEXT, "
+        "source JSON, "
+        "PRIMARY KEY (knowledge_base_id, url))",
+        "INSERT INTO kb_sources (knowledge_base_id, url, source) "
+        "SELECT knowledge_bases.id, sources.key, sources.value "
+        "FROM knowledge_bases, json_each((knowledge_bases.json_object #>> '{}')::json -> 'sources') AS sources "
+        "WHERE knowledge_bases.id IN (SELECT DISTINCT knowledge_base_id FROM kb_entities) "
+        "ON CONFLICT DO NOTHING",
+    ]
+
+def _knowledge_base_build_trace_column():
+    return ["ALTER TABLE knowledge_bases ADD COLUMN IF NOT EXISTS build_trace JSON"]
+
+def _knowledge_base_payload_storage():
+    # Already compressed, so Postgres' compression gains nothing, and without
+    # it substr() reads only the chunks of its slice (see kb_stream.py).
+    return [
+        "ALTER TABLE knowledge_bases ALTER COLUMN json_gzip SET STORAGE EXTERNAL",
+        "ALTER TABLE knowledge_bases ALTER COLUMN json_br SET STORAGE EXTERNAL",
+    ]
+
+MIGRATIONS = [
+    (1, 'Index user_id and public rows of privacy filtered tables', _privacy_filter_indexes()),
+    (2, 'Unique (a, b) constraints and reverse indexes on association tables', _association_constraints()),
+    (3, 'ETag and precompressed payload columns on knowledge_bases', _knowledge_base_payload_columns()),
+    (4, 'Graph index column on knowledge_bases', _knowledge_base_graph_index_column()),
+    (5, 'Graph layout column on knowledge_bases', _knowledge_base_graph_layout_column()),
+    (6, 'Graph cluster hierarchy column on knowledge_bases', _knowledge_base_graph_clusters_column()),
+    (7, 'Graph analytics column on knowledge_bases', _knowledge_base_graph_analytics_column()),
+    (8, 'Per-document extracts for the global knowledge base', _document_extracts_table()),
+    (9, 'Entity, relation and provenance tables of knowledge bases', _knowledge_base_tables()),
+    (10, 'Index knowledge sources by url', ["CREATE INDEX IF NOT EXISTS ix_knowledge_sources_url ON knowledge_sources (url)"]),
+    (11, 'Build trace column on knowledge_bases', _knowledge_base_build_trace_column()),
+    (12, 'Uncompressed storage of precompressed knowledge base payloads', _knowledge_base_payload_storage()),
+    (13, 'Source table of knowledge bases', _knowledge_base_sources_table()),
+]
+
+def applied_versions(connection):
+    """Return the set of migration versions already applied."""
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "description TEXT NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+    ))
+    return {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+def apply_migrations(engine, verbose=False):
+    """Apply pending migrations in order, each in its own transaction. Returns the applied versions."""
+    applied = []
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+        if verbose:
+            print(f"Applying migration {version}: {description}")
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)"),
+                {"version": version, "description": description}
+            )
+        applied.append(version)
+    return applied
+
+@click.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    applied = apply_migrations(db.engine, verbose=True)
+    click.echo(f"Applied {len(applied)} migration(s).")
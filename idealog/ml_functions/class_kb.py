@@ -2,24 +2,28 @@ from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 import math
 import torch
 import wikipedia
-from newspaper import Article, ArticleException
-from GoogleNews import GoogleNews
+from newspaper import ArticleException
 from pyvis.network import Network
 import json
-
-tokenizer = AutoTokenizer.from_pretrained("Babelscape/rebel-large")
-model = AutoModelForSeq2SeqLM.from_pretrained("Babelscape/rebel-large")
-
-
-def get_news_links(query, lang="en", region="US", pages=1, max_links=100000):
-    googlenews = GoogleNews(lang=lang, region=region)
-    googlenews.search(query)
-    all_urls = []
-    for page in range(pages):
-        googlenews.get_page(page)
-        all_urls += googlenews.get_links()
-    return list(set(all_urls))[:max_links]
-
+import threading
+from idealog.article_fetcher import fetch_articles
+from idealog.kb_pipeline import build_kb
+from idealog.kb_trace import count, stage
+from idealog.news_search import news_search, search_news_links
+
+MODEL_NAME = "Babelscape/rebel-large"
+tokenizer = None
+model = None
+_model_lock = threading.Lock()
+
+def load_model():
+    """Return the tokenizer and model, loading them on first use rather than when the module is imported."""
+    global tokenizer, model
+    with _model_lock:
+        if model is None:
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+            model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME)
+    return tokenizer, model
 
 
 def extract_relations_from_model_output(text):
@@ -67,10 +71,12 @@ def extract_relations_from_model_output(text):
     return relations
 
 class KB():
-    def __init__(self):
+    def __init__(self, entity_cache=None):
         self.entities = {}
         self.relations = []
         self.sources = {}
+        # Wikipedia data by name, which the KBs built for one job can share.
+        self.entity_cache = {} if entity_cache is None else entity_cache
 
     def are_relations_equal(self, r1, r2):
         return all(r1[attr] == r2[attr] for attr in ["head", "type", "tail"])
@@ -105,14 +111,35 @@ class KB():
         except:
             return None
 
+    def lookup_entity(self, candidate_entity):
+        """get_wikipedia_data through the entity cache."""
+        if candidate_entity in self.entity_cache:
+            count('entity_cache_hits')
+            return self.entity_cache[candidate_entity]
+        count('entity_lookups')
+        with stage('entity_resolution'):
+            entity_data = self.get_wikipedia_data(candidate_entity)
+        self.entity_cache[candidate_entity] = entity_data
+        if entity_data is not None:
+            # Relations are renamed to the titles, which other articles may mention as such.
+            self.entity_cache.setdefault(entity_data["title"], entity_data)
+        return entity_data
+
     def add_entity(self, e):
         self.entities[e["title"]] = {k:v for k,v in e.items() if k != "title"}
 
     def add_relation(self, r, article_title, article_publish_date):
         # check on wikipedia
         candidate_entities = [r["head"], r["tail"]]
-        entities = [self.get_wikipedia_data(ent) for ent in candidate_entities]
+        entities = [self.lookup_entity(ent) for ent in candidate_entities]
+        self.add_linked_relation(r, entities, article_title, article_publish_date)
+
+    def add_linked_relation(self, r, entities, article_title, article_publish_date):
+        """add_relation with the wikipedia data of the head and tail already looked up."""
+        with stage('merge'):
+            self._merge_linked_relation(r, entities, article_title, article_publish_date)
 
+    def _merge_linked_relation(self, r, entities, article_title, article_publish_date):
         # if one entity does not exist, stop
         if any(ent is None for ent in entities):
             return
@@ -138,13 +165,17 @@ class KB():
             self.relations.append(r)
         else:
             self.merge_relations(r)
-    
+
     def merge_with_kb(self, kb2):
-        for r in kb2.relations:
-            article_url = list(r["meta"].keys())[0]
-            source_data = kb2.sources[article_url]
-            self.add_relation(r, source_data["article_title"],
-                              source_data["article_publish_date"])
+        # kb2 already linked its entities to wikipedia, so they are not looked up
+        # again, and merging it is one call of the merge stage.
+        with stage('merge'):
+            for r in kb2.relations:
+                article_url = list(r["meta"].keys())[0]
+                source_data = kb2.sources[article_url]
+                entities = [{"title": r[end], **kb2.entities.get(r[end], {})} for end in ("head", "tail")]
+                self._merge_linked_relation(r, entities, source_data["article_title"],
+                                            source_data["article_publish_date"])
 
     def print(self):
         print("Entities:")
@@ -167,6 +198,7 @@ class KB():
 
 def from_small_text_to_kb(text, verbose=False):
     kb = KB()
+    tokenizer, model = load_model()
 
     # Tokenizer text
     model_inputs = tokenizer(text, max_length=512, padding=True, truncation=True,
@@ -195,18 +227,22 @@ def from_small_text_to_kb(text, verbose=False):
 
     return kb
 
-def from_text_to_kb(text, article_url, span_length=128, article_title=None,
-                    article_publish_date=None, verbose=False):
+def extract_text_relations(text, article_url, span_length=128, verbose=False):
+    """Relations the model finds in `text`, before entity linking, with the spans they were found in."""
+    tokenizer, model = load_model()
     # tokenize whole text
-    inputs = tokenizer([text], return_tensors="pt")
+    with stage('tokenization'):
+        inputs = tokenizer([text], return_tensors="pt")
 
     # compute span boundaries
     num_tokens = len(inputs["input_ids"][0])
+    count('tokens', num_tokens)
     if verbose:
         print(f"Input has {num_tokens} tokens")
     num_spans = math.ceil(num_tokens / span_length)
     if verbose:
         print(f"Input has {num_spans} spans")
+    count('spans', num_spans)
     overlap = math.ceil((num_spans * span_length - num_tokens) / 
                         max(num_spans - 1, 1))
     spans_boundaries = []
@@ -236,77 +272,84 @@ def from_text_to_kb(text, article_url, span_length=128, article_title=None,
         "num_beams": 3,
         "num_return_sequences": num_return_sequences
     }
-    generated_tokens = model.generate(
-        **inputs,
-        **gen_kwargs,
-    )
-
-    # decode relations
-    decoded_preds = tokenizer.batch_decode(generated_tokens,
-                                           skip_special_tokens=False)
-
-    # create kb
-    kb = KB()
-    i = 0
-    for sentence_pred in decoded_preds:
-        current_span_index = i // num_return_sequences
-        relations = extract_relations_from_model_output(sentence_pred)
-        for relation in relations:
-            relation["meta"] = {
-                article_url: {
-                    "spans": [spans_boundaries[current_span_index]]
+    with stage('generation'):
+        generated_tokens = model.generate(
+            **inputs,
+            **gen_kwargs,
+        )
+
+    with stage('decoding'):
+        # decode relations
+        decoded_preds = tokenizer.batch_decode(generated_tokens,
+                                               skip_special_tokens=False)
+
+        # attach spans
+        text_relations = []
+        i = 0
+        for sentence_pred in decoded_preds:
+            current_span_index = i // num_return_sequences
+            relations = extract_relations_from_model_output(sentence_pred)
+            for relation in relations:
+                relation["meta"] = {
+                    article_url: {
+                        "spans": [spans_boundaries[current_span_index]]
+                    }
                 }
-            }
-            kb.add_relation(relation, article_title, article_publish_date)
-        i += 1
+                text_relations.append(relation)
+            i += 1
+    count('relations_extracted', len(text_relations))
+
+    return text_relations
 
+def from_text_to_kb(text, article_url, span_length=128, article_title=None,
+                    article_publish_date=None, verbose=False, entity_cache=None):
+    kb = KB(entity_cache)
+    for relation in extract_text_relations(text, article_url, span_length=span_length, verbose=verbose):
+        kb.add_relation(relation, article_title, article_publish_date)
     return kb
 
+def extract_article_relations(article):
+    return extract_text_relations(article["text"], article["url"])
+
 def get_article(url):
-    article = Article(url)
-    article.download()
-    article.parse()
-    return article
+    """Download and parse the article at `url`, through the article cache. Returns a dict of url, name, text and publish_date."""
+    # A single url doesn't need a process pool to parse it.
+    result = next(fetch_articles([url], parse_workers=0))
+    if result.article is None:
+        raise ArticleException(result.error)
+    return result.article
 
 def from_url_to_kb(url):
     article = get_article(url)
     config = {
-        "article_title": article.title,
-        "article_publish_date": article.publish_date
+        "article_title": article["name"],
+        "article_publish_date": article["publish_date"]
     }
-    kb = from_text_to_kb(article.text, article.url, **config)
+    kb = from_text_to_kb(article["text"], article["url"], **config)
     return kb
- 
+
 def get_news_links(query, lang="en", region="US", pages=1, max_links=100000):
-    googlenews = GoogleNews(lang=lang, region=region)
-    googlenews.search(query)
-    all_urls = []
-    for page in range(pages):
-        googlenews.get_page(page)
-        all_urls += googlenews.get_links()
-    return list(set(all_urls))[:max_links]
+    return list(search_news_links(query, pages=pages, max_links=max_links, search=news_search(lang=lang, region=region)))
 
 def from_urls_to_kb(urls, verbose=False):
-    kb = KB()
+    # Downloading, the model and the wikipedia lookups overlap; see kb_pipeline.py.
     if verbose:
         print(f"{len(urls)} links to visit")
-    for url in urls:
-        if verbose:
-            print(f"Visiting {url}...")
-        try:
-            kb_url = from_url_to_kb(url)
-            kb.merge_with_kb(kb_url)
-        except ArticleException:
-            if verbose:
-                print(f"Couldn't download article at url {url}")
-    return kb
+    kb = KB()
+    return build_kb(kb, urls, extract_article_relations, kb.lookup_entity)
+
+def from_query_to_kb(query, pages=1, max_links=100000):
+    """KB of the news articles found for `query`, built while the results are still being searched."""
+    kb = KB()
+    links = search_news_links(query, pages=pages, max_links=max_links)
+    return build_kb(kb, links, extract_article_relations, kb.lookup_entity)
 
-def from_idea_to_kb(idea):
+def from_idea_to_kb(idea, entity_cache=None):
     config = {
         "article_title": idea.name,
         "article_publish_date": idea.publish_date.isoformat()
     }
-    kb = from_text_to_kb(idea.text, idea.url, **config)
+    kb = from_text_to_kb(idea.text, idea.url, entity_cache=entity_cache, **config)
     return kb
 
 def from_ideas_to_kb(ideas, verbose=False):
@@ -317,7 +360,7 @@ def from_ideas_to_kb(ideas, verbose=False):
         if verbose:
             print(f"Visiting idea: {idea.name}...")
         try:
-            kb_idea = from_idea_to_kb(idea)
+            kb_idea = from_idea_to_kb(idea, entity_cache=kb.entity_cache)
             kb.merge_with_kb(kb_idea)
         except ArticleException:
             if verbose:
@@ -4,9 +4,25 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+from idealog.kb_payload import payload_text, payload_data, compute_etag, compress_payload
+from idealog.kb_index import build_graph_index
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Heavy columns (Idea.text, KnowledgeSource.text, Artifact.text and the
+# KnowledgeBase payloads) are deferred: list pages, search results and form
+# choices only show names, so these columns are loaded on first access, or up
+# front with `undefer()` where they are actually needed (detail/edit pages,
+# the KB JSON API and the extraction pipeline).
+
+class NameChoicesMixin():
+    """Id/name projection used to populate select fields."""
+
+    @classmethod
+    def choices(cls, *criteria):
+        return [tuple(row) for row in db.session.query(cls.id, cls.name).filter(*criteria).order_by(cls.id)]
+
 class User(db.Model):
     """User in the system."""
 
@@ -23,6 +39,10 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}, type={self.user_type}>"
 
+    @property
+    def is_admin(self):
+        return self.user_type == 'admin'
+
     @classmethod
     def signup(cls, username, email, password, image_url, user_type):
         """Sign up user.
@@ -67,15 +87,19 @@ class User(db.Model):
 
         return False
 
-class Idea(db.Model):
+class Idea(NameChoicesMixin, db.Model):
     """User's idea model."""
     __tablename__ = 'ideas'
+    __table_args__ = (
+        db.Index('ix_ideas_user_id', 'user_id'),
+        db.Index('ix_ideas_public', 'id', postgresql_where=db.text("privacy = 'public'")),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     name = db.Column(db.Text, nullable=False)
     publish_date = db.Column(db.DateTime, nullable=False, default = datetime.utcnow)
-    text = db.Column(db.Text, nullable=False)
+    text = db.deferred(db.Column(db.Text, nullable=False))
     url = db.Column(db.Text, nullable=False)
 
     privacy = db.Column(db.Text, nullable=False, default="private")
@@ -93,9 +117,13 @@ class Idea(db.Model):
     def sorted_query(cls):
         return cls.query.order_by(cls.name).all()
 
-class Group(db.Model):
+class Group(NameChoicesMixin, db.Model):
     """Ideas group model."""
     __tablename__ = 'groups'
+    __table_args__ = (
+        db.Index('ix_groups_user_id', 'user_id'),
+        db.Index('ix_groups_public', 'id', postgresql_where=db.text("privacy = 'public'")),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False, unique=True)
@@ -110,11 +138,14 @@ class Group(db.Model):
 class Artifact(db.Model):
     """Idea's artifact model."""
     __tablename__ = 'artifacts'
+    __table_args__ = (
+        db.Index('ix_artifacts_idea_id', 'idea_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
     publish_date = db.Column(db.Text, nullable=False, default = datetime.utcnow)
-    text = db.Column(db.Text, nullable=False)
+    text = db.deferred(db.Column(db.Text, nullable=False))
     url = db.Column(db.Text, nullable=False)
     file_url = db.Column(db.Text, nullable=False)
     idea_id = db.Column(db.Integer, db.ForeignKey('ideas.id', ondelete="CASCADE"))
@@ -131,18 +162,23 @@ class Artifact(db.Model):
     def sorted_query(self):
         return self.query.order_by(self.name).all()
 
-class KnowledgeSource(db.Model):
+class KnowledgeSource(NameChoicesMixin, db.Model):
     """
     Knowledge source model
     It's similar to ideas but it includes "ideas" extracted from published paper, internet articles, other sources, etc.
     It usually is a bigger chunk of information.
     """
     __tablename__='knowledge_sources'
+    __table_args__ = (
+        db.Index('ix_knowledge_sources_user_id', 'user_id'),
+        db.Index('ix_knowledge_sources_public', 'id', postgresql_where=db.text("privacy = 'public'")),
+        db.Index('ix_knowledge_sources_url', 'url'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
     publish_date = db.Column(db.DateTime, nullable=False, default = datetime.utcnow)
-    text = db.Column(db.Text, nullable=False)
+    text = db.deferred(db.Column(db.Text, nullable=False))
     url = db.Column(db.Text, nullable=False)
 
     privacy = db.Column(db.Text, nullable=False, default="private")
@@ -161,9 +197,13 @@ class KnowledgeSource(db.Model):
     def sorted_query(self):
         return self.query.order_by(self.name).all()
 
-class KnowledgeDomain(db.Model):
+class KnowledgeDomain(NameChoicesMixin, db.Model):
     """Knowledge domain model. Similar to the idea's group."""
     __tablename__ = 'knowledge_domains'
+    __table_args__ = (
+        db.Index('ix_knowledge_domains_user_id', 'user_id'),
+        db.Index('ix_knowledge_domains_public', 'id', postgresql_where=db.text("privacy = 'public'")),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
@@ -175,13 +215,27 @@ class KnowledgeDomain(db.Model):
     def __repr__(self):
         return f"<Knowledge Domain #{self.id}: {self.name}>"
 
-class KnowledgeBase(db.Model):
+class KnowledgeBase(NameChoicesMixin, db.Model):
     """Knowledge basee model. Storing objects of KBClass. """
     __tablename__ = 'knowledge_bases'
+    __table_args__ = (
+        db.Index('ix_knowledge_bases_user_id', 'user_id'),
+        db.Index('ix_knowledge_bases_public', 'id', postgresql_where=db.text("privacy = 'public'")),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.Text, nullable=False)
-    json_object = db.Column(db.JSON)
+    json_object = db.deferred(db.Column(db.JSON))
+    json_etag = db.Column(db.Text)
+    json_gzip = db.deferred(db.Column(db.LargeBinary))
+    json_br = db.deferred(db.Column(db.LargeBinary))
+    # Derived from json_object. None is stored as SQL NULL, so the API can tell
+    # which have been built without loading them.
+    graph_index = db.deferred(db.Column(db.JSON(none_as_null=True)))
+    graph_layout = db.deferred(db.Column(db.JSON(none_as_null=True)))
+    graph_clusters = db.deferred(db.Column(db.JSON(none_as_null=True)))
+    graph_analytics = db.deferred(db.Column(db.JSON(none_as_null=True)))
+    build_trace = db.deferred(db.Column(db.JSON))
     date_created = db.Column(db.DateTime, nullable=False, default = datetime.utcnow)
 
     privacy = db.Column(db.Text, nullable=False, default="private")
@@ -200,6 +254,103 @@ class KnowledgeBase(db.Model):
     def __repr__(self):
         return f"<Knowledge Base #{self.id}: {self.name}>"
 
+    def set_json_object(self, json_object):
+        """Store the KB's JSON along with its ETag, precompressed variants and graph index.
+
+        The layout, clusters and analytics of the previous payload are cleared;
+        they are built afterwards, outside the save (see kb_views.py).
+        """
+        self.json_object = json_object
+        self.graph_layout = self.graph_clusters = self.graph_analytics = None
+        text = payload_text(json_object)
+        if text is None:
+            self.json_etag = self.json_gzip = self.json_br = self.graph_index = None
+            return
+        self.json_etag = compute_etag(text)
+        self.json_gzip, self.json_br = compress_payload(text)
+        self.graph_index = build_graph_index(payload_data(json_object))
+
+class DocumentExtract(db.Model):
+    """Relations extracted from a single idea or knowledge source, kept so the
+    global knowledge base can be patched one document at a time."""
+    __tablename__ = 'document_extracts'
+    __table_args__ = (
+        db.UniqueConstraint('document_type', 'document_id', name='uq_document_extracts'),
+        db.Index('ix_document_extracts_url', 'url'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    document_type = db.Column(db.Text, nullable=False)
+    document_id = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.Text, nullable=False)
+    json_object = db.deferred(db.Column(db.JSON))
+    date_updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Document Extract #{self.id}: {self.document_type} {self.document_id}>"
+
+class KBEntity(db.Model):
+    """An entity of a knowledge base. `entity_id` is its position in the KB's graph index."""
+    __tablename__ = 'kb_entities'
+    __table_args__ = (
+        db.Index('ix_kb_entities_name', 'name'),
+    )
+
+    knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Text, nullable=False)
+    url = db.Column(db.Text)
+
+    def __repr__(self):
+        return f"<KB Entity {self.knowledge_base_id}:{self.entity_id}: {self.name}>"
+
+class KBRelation(db.Model):
+    """A relation of a knowledge base. `relation_id` is its position in the KB's payload."""
+    __tablename__ = 'kb_relations'
+    __table_args__ = (
+        db.Index('ix_kb_relations_type', 'type'),
+        db.Index('ix_kb_relations_head', 'knowledge_base_id', 'head'),
+        db.Index('ix_kb_relations_tail', 'knowledge_base_id', 'tail'),
+    )
+
+    knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"), primary_key=True)
+    relation_id = db.Column(db.Integer, primary_key=True)
+    head = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.Text, nullable=False)
+    tail = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<KB Relation {self.knowledge_base_id}:{self.relation_id}: {self.type}>"
+
+class KBProvenance(db.Model):
+    """A span of a source article that a knowledge base relation was extracted from."""
+    __tablename__ = 'kb_provenance'
+    __table_args__ = (
+        db.Index('ix_kb_provenance_relation', 'knowledge_base_id', 'relation_id'),
+        db.Index('ix_kb_provenance_url', 'url'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"), nullable=False)
+    relation_id = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.Text, nullable=False)
+    span_start = db.Column(db.Integer)
+    span_end = db.Column(db.Integer)
+
+    def __repr__(self):
+        return f"<KB Provenance {self.knowledge_base_id}:{self.relation_id}: {self.url}>"
+
+class KBSource(db.Model):
+    """An article a knowledge base cites, with the details stored in its payload's `sources`."""
+    __tablename__ = 'kb_sources'
+
+    knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"), primary_key=True)
+    url = db.Column(db.Text, primary_key=True)
+    source = db.Column(db.JSON)
+
+    def __repr__(self):
+        return f"<KB Source {self.knowledge_base_id}: {self.url}>"
+
 class Tag(db.Model):
     """"""
     __tablename__='tags'
@@ -212,6 +363,10 @@ class Tag(db.Model):
 class UserKnowledgeBase(db.Model):
     """Storing relationships between users and knowledge bases"""
     __tablename__ = 'user_knowledge_bases'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'knowledge_base_id', name='uq_user_knowledge_bases'),
+        db.Index('ix_user_knowledge_bases_knowledge_base_id', 'knowledge_base_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"))
@@ -220,6 +375,10 @@ class UserKnowledgeBase(db.Model):
 class UserKnowledgeSource(db.Model):
     """Storing relationships between users and knowledge sources"""
     __tablename__ = 'user_knowledge_sources'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'knowledge_base_id', name='uq_user_knowledge_sources'),
+        db.Index('ix_user_knowledge_sources_knowledge_base_id', 'knowledge_base_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete="CASCADE"))
@@ -228,6 +387,10 @@ class UserKnowledgeSource(db.Model):
 class IdeaGroup(db.Model):
     """Storing relationships between ideas and idea groups"""
     __tablename__ = 'idea_groups'
+    __table_args__ = (
+        db.UniqueConstraint('idea_id', 'group_id', name='uq_idea_groups'),
+        db.Index('ix_idea_groups_group_id', 'group_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     idea_id = db.Column(db.Integer, db.ForeignKey('ideas.id', ondelete="CASCADE"))
@@ -236,6 +399,10 @@ class IdeaGroup(db.Model):
 class Connection(db.Model):
     """Storing connection between two different idieas"""
     __tablename__ = 'connections'
+    __table_args__ = (
+        db.UniqueConstraint('idea_id_1', 'idea_id_2', name='uq_connections'),
+        db.Index('ix_connections_idea_id_2', 'idea_id_2'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     idea_id_1 = db.Column(db.Integer, db.ForeignKey('ideas.id', ondelete="CASCADE"))
@@ -246,6 +413,10 @@ class Connection(db.Model):
 class KnowledgeSourceKnowledgeDomain(db.Model):
     """Storing relationships between knowledge sources and knowledge domains"""
     __tablename__ = 'knowledge_source_knowledge_domains'
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_source_id', 'knowledge_domain_id', name='uq_knowledge_source_knowledge_domains'),
+        db.Index('ix_knowledge_source_knowledge_domains_knowledge_domain_id', 'knowledge_domain_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     knowledge_source_id = db.Column(db.Integer, db.ForeignKey('knowledge_sources.id', ondelete="CASCADE"))
@@ -254,6 +425,10 @@ class KnowledgeSourceKnowledgeDomain(db.Model):
 class KnowledgeBaseGroup(db.Model):
     """Storing relationships between a knowledge base and groups"""
     __tablename__ = 'knowledge_base_groups'
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_base_id', 'idea_group_id', name='uq_knowledge_base_groups'),
+        db.Index('ix_knowledge_base_groups_idea_group_id', 'idea_group_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"))
@@ -262,6 +437,10 @@ class KnowledgeBaseGroup(db.Model):
 class KnowledgeBaseKnowledgeDomain(db.Model):
     """Storing relationships between a knowledge base and groups"""
     __tablename__ = 'knowledge_base_knowledge_domains'
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_base_id', 'knowledge_domain_id', name='uq_knowledge_base_knowledge_domains'),
+        db.Index('ix_knowledge_base_knowledge_domains_knowledge_domain_id', 'knowledge_domain_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"))
@@ -270,6 +449,10 @@ class KnowledgeBaseKnowledgeDomain(db.Model):
 class KnowledgeBaseIdea(db.Model):
     """Storing relationships between a knowledge base and ideas (components of a KB)"""
     __tablename__ = 'knowledge_base_ideas'
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_base_id', 'idea_id', name='uq_knowledge_base_ideas'),
+        db.Index('ix_knowledge_base_ideas_idea_id', 'idea_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"))
@@ -278,6 +461,10 @@ class KnowledgeBaseIdea(db.Model):
 class KnowledgeBaseKnowledgeSource(db.Model):
     """Storing relationships between a knowledge base and knowledge sources (components of a KB)"""
     __tablename__ = 'knowledge_base_knowledge_sources'
+    __table_args__ = (
+        db.UniqueConstraint('knowledge_base_id', 'knowledge_source_id', name='uq_knowledge_base_knowledge_sources'),
+        db.Index('ix_knowledge_base_knowledge_sources_knowledge_source_id', 'knowledge_source_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     knowledge_base_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id', ondelete="CASCADE"))
@@ -286,11 +473,26 @@ class KnowledgeBaseKnowledgeSource(db.Model):
 class IdeaTag(db.Model):
     """Storing relationships between ideas and tags"""
     __tablename__ = 'idea_tags'
+    __table_args__ = (
+        db.UniqueConstraint('idea_id', 'tag_id', name='uq_idea_tags'),
+        db.Index('ix_idea_tags_tag_id', 'tag_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     idea_id = db.Column(db.Integer, db.ForeignKey('ideas.id', ondelete="CASCADE"))
     tag_id = db.Column(db.Integer, db.ForeignKey('tags.id', ondelete="CASCADE"))
 
+def load_texts(documents):
+    """Load the deferred `text` of a mixed list of ideas and knowledge sources, one query per model.
+
+    Used by the extraction pipeline, which reads every document's text.
+    """
+    for model in (Idea, KnowledgeSource):
+        ids = [document.id for document in documents if isinstance(document, model)]
+        if ids:
+            model.query.options(db.undefer(model.text)).filter(model.id.in_(ids)).all()
+    return documents
+
 # def connect_db(app):
 #     """Connect this database to provided Flask app."""
 #     db.app = app
@@ -0,0 +1,105 @@
+"""Finding article links for a search query.
+
+A provider returns the links on one page of results for a query:
+
+- `GoogleNewsSearch` searches Google News.
+- `LocalNewsSearch` reads the results from a JSON file of
+  {query: [[links on page 1], [links on page 2], ...]}, for development and
+  tests without network access. It is used when NEWS_SEARCH_FILE is set.
+
+`search_news_links` yields the links of a query page by page, so building a
+KB can start on the first page while later ones are still being searched.
+Every page is cached in Redis for NEWS_LINKS_CACHE_TTL seconds per provider,
+query and page, so searching the same query again makes no requests.
+"""
+import hashlib
+import json
+import threading
+
+from flask import current_app, has_app_context
+from GoogleNews import GoogleNews
+from redis.exceptions import RedisError
+
+class GoogleNewsSearch():
+    name = "google"
+
+    def __init__(self, lang="en", region="US"):
+        self.lang = lang
+        self.region = region
+        self._searches = {}
+        self._lock = threading.Lock()
+
+    def page_links(self, query, page):
+        # GoogleNews fetches page 1 when the search starts and accumulates
+        # links across pages, so keep one instance per query.
+        with self._lock:
+            googlenews = self._searches.get(query)
+            if googlenews is None:
+                googlenews = self._searches[query] = GoogleNews(lang=self.lang, region=self.region)
+                googlenews.search(query)
+                if page == 1:
+                    return list(googlenews.get_links())
+            before = len(googlenews.get_links())
+            googlenews.get_page(page)
+            return list(googlenews.get_links()[before:])
+
+class LocalNewsSearch():
+    name = "local"
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.results = json.load(f)
+
+    def page_links(self, query, page):
+        pages = self.results.get(query, [])
+        return list(pages[page - 1]) if page <= len(pages) else []
+
+def news_search(lang="en", region="US"):
+    """The search provider configured for the current app."""
+    if has_app_context() and current_app.config.get('NEWS_SEARCH_FILE'):
+        return LocalNewsSearch(current_app.config['NEWS_SEARCH_FILE'])
+    return GoogleNewsSearch(lang=lang, region=region)
+
+def _cache_key(search, query, page):
+    query_hash = hashlib.sha256(f"{getattr(search, 'lang', '')}:{getattr(search, 'region', '')}:{query}".encode('utf-8')).hexdigest()
+    return f"idealog:news_links:{search.name}:{query_hash}:{page}"
+
+def _redis():
+    if not has_app_context() or not current_app.config.get('NEWS_LINKS_CACHE_TTL'):
+        return None
+    return current_app.extensions.get('redis')
+
+def cached_page_links(search, query, page):
+    """Links on one page of results, through the Redis cache."""
+    r = _redis()
+    key = _cache_key(search, query, page)
+    if r is not None:
+        try:
+            cached = r.get(key)
+            if cached is not None:
+                return json.loads(cached)
+        except RedisError:
+            r = None
+
+    links = search.page_links(query, page)
+    if r is not None:
+        try:
+            r.set(key, json.dumps(links), ex=current_app.config['NEWS_LINKS_CACHE_TTL'])
+        except RedisError:
+            pass
+    return links
+
+def search_news_links(query, pages=1, max_links=100000, search=None):
+    """Yield the unique links of the first `pages` pages of results for `query`, up to `max_links`."""
+    search = search or news_search()
+    seen = set()
+    for page in range(1, pages + 1):
+        links = cached_page_links(search, query, page)
+        if not links:
+            return
+        for link in links:
+            if link not in seen:
+                seen.add(link)
+                yield link
+                if len(seen) == max_links:
+                    return
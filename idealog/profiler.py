@@ -0,0 +1,198 @@
+"""On-demand sampling profiler of the web and Celery worker processes.
+
+Every worker process runs a control thread that registers the process in
+Redis and waits on its own request list with BLPOP, so an idle worker costs
+one Redis round trip every PROFILER_POLL_SECONDS. Web workers start it on
+their first request, Celery pool processes when they start (see
+celery_app.py).
+
+An admin picks a worker and a duration on /users_bp/admin. The worker's
+control thread then samples the stacks of the process's other threads every
+PROFILER_INTERVAL seconds with sys._current_frames(), without signals and
+without touching the sampled threads, and stores them as collapsed stacks
+("thread;outer;...;inner count" lines, the input of flamegraph.pl and
+speedscope) in Redis for PROFILER_RESULT_TTL seconds. The result is saved
+every second while sampling, so a Celery process that exits with its task
+still leaves what it sampled.
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import redis
+from flask import current_app
+from redis.exceptions import RedisError
+
+WORKERS_KEY = "idealog:profiler:workers"
+PROFILES_KEY = "idealog:profiler:profiles"
+SAVE_INTERVAL = 1.0
+
+_started_pid = None
+_start_lock = threading.Lock()
+
+def _requests_key(worker_id):
+    return f"idealog:profiler:requests:{worker_id}"
+
+def _result_key(profile_id):
+    return f"idealog:profiler:profile:{profile_id}"
+
+def _frame_name(code, prefixes):
+    filename = code.co_filename
+    # Module paths, e.g. idealog/tasks.py or threading.py, rather than absolute ones.
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+            break
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(';', ':')
+
+def take_sample(counts, skip=()):
+    """Add the current stack of every thread but those in `skip` to `counts`."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    prefixes = sorted((os.path.join(os.path.abspath(path), '') for path in sys.path if path), key=len, reverse=True)
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id in skip:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame.f_code, prefixes))
+            frame = frame.f_back
+        stack.append(names.get(thread_id, str(thread_id)).replace(';', ':'))
+        counts[";".join(reversed(stack))] += 1
+
+def collapsed_stacks(counts):
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+class Profiler():
+    """The control thread of this process."""
+
+    def __init__(self, app, kind):
+        self.app = app
+        self.worker_id = f"{kind}:{socket.gethostname()}:{os.getpid()}"
+        self.info = {"kind": kind, "host": socket.gethostname(), "pid": os.getpid(),
+                     "started": datetime.utcnow().isoformat(timespec='seconds')}
+        self.poll = app.config['PROFILER_POLL_SECONDS']
+        # The app's client times out after a second, shorter than BLPOP waits.
+        kwargs = app.extensions['redis'].connection_pool.connection_kwargs
+        self.redis = redis.Redis(**dict(kwargs, socket_timeout=self.poll + 10))
+
+    def run(self):
+        while True:
+            try:
+                self.redis.hset(WORKERS_KEY, self.worker_id, json.dumps(dict(self.info, seen=time.time())))
+                item = self.redis.blpop([_requests_key(self.worker_id)], timeout=self.poll)
+            except RedisError:
+                time.sleep(self.poll)
+                continue
+            if item is not None:
+                self.profile(json.loads(item[1]))
+
+    def profile(self, profile_request):
+        profile_id = profile_request["id"]
+        interval = self.app.config['PROFILER_INTERVAL']
+        ttl = self.app.config['PROFILER_RESULT_TTL']
+        skip = {threading.get_ident()}
+        counts = Counter()
+        samples = 0
+        start = time.monotonic()
+        deadline = start + profile_request["seconds"]
+        saved = start
+        while True:
+            take_sample(counts, skip)
+            samples += 1
+            now = time.monotonic()
+            done = now >= deadline
+            if done or now - saved >= SAVE_INTERVAL:
+                self.save(profile_id, profile_request, counts, samples, now - start, done, ttl)
+                saved = now
+            if done:
+                return
+            time.sleep(interval)
+
+    def save(self, profile_id, profile_request, counts, samples, seconds, done, ttl):
+        entry = dict(profile_request, status="done" if done else "running", samples=samples, sampled_seconds=round(seconds, 1))
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.setex(_result_key(profile_id), ttl, collapsed_stacks(counts))
+            pipeline.hset(PROFILES_KEY, profile_id, json.dumps(entry))
+            pipeline.execute()
+        except RedisError:
+            pass
+
+def start_profiler(app, kind):
+    """Start the control thread of this process, once per process (also after a fork)."""
+    global _started_pid
+    if not app.config['PROFILER_ENABLED'] or app.extensions.get('redis') is None:
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    profiler = Profiler(app, kind)
+    threading.Thread(target=profiler.run, name="idealog-profiler", daemon=True).start()
+
+def init_profiler(app):
+    """Start the control thread of web workers on their first request."""
+    def start_web_profiler():
+        if _started_pid != os.getpid():
+            start_profiler(app, 'web')
+    if not app.testing:
+        app.before_request(start_web_profiler)
+
+def _redis():
+    r = current_app.extensions.get('redis')
+    if r is None:
+        raise RedisError("Redis is not configured")
+    return r
+
+def list_workers():
+    """The worker processes seen within the last two polls, by worker id. Forgets the others."""
+    r = _redis()
+    horizon = time.time() - 2 * current_app.config['PROFILER_POLL_SECONDS'] - 5
+    workers = {}
+    for worker_id, info in r.hgetall(WORKERS_KEY).items():
+        worker_id, info = worker_id.decode('utf-8'), json.loads(info)
+        if info["seen"] < horizon:
+            r.hdel(WORKERS_KEY, worker_id)
+        else:
+            workers[worker_id] = info
+    return dict(sorted(workers.items()))
+
+def request_profile(worker_id, seconds):
+    """Ask worker `worker_id` to sample its stacks for `seconds`. Returns the profile id."""
+    r = _redis()
+    profile_id = uuid.uuid4().hex[:12]
+    entry = {"id": profile_id, "worker": worker_id, "seconds": seconds,
+             "requested": datetime.utcnow().isoformat(timespec='seconds'), "status": "requested"}
+    pipeline = r.pipeline(transaction=False)
+    pipeline.hset(PROFILES_KEY, profile_id, json.dumps(entry))
+    pipeline.rpush(_requests_key(worker_id), json.dumps(entry))
+    # A worker that went away doesn't leave requests behind.
+    pipeline.expire(_requests_key(worker_id), 2 * current_app.config['PROFILER_POLL_SECONDS'])
+    pipeline.execute()
+    return profile_id
+
+def list_profiles():
+    """Profiles, newest first. Forgets those whose result expired."""
+    r = _redis()
+    ttl = current_app.config['PROFILER_RESULT_TTL']
+    profiles = []
+    for profile_id, entry in r.hgetall(PROFILES_KEY).items():
+        entry = json.loads(entry)
+        age = (datetime.utcnow() - datetime.fromisoformat(entry["requested"])).total_seconds()
+        if age > ttl + entry["seconds"]:
+            r.hdel(PROFILES_KEY, profile_id)
+        else:
+            profiles.append(entry)
+    return sorted(profiles, key=lambda entry: entry["requested"], reverse=True)
+
+def profile_stacks(profile_id):
+    """The collapsed stacks of a profile, or None."""
+    result = _redis().get(_result_key(profile_id))
+    return result.decode('utf-8') if result is not None else None
@@ -0,0 +1,243 @@
+"""Per-request timing and SQL statement metrics.
+
+Every request records, under its endpoint and method:
+
+- its duration, from before the user is loaded until the response body has
+  been sent,
+- the number of SQL statements it ran and the time spent in them,
+- the size of the response body.
+
+They are kept as Prometheus histograms in each worker process and added to
+Redis every `METRICS_FLUSH_INTERVAL` seconds, so `/users_bp/admin/metrics`
+reports all gunicorn workers together. The endpoint is open to admins and,
+when `METRICS_TOKEN` is set, to scrapers sending it as a bearer token.
+
+Requests slower than `SLOW_REQUEST_SECONDS` are logged with their slowest
+statements (without parameters).
+
+The jobs building knowledge bases add their durations, peak memory, stage
+times and counts (see kb_trace.py) to the same metrics.
+"""
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+from idealog.models import db
+
+METRICS_KEY = "idealog:metrics"
+SLOW_STATEMENTS_LOGGED = 10
+STATEMENTS_KEPT = 200
+
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+SIZE_BUCKETS = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864]
+JOB_DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+MEMORY_BUCKETS = [2 ** 27, 2 ** 28, 2 ** 29, 2 ** 30, 2 ** 31, 2 ** 32, 2 ** 33, 2 ** 34]
+
+# name: (buckets, help)
+HISTOGRAMS = {
+    'idealog_request_duration_seconds': (DURATION_BUCKETS, "Time from the start of a request until its response was sent."),
+    'idealog_request_sql_statements': (COUNT_BUCKETS, "SQL statements run by a request."),
+    'idealog_request_sql_duration_seconds': (DURATION_BUCKETS, "Time a request spent running SQL statements."),
+    'idealog_response_size_bytes': (SIZE_BUCKETS, "Size of the response body."),
+    'idealog_kb_job_duration_seconds': (JOB_DURATION_BUCKETS, "Time a knowledge base job took, by task."),
+    'idealog_kb_job_peak_rss_bytes': (MEMORY_BUCKETS, "Peak resident memory of the worker during a knowledge base job."),
+}
+REQUESTS_TOTAL = 'idealog_requests_total'
+KB_JOBS_TOTAL = 'idealog_kb_jobs_total'
+KB_JOB_STAGE_SECONDS = 'idealog_kb_job_stage_seconds_total'
+KB_JOB_STAGE_CALLS = 'idealog_kb_job_stage_calls_total'
+KB_JOB_COUNTS = 'idealog_kb_job_counts_total'
+
+# name: help
+COUNTERS = {
+    REQUESTS_TOTAL: "Requests, by endpoint, method and status.",
+    KB_JOBS_TOTAL: "Knowledge base jobs, by task and status.",
+    KB_JOB_STAGE_SECONDS: "Time knowledge base jobs spent in each stage.",
+    KB_JOB_STAGE_CALLS: "Calls of each stage of knowledge base jobs.",
+    KB_JOB_COUNTS: "Tokens, spans, relations, entity lookups and entity cache hits of knowledge base jobs.",
+}
+
+class Metrics():
+    """Counters of this process not yet added to Redis, by Redis hash field."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.last_flush = time.monotonic()
+
+    def add(self, field, value):
+        self.counts[field] = self.counts.get(field, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][0]
+        for bound in buckets:
+            if value <= bound:
+                self.add(f"{name}_bucket|{labels}|{bound}", 1)
+        self.add(f"{name}_bucket|{labels}|+Inf", 1)
+        self.add(f"{name}_sum|{labels}|", value)
+        self.add(f"{name}_count|{labels}|", 1)
+
+    def record(self, request_metrics, status, size, duration):
+        labels = f'endpoint="{request_metrics.endpoint}",method="{request_metrics.method}"'
+        with self.lock:
+            self.add(f'{REQUESTS_TOTAL}|{labels},status="{status}"|', 1)
+            self.observe('idealog_request_duration_seconds', labels, duration)
+            self.observe('idealog_request_sql_statements', labels, request_metrics.statements)
+            self.observe('idealog_request_sql_duration_seconds', labels, request_metrics.sql_duration)
+            if size is not None:
+                self.observe('idealog_response_size_bytes', labels, size)
+
+    def record_kb_job(self, trace):
+        """Add the result of a kb_trace.JobTrace."""
+        labels = f'task="{trace["task"]}"'
+        with self.lock:
+            self.add(f'{KB_JOBS_TOTAL}|{labels},status="{trace["status"]}"|', 1)
+            self.observe('idealog_kb_job_duration_seconds', labels, trace["seconds"])
+            if trace["peak_rss"] is not None:
+                self.observe('idealog_kb_job_peak_rss_bytes', labels, trace["peak_rss"])
+            for entry in trace["stages"]:
+                self.add(f'{KB_JOB_STAGE_SECONDS}|{labels},stage="{entry["name"]}"|', entry["seconds"])
+                self.add(f'{KB_JOB_STAGE_CALLS}|{labels},stage="{entry["name"]}"|', entry["calls"])
+            for name, value in trace["counters"].items():
+                self.add(f'{KB_JOB_COUNTS}|{labels},count="{name}"|', value)
+
+    def flush(self, r, force=False):
+        """Add the pending counts to Redis, at most every METRICS_FLUSH_INTERVAL seconds unless `force`d.
+
+        Counts stay pending while Redis is unavailable."""
+        with self.lock:
+            if not force and time.monotonic() - self.last_flush < current_app.config['METRICS_FLUSH_INTERVAL']:
+                return
+            counts, self.counts = self.counts, {}
+            self.last_flush = time.monotonic()
+        if not counts or r is None:
+            self.merge(counts)
+            return
+        try:
+            pipeline = r.pipeline(transaction=False)
+            for field, value in counts.items():
+                if isinstance(value, int):
+                    pipeline.hincrby(METRICS_KEY, field, value)
+                else:
+                    pipeline.hincrbyfloat(METRICS_KEY, field, value)
+            pipeline.execute()
+        except RedisError:
+            self.merge(counts)
+
+    def merge(self, counts):
+        with self.lock:
+            for field, value in counts.items():
+                self.add(field, value)
+
+    def pending(self):
+        with self.lock:
+            return dict(self.counts)
+
+class RequestMetrics():
+    """What the current request has done so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.endpoint = None
+        self.method = None
+        self.statements = 0
+        self.sql_duration = 0.0
+        # (duration, statement), the slowest kept once there are too many.
+        self.statement_timings = []
+
+    def add_statement(self, statement, duration):
+        self.statements += 1
+        self.sql_duration += duration
+        self.statement_timings.append((duration, statement))
+        if len(self.statement_timings) > 2 * STATEMENTS_KEPT:
+            self.statement_timings = sorted(self.statement_timings, reverse=True)[:STATEMENTS_KEPT]
+
+def _redis():
+    return current_app.extensions.get('redis')
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'request_metrics' in g:
+        g.request_metrics.add_statement(statement, duration)
+
+def _start_request():
+    g.request_metrics = RequestMetrics()
+
+def _finish_request(response):
+    request_metrics = g.get('request_metrics')
+    if request_metrics is None:
+        return response
+    request_metrics.endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    request_metrics.method = request.method
+    app = current_app._get_current_object()
+    status = response.status_code
+    size = response.content_length
+
+    def done():
+        # Called once the body has been sent, after the request context is gone.
+        duration = time.perf_counter() - request_metrics.start
+        metrics = app.extensions['metrics']
+        metrics.record(request_metrics, status, size, duration)
+        with app.app_context():
+            if duration >= app.config['SLOW_REQUEST_SECONDS']:
+                log_slow_request(request_metrics, status, duration)
+            metrics.flush(_redis())
+
+    response.call_on_close(done)
+    return response
+
+def log_slow_request(request_metrics, status, duration):
+    slowest = sorted(request_metrics.statement_timings, reverse=True)[:SLOW_STATEMENTS_LOGGED]
+    lines = [f"Slow request: {request_metrics.method} {request_metrics.endpoint} {status} took {duration * 1000:.0f} ms, "
+             f"{request_metrics.statements} SQL statements in {request_metrics.sql_duration * 1000:.0f} ms"]
+    lines += [f"  {statement_duration * 1000:8.1f} ms  {' '.join(statement.split())}" for statement_duration, statement in slowest]
+    current_app.logger.warning("\n".join(lines))
+
+def init_request_metrics(app):
+    """Instrument the requests and database engine of `app`. Call before any other before_request function."""
+    app.extensions['metrics'] = Metrics()
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def render_metrics():
+    """All the request and job metrics, in the Prometheus text format."""
+    r = _redis()
+    metrics = current_app.extensions['metrics']
+    metrics.flush(r, force=True)
+    counts = {}
+    try:
+        if r is not None:
+            counts = {field.decode('utf-8'): float(value) for field, value in r.hgetall(METRICS_KEY).items()}
+    except RedisError:
+        pass
+    for field, value in metrics.pending().items():
+        counts[field] = counts.get(field, 0) + value
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        lines += [f"{name}{{{field.split('|')[1]}}} {_format_value(value)}"
+                  for field, value in sorted(counts.items()) if field.startswith(name + '|')]
+    for name, (buckets, help_text) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for series in sorted(field.split('|')[1] for field in counts if field.startswith(f"{name}_count|")):
+            # Every bucket, so quantiles can be estimated from any series.
+            for bound in buckets + ['+Inf']:
+                lines.append(f'{name}_bucket{{{series},le="{bound}"}} {_format_value(counts.get(f"{name}_bucket|{series}|{bound}", 0))}')
+            lines.append(f"{name}_sum{{{series}}} {_format_value(counts[f'{name}_sum|{series}|'])}")
+            lines.append(f"{name}_count{{{series}}} {_format_value(counts[f'{name}_count|{series}|'])}")
+    return "\n".join(lines) + "\n"
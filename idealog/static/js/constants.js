@@ -2,10 +2,15 @@ const pathname = window.location.pathname;
 const segments = pathname.split('/');
 
 let graphUrl;
+let clustersUrl;
 
 if (segments.length > 2) {
     const knowledgeBaseId = segments.pop();
-    graphUrl = `/api/knowledge-bases/${knowledgeBaseId}?authorized=authorized`;
+    // The graph only draws entity names and head/type/tail at their precomputed positions,
+    // so skip summaries, meta and sources.
+    graphUrl = `/api/knowledge-bases/${knowledgeBaseId}?authorized=authorized&fields=layout`;
+    // Level-of-detail view: large KBs arrive as clusters that expand on click.
+    clustersUrl = `/api/knowledge-bases/${knowledgeBaseId}/clusters?authorized=authorized`;
 } else {
     graphUrl = '/api/knowledge-bases?content=latest&authorized=authorized';
 }
@@ -15,7 +15,7 @@ async function fetchDataAndCreateGraph(url) {
 
         // Create nodes for entities
         var nodes = kb.entities.map(function (entity) {
-            return { id: entity, type: "entity" };
+            return placeNode({ id: entity, type: "entity" }, response.data.entities[entity]);
         });
 
         // Create links for relations
@@ -84,7 +84,7 @@ async function fetchDataAndCreateGraph(url) {
             d.fy = null;
         }
 
-        simulation.on("tick", function () {
+        function ticked() {
             link
                 .attr("x1", function (d) { return d.source.x; })
                 .attr("y1", function (d) { return d.source.y; })
@@ -104,7 +104,9 @@ async function fetchDataAndCreateGraph(url) {
             linkLabel
                 .attr("x", function (d) { return (d.source.x + d.target.x) / 2; })
                 .attr("y", function (d) { return (d.source.y + d.target.y) / 2; });
-        });
+        }
+
+        startSimulation(simulation, nodes, ticked);
     } catch (error) {
         console.error('Error fetching data:', error);
     }
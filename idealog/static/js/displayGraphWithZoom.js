@@ -1,17 +1,57 @@
-async function fetchDataAndCreateGraph(url) {
-    let kb;
+// Nodes and links of a full or sliced KB payload.
+function entityGraph(data) {
+    var nodes = Object.keys(data.entities).map(function (entity) {
+        return placeNode({ id: entity, label: entity, type: "entity" }, data.entities[entity]);
+    });
+
+    var links = data.relations.map(function (relation) {
+        return {
+            source: relation.head,
+            target: relation.tail,
+            type: relation.type
+        };
+    });
+    return { nodes: nodes, links: links };
+}
 
-    try {
-        const response = await axios.get(url);
-        const entityKeys = Object.keys(response.data.entities);
-        const relations = response.data.relations;
-        kb = {
-            entities: entityKeys,
-            relations: relations
+// Nodes and links of a level-of-detail view from the clusters API.
+function clusterGraph(data) {
+    var nodes = data.nodes.map(function (item) {
+        return placeNode({
+            id: item.id,
+            label: item.level > 0 ? `${item.label} (+${item.size - 1})` : item.label,
+            type: item.level > 0 ? "cluster" : "entity",
+            size: item.size
+        }, item);
+    });
+
+    var links = data.links.map(function (item) {
+        return {
+            source: item.source,
+            target: item.target,
+            type: item.type !== undefined ? item.type : `${item.weight} relations`
         };
+    });
+    return { nodes: nodes, links: links };
+}
+
+async function fetchDataAndCreateGraph(url) {
+    try {
+        let response;
+        try {
+            response = await axios.get(url);
+        } catch (error) {
+            // A KB's clusters are built after it is stored; until then draw its graph directly.
+            if (url !== clustersUrl || !error.response || error.response.status !== 404) {
+                throw error;
+            }
+            response = await axios.get(graphUrl);
+        }
+        var graph = response.data.nodes ? clusterGraph(response.data) : entityGraph(response.data);
 
-        // Create the graph using kb
+        // Create the graph, replacing the previous one when a cluster is expanded
         var svg = d3.select("svg");
+        svg.selectAll("*").remove();
 
         // Define a 'g' element that will contain all graph elements
         var g = svg.append("g");
@@ -26,19 +66,8 @@ async function fetchDataAndCreateGraph(url) {
         // Apply zoom behavior to the SVG
         svg.call(zoom);
 
-        // Create nodes for entities
-        var nodes = kb.entities.map(function (entity) {
-            return { id: entity, type: "entity" };
-        });
-
-        // Create links for relations
-        var links = kb.relations.map(function (relation) {
-            return {
-                source: relation.head,
-                target: relation.tail,
-                type: relation.type
-            };
-        });
+        var nodes = graph.nodes;
+        var links = graph.links;
 
         var simulation = d3.forceSimulation(nodes)
             .force("link", d3.forceLink(links).id(function (d) { return d.id; }))
@@ -61,14 +90,21 @@ async function fetchDataAndCreateGraph(url) {
             .data(nodes)
             .enter().append("circle")
             .attr("class", function (d) { return "node " + d.type; })
-            .attr("r", 10);
+            .attr("r", function (d) { return d.type === "cluster" ? 10 + Math.sqrt(d.size) : 10; });
+
+        // Clicking a cluster expands it into its members
+        node.filter(function (d) { return d.type === "cluster"; })
+            .style("cursor", "pointer")
+            .on("click", function (event, d) {
+                fetchDataAndCreateGraph(`${clustersUrl}&cluster=${encodeURIComponent(d.id)}`);
+            });
 
         // Add labels for nodes
         var nodeLabel = g.selectAll(".node-label")
             .data(nodes)
             .enter().append("text")
             .attr("class", "node-label")
-            .text(function (d) { return d.id; });
+            .text(function (d) { return d.label; });
 
         // Define the drag behavior
         var drag = d3.drag()
@@ -97,7 +133,7 @@ async function fetchDataAndCreateGraph(url) {
             d.fy = null;
         }
 
-        simulation.on("tick", function () {
+        function ticked() {
             link
                 .attr("x1", function (d) { return d.source.x; })
                 .attr("y1", function (d) { return d.source.y; })
@@ -117,12 +153,14 @@ async function fetchDataAndCreateGraph(url) {
             linkLabel
                 .attr("x", function (d) { return (d.source.x + d.target.x) / 2; })
                 .attr("y", function (d) { return (d.source.y + d.target.y) / 2; });
-        });
+        }
+
+        startSimulation(simulation, nodes, ticked);
     } catch (error) {
         console.error('Error fetching data:', error);
     }
 }
 
 
-url = graphUrl
+url = clustersUrl || graphUrl
 fetchDataAndCreateGraph(url);
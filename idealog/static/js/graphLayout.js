@@ -0,0 +1,21 @@
+// Drawing graphs at the layout precomputed on the server (see graph_layout.py).
+// KBs whose layout isn't built yet come without positions and are laid out by the simulation.
+
+// Place a node at the position the API gave it, centred on the SVG.
+function placeNode(node, position) {
+    if (position.x !== undefined) {
+        node.x = 350 + position.x;
+        node.y = 350 + position.y;
+    }
+    return node;
+}
+
+// Redraw with `ticked` on every tick. Nodes that already sit at their final layout are drawn
+// once instead of being simulated from scratch; dragging restarts the simulation as usual.
+function startSimulation(simulation, nodes, ticked) {
+    simulation.on("tick", ticked);
+    if (nodes.length > 0 && nodes.every(function (d) { return d.x !== undefined; })) {
+        simulation.stop();
+        ticked();
+    }
+}
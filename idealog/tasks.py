@@ -1,50 +1,299 @@
+import os
 import time
+from datetime import datetime
 
 from celery import shared_task, Task
+from flask import current_app
+from sqlalchemy import insert
 
-from idealog.models import db, KnowledgeBase
+from idealog.models import db, KnowledgeBase, KnowledgeSource, KnowledgeSourceKnowledgeDomain, DocumentExtract, load_texts
+from idealog.article_fetcher import fetch_articles
+from idealog.file_ingest import file_documents
+from idealog.uploads import batch_path
+from idealog.kb_merge import merge_knowledge_base_payloads
+from idealog.kb_views import build_graph_views
+from idealog.kb_trace import trace_job, finish_trace, stage, count
+from idealog.kb_refresh import (DOCUMENT_MODELS, document_key, parse_document_key, take_pending_documents,
+                                enqueue_documents, schedule_refresh, add_changed_urls, take_changed_urls,
+                                global_knowledge_base, patch_payload)
 from idealog.ml_functions import class_kb
 from idealog.ml_functions.class_kb import from_text_to_kb
 
-tokenizer = class_kb.tokenizer
-model = class_kb.model
 
 @shared_task(ignore_result=False)
 def add(a: int, b: int) -> int:
     time.sleep(5)
     return a + b
 
-@shared_task(ignore_result=False, time_limit=420)
+def store_kb(knowledge_base, kb):
+    """Serialize `kb` into `knowledge_base` and mark it ready."""
+    count('kb_entities', len(kb.entities))
+    count('kb_relations', len(kb.relations))
+    with stage('serialization'):
+        payload = kb.to_json()
+    with stage('storing'):
+        knowledge_base.set_json_object(payload)
+    knowledge_base.status = 'ready'
+
+def commit_kb(knowledge_base, trace):
+    """Commit a stored KB, then build its graph views: the payload is served while they are computed."""
+    db.session.commit()
+    with stage('graph_views'):
+        build_graph_views(knowledge_base)
+    knowledge_base.build_trace = finish_trace(trace)
+    db.session.commit()
+
+def keep_failed_trace(kb_id, trace, error):
+    """Store the trace of a job that failed on its knowledge base, so it shows where the time went."""
+    result = finish_trace(trace, error)
+    if result is None:
+        return
+    try:
+        knowledge_base = db.session.get(KnowledgeBase, kb_id)
+        if knowledge_base is not None:
+            knowledge_base.build_trace = result
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+
+# The soft time limits leave time to store the trace of a job that runs out of time.
+@shared_task(ignore_result=False, time_limit=420, soft_time_limit=400)
 def create_kb(kb_id: int):
+    with trace_job('create_kb') as trace:
+        try:
+            knowledge_base = db.session.query(KnowledgeBase).get(kb_id)
+
+            if knowledge_base:
+                with stage('load'):
+                    ideas = knowledge_base.ideas
+                    knowledge_sources = knowledge_base.knowledge_sources
+
+                    idea_groups = knowledge_base.idea_groups
+                    ideas_from_groups=[]
+                    for idea_group in idea_groups:
+                        ideas_from_groups.extend(idea_group.ideas)
+
+                    domains = knowledge_base.knowledge_domains
+                    knowledge_sources_from_domains = []
+                    for domain in domains:
+                        knowledge_sources_from_domains.extend(domain.knowledge_sources)
+
+                    merged_ideas = load_texts(ideas + knowledge_sources + ideas_from_groups + knowledge_sources_from_domains)
+                count('texts', len(merged_ideas))
+
+                kb = class_kb.from_ideas_to_kb(merged_ideas,verbose=False)
+
+                store_kb(knowledge_base, kb)
+                commit_kb(knowledge_base, trace)
+
+                return kb_id
+            else:
+                raise ValueError('Could not find the knowledge_base')
+
+        except Exception as e:
+            db.session.rollback()
+            keep_failed_trace(kb_id, trace, e)
+            return str(e)
+
+@shared_task(ignore_result=False, time_limit=420, soft_time_limit=400)
+def merge_kbs(kb_id: int, source_kb_ids: list):
+    """Fill knowledge base `kb_id` with the merged payloads of `source_kb_ids`."""
+    with trace_job('merge_kbs') as trace:
+        try:
+            knowledge_base = db.session.query(KnowledgeBase).get(kb_id)
+
+            if knowledge_base:
+                # One payload in memory at a time; the column query keeps the
+                # source rows out of the session.
+                payloads = (db.session.query(KnowledgeBase.json_object).filter(KnowledgeBase.id == source_kb_id).scalar()
+                            for source_kb_id in source_kb_ids)
+                with stage('merge'):
+                    payload = merge_knowledge_base_payloads(payloads)
+                with stage('storing'):
+                    knowledge_base.set_json_object(payload)
+                knowledge_base.status = 'ready'
+                commit_kb(knowledge_base, trace)
+
+                return kb_id
+            else:
+                raise ValueError('Could not find the knowledge_base')
+
+        except Exception as e:
+            db.session.rollback()
+            keep_failed_trace(kb_id, trace, e)
+            return str(e)
+
+@shared_task(ignore_result=False, time_limit=1800, soft_time_limit=1780)
+def create_kb_from_query(kb_id: int, query: str, pages: int):
+    """Fill knowledge base `kb_id` with the relations in the news articles found for `query` (see kb_pipeline.py)."""
+    with trace_job('create_kb_from_query') as trace:
+        try:
+            knowledge_base = db.session.query(KnowledgeBase).get(kb_id)
+
+            if knowledge_base:
+                kb = class_kb.from_query_to_kb(query, pages=pages)
+                store_kb(knowledge_base, kb)
+                commit_kb(knowledge_base, trace)
+
+                return kb_id
+            else:
+                raise ValueError('Could not find the knowledge_base')
+
+        except Exception as e:
+            db.session.rollback()
+            keep_failed_trace(kb_id, trace, e)
+            return str(e)
+
+@shared_task(ignore_result=False, time_limit=420)
+def refresh_global_kb():
+    """Extract the ideas and knowledge sources changed since the last run, and patch the global
+    knowledge base with them once there are none left."""
     try:
-        knowledge_base = db.session.query(KnowledgeBase).get(kb_id)
-
-        if knowledge_base:
-            ideas = knowledge_base.ideas
-            knowledge_sources = knowledge_base.knowledge_sources
-
-            idea_groups = knowledge_base.idea_groups
-            ideas_from_groups=[]
-            for idea_group in idea_groups:
-                ideas_from_groups.extend(idea_group.ideas)
-
-            domains = knowledge_base.knowledge_domains
-            knowledge_sources_from_domains = []
-            for domain in domains:
-                knowledge_sources_from_domains.extend(domain.knowledge_sources)
-                 
-            merged_ideas = ideas + knowledge_sources + ideas_from_groups + knowledge_sources_from_domains
-            
-            kb = class_kb.from_ideas_to_kb(merged_ideas,verbose=False)
-
-            knowledge_base.json_object = kb.to_json()
-            knowledge_base.status = 'ready'
+        keys, more = take_pending_documents(current_app.config['KB_REFRESH_BATCH_SIZE'])
+        if keys:
+            urls = set()
+            for key in keys:
+                document_type, document_id = parse_document_key(key)
+                model = DOCUMENT_MODELS[document_type]
+                extract = DocumentExtract.query.filter_by(document_type=document_type, document_id=document_id).first()
+                if extract is not None:
+                    urls.add(extract.url)
+
+                document = model.query.options(db.undefer(model.text)).filter_by(id=document_id).first()
+                if document is None:
+                    if extract is not None:
+                        db.session.delete(extract)
+                    continue
+
+                try:
+                    kb = class_kb.from_idea_to_kb(document)
+                except Exception:
+                    # Keep the previous extract; the next change to the document retries it.
+                    continue
+                if extract is None:
+                    extract = DocumentExtract(document_type=document_type, document_id=document_id)
+                    db.session.add(extract)
+                extract.url = document.url
+                extract.json_object = kb.to_json()
+                urls.add(document.url)
+
             db.session.commit()
+            add_changed_urls(urls)
 
-            return kb_id
+        if more:
+            schedule_refresh(countdown=0)
         else:
+            patch_global_kb()
+        return len(keys)
+
+    except Exception as e:
+        db.session.rollback()
+        return str(e)
+
+def patch_global_kb():
+    """Patch the global knowledge base with the stored extracts of every url changed since its last patch."""
+    urls = take_changed_urls()
+    if not urls:
+        return
+    try:
+        knowledge_base = global_knowledge_base()
+        extracts = db.session.query(DocumentExtract.json_object).filter(DocumentExtract.url.in_(urls)).all()
+        knowledge_base.set_json_object(patch_payload(knowledge_base.json_object, urls, [row[0] for row in extracts]))
+        knowledge_base.status = 'ready'
+        db.session.commit()
+    except Exception:
+        # Left for the next run to patch.
+        add_changed_urls(urls)
+        raise
+    build_graph_views(knowledge_base)
+    db.session.commit()
+
+@shared_task(ignore_result=False, time_limit=600)
+def build_kb_graph_views(kb_id: int):
+    """Build the graph views of a knowledge base stored outside a job (see kb_views.py)."""
+    try:
+        knowledge_base = db.session.get(KnowledgeBase, kb_id)
+        if knowledge_base is None or knowledge_base.graph_index is None:
             raise ValueError('Could not find the knowledge_base')
+        build_graph_views(knowledge_base)
+        db.session.commit()
+        return kb_id
+
+    except Exception as e:
+        db.session.rollback()
+        return str(e)
+
+KNOWLEDGE_SOURCE_BATCH_SIZE = 100
+KNOWLEDGE_SOURCE_BATCH_BYTES = 8 * 1024 * 1024
+
+def insert_knowledge_sources(articles, user_id, privacy, knowledge_domain_ids):
+    """Bulk insert parsed articles (see article_fetcher.parse_article) as knowledge sources. Returns their ids."""
+    rows = [dict(
+        name=article["name"],
+        text=article["text"],
+        url=article["url"],
+        publish_date=datetime.fromisoformat(article["publish_date"]) if article["publish_date"] else datetime.utcnow(),
+        privacy=privacy,
+        creation_mode='automated',
+        user_id=user_id,
+    ) for article in articles]
+    ids = db.session.scalars(insert(KnowledgeSource).returning(KnowledgeSource.id), rows).all()
+    if knowledge_domain_ids:
+        db.session.execute(insert(KnowledgeSourceKnowledgeDomain), [
+            dict(knowledge_source_id=knowledge_source_id, knowledge_domain_id=knowledge_domain_id)
+            for knowledge_source_id in ids for knowledge_domain_id in knowledge_domain_ids
+        ])
+    db.session.commit()
+    # Bulk inserts skip the mapper events that tell the global KB about new documents.
+    enqueue_documents([document_key('knowledge_source', knowledge_source_id) for knowledge_source_id in ids])
+    return ids
+
+def store_knowledge_sources(articles, user_id, privacy, knowledge_domain_ids):
+    """Insert an iterable of articles in batches of at most KNOWLEDGE_SOURCE_BATCH_SIZE articles or
+    KNOWLEDGE_SOURCE_BATCH_BYTES of text, so memory stays flat however many there are. Returns how many were added."""
+    added = 0
+    batch = []
+    batch_bytes = 0
+    for article in articles:
+        batch.append(article)
+        batch_bytes += len(article["text"])
+        if len(batch) == KNOWLEDGE_SOURCE_BATCH_SIZE or batch_bytes >= KNOWLEDGE_SOURCE_BATCH_BYTES:
+            added += len(insert_knowledge_sources(batch, user_id, privacy, knowledge_domain_ids))
+            batch = []
+            batch_bytes = 0
+    if batch:
+        added += len(insert_knowledge_sources(batch, user_id, privacy, knowledge_domain_ids))
+    return added
+
+@shared_task(ignore_result=False, time_limit=1800)
+def fetch_knowledge_sources(urls: list, user_id: int, privacy: str, knowledge_domain_ids: list):
+    """Download the articles at `urls` and store them as knowledge sources, a batch at a time as they arrive.
+
+    Urls that already have a knowledge source are skipped, as are pages without any article text.
+    """
+    try:
+        existing = {row[0] for row in db.session.query(KnowledgeSource.url).filter(KnowledgeSource.url.in_(urls))}
+        articles = (result.article for result in fetch_articles(url for url in urls if url not in existing)
+                    if result.article is not None and result.article["text"].strip())
+        return store_knowledge_sources(articles, user_id, privacy, knowledge_domain_ids)
+
+    except Exception as e:
+        db.session.rollback()
+        return str(e)
+
+@shared_task(ignore_result=False, time_limit=3600)
+def ingest_knowledge_source_files(batch: str, files: list, user_id: int, privacy: str, knowledge_domain_ids: list):
+    """Split uploaded files into documents (see file_ingest.py) and store them as knowledge sources.
+
+    `files` are [file name, uploaded name] pairs of the files of upload `batch` (see uploads.py). The web
+    app saved them and removes them once this task has finished.
+    """
+    try:
+        if not os.path.isdir(batch_path(batch)):
+            return f"Upload {batch} is not in {current_app.config['UPLOAD_DIR']}; is UPLOAD_DIR shared with the web app?"
+        documents = (document for file_name, name in files for document in file_documents(batch_path(batch, file_name), name))
+        return store_knowledge_sources(documents, user_id, privacy, knowledge_domain_ids)
 
     except Exception as e:
         db.session.rollback()
-        return str(e)
\ No newline at end of file
+        return str(e)
@@ -0,0 +1,54 @@
+"""Uploaded files handed from the web app to the Celery workers.
+
+Uploads are saved under UPLOAD_DIR, one directory per batch, and the worker
+reads them from there. In a deployment UPLOAD_DIR must therefore be storage
+shared by the web and worker containers (the `uploads` volume in
+compose.yaml). Files are named relative to UPLOAD_DIR, so it may be mounted
+at a different path on each side.
+
+A batch is named after the id of the Celery task that ingests it. The web app
+wrote the files, so it is the one that removes them: before each new upload it
+removes the batches whose task has finished. Task results expire, after which
+a finished task looks like a queued one, so batches older than UPLOAD_MAX_AGE
+are removed as well.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from flask import current_app
+from redis.exceptions import RedisError
+from werkzeug.utils import secure_filename
+
+def batch_path(batch, file_name=''):
+    """Path of the directory of `batch`, or of `file_name` in it, under UPLOAD_DIR."""
+    return os.path.join(current_app.config['UPLOAD_DIR'], batch, file_name)
+
+def save_uploads(uploads):
+    """Save werkzeug file uploads as a new batch; returns its name and [file name, uploaded name] pairs."""
+    batch = uuid.uuid4().hex
+    os.makedirs(batch_path(batch))
+    files = []
+    for number, upload in enumerate(uploads):
+        name = secure_filename(upload.filename) or f"upload-{number}"
+        file_name = f"{number}-{name}"
+        # Copied in chunks from werkzeug's spooled temporary file.
+        upload.save(batch_path(batch, file_name))
+        files.append([file_name, name])
+    return batch, files
+
+def remove_finished_batches(task):
+    """Remove the batches whose run of `task` has finished, or that are older than UPLOAD_MAX_AGE."""
+    root = current_app.config['UPLOAD_DIR']
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - current_app.config['UPLOAD_MAX_AGE']
+    for batch in os.listdir(root):
+        try:
+            finished = os.path.getmtime(batch_path(batch)) < cutoff or task.AsyncResult(batch).ready()
+        except (OSError, RedisError):
+            # Gone already, or the result backend is down: look again next time.
+            continue
+        if finished:
+            shutil.rmtree(batch_path(batch), ignore_errors=True)
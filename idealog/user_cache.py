@@ -0,0 +1,82 @@
+"""Cache of the logged-in user's identity.
+
+`add_user_to_g` runs on every request, including the JS and API fetches, so the
+handful of user columns the views and templates actually read are kept in Redis
+for `USER_CACHE_TTL` seconds instead of being queried each time. Anything else
+(relationships such as `g.user.ideas`) falls through to a real `User` row,
+loaded on first access. Views that change a user must call
+`invalidate_cached_user` after committing.
+"""
+import json
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from idealog.models import db, User
+
+USER_CACHE_COLUMNS = ['id', 'username', 'email', 'image_url', 'user_type']
+
+def _cache_key(user_id):
+    return f"idealog:user:{user_id}"
+
+class CachedUser():
+    """Snapshot of a user's columns that loads the full `User` row only when needed."""
+
+    def __init__(self, data, user=None):
+        self.__dict__.update(data)
+        self.__dict__['_user'] = user
+
+    @property
+    def is_admin(self):
+        return self.user_type == 'admin'
+
+    def load(self):
+        """Return the `User` row this snapshot was taken from."""
+        if self.__dict__['_user'] is None:
+            self.__dict__['_user'] = db.session.get(User, self.id)
+        return self.__dict__['_user']
+
+    def __getattr__(self, name):
+        # Only called for attributes missing from the snapshot.
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CachedUser #{self.id}: {self.username}, {self.email}, type={self.user_type}>"
+
+def _redis():
+    if not current_app.config.get('USER_CACHE_TTL'):
+        return None
+    return current_app.extensions.get('redis')
+
+def get_cached_user(user_id):
+    """Return a `CachedUser` for `user_id`, or None if the user no longer exists."""
+    r = _redis()
+    if r is not None:
+        try:
+            cached = r.get(_cache_key(user_id))
+            if cached:
+                return CachedUser(json.loads(cached))
+        except RedisError:
+            r = None
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+
+    data = {column: getattr(user, column) for column in USER_CACHE_COLUMNS}
+    if r is not None:
+        try:
+            r.set(_cache_key(user_id), json.dumps(data), ex=current_app.config['USER_CACHE_TTL'])
+        except RedisError:
+            pass
+    return CachedUser(data, user)
+
+def invalidate_cached_user(user_id):
+    """Drop the cached snapshot of `user_id` so the next request reloads it."""
+    r = _redis()
+    if r is None:
+        return
+    try:
+        r.delete(_cache_key(user_id))
+    except RedisError:
+        pass
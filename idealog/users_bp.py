@@ -1,7 +1,12 @@
-from flask import Flask, render_template, redirect, flash, session, g, request, jsonify, Blueprint, url_for
+import hmac
+from flask import Flask, Response, render_template, redirect, flash, session, g, request, jsonify, Blueprint, url_for, current_app
 from .helpers import requires_login, requires_admin
 from idealog.models import db, User, Idea, Group, KnowledgeSource, KnowledgeDomain, KnowledgeBase
-from idealog.forms import UserEditForm, UserAddForm
+from redis.exceptions import RedisError
+from idealog.forms import UserEditForm, UserAddForm, ProfileForm
+from idealog.user_cache import invalidate_cached_user
+from idealog.request_metrics import render_metrics
+from idealog.profiler import list_workers, request_profile, list_profiles, profile_stacks
 
 bp = Blueprint('users_bp', __name__)
 
@@ -11,15 +16,17 @@ bp = Blueprint('users_bp', __name__)
 @requires_login
 def profile():
     """Update profile for current user."""    
-    form = UserEditForm(obj=g.user)
+    user = g.user.load()
+    form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        g.user.username = form.username.data
-        g.user.email = form.email.data
-        g.user.image_url = form.image_url.data
+        user.username = form.username.data
+        user.email = form.email.data
+        user.image_url = form.image_url.data
         authenticate_user = User.authenticate(form.username.data, form.password.data)
         if authenticate_user:
             db.session.commit()
+            invalidate_cached_user(user.id)
             flash("Successfully saved changes.", "success")
         else:
             flash("Access unauthorized.", "danger")
@@ -96,6 +103,7 @@ def edit_user(user_id):
         user.password = User.hash_existing(form.password.data)
 
         db.session.commit()
+        invalidate_cached_user(user_id)
         flash("Successfully saved changes.", "success")
 
         return redirect(url_for('users_bp.user_show', user_id=user_id))
@@ -110,6 +118,7 @@ def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     db.session.delete(user)
     db.session.commit()
+    invalidate_cached_user(user_id)
 
     return redirect(url_for('users_bp.list_users'))
 
@@ -122,7 +131,7 @@ def search_results():
 
     # Check user status
     if g.user:
-        if 'admin' in g.user.user_type:
+        if g.user.is_admin:
             # Admin: Show all entries
             ideas = Idea.query.filter(Idea.name.ilike(query)).all()
             groups = Group.query.filter(Group.name.ilike(query)).all()
@@ -146,8 +155,49 @@ def search_results():
 
     return render_template('searches/home_search.html', ideas=ideas, groups=groups, knowledge_sources=knowledge_sources, knowledge_domains=knowledge_domains, knowledge_bases=knowledge_bases)
 
-@bp.route('/admin')
+@bp.route('/admin', methods=["GET", "POST"])
 @requires_login
 @requires_admin
 def render_admin_index():
-    return redirect(url_for('users_bp.list_users'))
\ No newline at end of file
+    """Admin page: links to the admin features, and profiling of the web and Celery workers (see profiler.py)."""
+    form = ProfileForm()
+    try:
+        workers = list_workers()
+        profiles = list_profiles()
+    except RedisError:
+        flash("Profiling needs Redis, which is unavailable.", "danger")
+        workers, profiles = {}, []
+    form.worker.choices = [(worker_id, f"{worker_id} (since {info['started']})") for worker_id, info in workers.items()]
+
+    if form.validate_on_submit():
+        try:
+            request_profile(form.worker.data, form.seconds.data)
+            flash(f"Profiling {form.worker.data} for {form.seconds.data} s.", "success")
+        except RedisError:
+            flash("Profiling needs Redis, which is unavailable.", "danger")
+        return redirect(url_for('users_bp.render_admin_index'))
+
+    return render_template('admin/index.html', form=form, profiles=profiles)
+
+@bp.route('/admin/profiles/<profile_id>')
+@requires_login
+@requires_admin
+def download_profile(profile_id):
+    """Collapsed stacks of a profile, for flamegraph.pl or speedscope."""
+    try:
+        stacks = profile_stacks(profile_id)
+    except RedisError:
+        stacks = None
+    if stacks is None:
+        return {"error": "Profile not found"}, 404
+    return Response(stacks, mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename=profile-{profile_id}.folded'})
+
+@bp.route('/admin/metrics')
+def render_admin_metrics():
+    """Request and knowledge base job metrics in the Prometheus text format, for admins and for scrapers sending the METRICS_TOKEN."""
+    token = current_app.config.get('METRICS_TOKEN')
+    scraper = token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    if not scraper and not (g.user and g.user.is_admin):
+        return {"error": "Admin access required"}, 403
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -1,5 +1,8 @@
 from flask import Flask, render_template, redirect, request, flash, session, g, jsonify, Blueprint, url_for
+from markupsafe import Markup
+from sqlalchemy.orm import load_only
 from .helpers import requires_login, requires_admin
+from .fragment_cache import cached_fragment, GUEST_KB_LIST_KEY
 from idealog.models import db, User, Idea, Group, KnowledgeSource, KnowledgeDomain, KnowledgeBase
 from . import tasks
 
@@ -15,9 +18,17 @@ def homepage():
         return render_template('users/registered_home.html', user=user)
 
     else:
-        knowledge_bases = KnowledgeBase.query.filter((KnowledgeBase.privacy == 'public')).all()
+        guest_kb_list = cached_fragment(GUEST_KB_LIST_KEY, render_guest_kb_list)
 
-        return render_template('users/guest_home.html', knowledge_bases=knowledge_bases)
+        return render_template('users/guest_home.html', guest_kb_list=Markup(guest_kb_list))
+
+def render_guest_kb_list():
+    """Render the list of public knowledge bases shown to every guest."""
+    knowledge_bases = (KnowledgeBase.query
+                       .options(load_only(KnowledgeBase.id, KnowledgeBase.name, KnowledgeBase.privacy, KnowledgeBase.creation_mode))
+                       .filter((KnowledgeBase.privacy == 'public'))
+                       .all())
+    return render_template('users/guest_kb_list.html', knowledge_bases=knowledge_bases)
 
 
 ##############################################################################
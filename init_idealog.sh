@@ -66,6 +66,14 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL,
     json_object JSON,
+    json_etag TEXT,
+    json_gzip BYTEA,
+    json_br BYTEA,
+    graph_index JSON,
+    graph_layout JSON,
+    graph_clusters JSON,
+    graph_analytics JSON,
+    build_trace JSON,
     date_created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     privacy TEXT NOT NULL DEFAULT 'private',
     status TEXT NOT NULL DEFAULT 'pending',
@@ -73,6 +81,49 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     user_id INTEGER REFERENCES users(id) ON DELETE CASCADE
     );
 
+    CREATE TABLE document_extracts (
+    id SERIAL PRIMARY KEY,
+    document_type TEXT NOT NULL,
+    document_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    json_object JSON,
+    date_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_document_extracts UNIQUE (document_type, document_id)
+    );
+
+    CREATE TABLE kb_entities (
+    knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE,
+    entity_id INTEGER,
+    name TEXT NOT NULL,
+    url TEXT,
+    PRIMARY KEY (knowledge_base_id, entity_id)
+    );
+
+    CREATE TABLE kb_relations (
+    knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE,
+    relation_id INTEGER,
+    head INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    tail INTEGER NOT NULL,
+    PRIMARY KEY (knowledge_base_id, relation_id)
+    );
+
+    CREATE TABLE kb_provenance (
+    id SERIAL PRIMARY KEY,
+    knowledge_base_id INTEGER NOT NULL REFERENCES knowledge_bases(id) ON DELETE CASCADE,
+    relation_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    span_start INTEGER,
+    span_end INTEGER
+    );
+
+    CREATE TABLE kb_sources (
+    knowledge_base_id INTEGER REFERENCES knowledge_bases(id) ON DELETE CASCADE,
+    url TEXT,
+    source JSON,
+    PRIMARY KEY (knowledge_base_id, url)
+    );
+
     CREATE TABLE tags (
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL
@@ -138,6 +189,47 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-E
     tag_id INTEGER REFERENCES tags(id) ON DELETE CASCADE
     );
 
+    CREATE INDEX ix_document_extracts_url ON document_extracts (url);
+    CREATE INDEX ix_kb_entities_name ON kb_entities (name);
+    CREATE INDEX ix_kb_relations_type ON kb_relations (type);
+    CREATE INDEX ix_kb_relations_head ON kb_relations (knowledge_base_id, head);
+    CREATE INDEX ix_kb_relations_tail ON kb_relations (knowledge_base_id, tail);
+    CREATE INDEX ix_kb_provenance_relation ON kb_provenance (knowledge_base_id, relation_id);
+    CREATE INDEX ix_kb_provenance_url ON kb_provenance (url);
+    CREATE INDEX ix_ideas_user_id ON ideas (user_id);
+    CREATE INDEX ix_ideas_public ON ideas (id) WHERE privacy = 'public';
+    CREATE INDEX ix_groups_user_id ON groups (user_id);
+    CREATE INDEX ix_groups_public ON groups (id) WHERE privacy = 'public';
+    CREATE INDEX ix_knowledge_sources_user_id ON knowledge_sources (user_id);
+    CREATE INDEX ix_knowledge_sources_public ON knowledge_sources (id) WHERE privacy = 'public';
+    CREATE INDEX ix_knowledge_sources_url ON knowledge_sources (url);
+    ALTER TABLE knowledge_bases ALTER COLUMN json_gzip SET STORAGE EXTERNAL;
+    ALTER TABLE knowledge_bases ALTER COLUMN json_br SET STORAGE EXTERNAL;
+    CREATE INDEX ix_knowledge_domains_user_id ON knowledge_domains (user_id);
+    CREATE INDEX ix_knowledge_domains_public ON knowledge_domains (id) WHERE privacy = 'public';
+    CREATE INDEX ix_knowledge_bases_user_id ON knowledge_bases (user_id);
+    CREATE INDEX ix_knowledge_bases_public ON knowledge_bases (id) WHERE privacy = 'public';
+    CREATE INDEX ix_artifacts_idea_id ON artifacts (idea_id);
+
+    ALTER TABLE user_knowledge_bases ADD CONSTRAINT uq_user_knowledge_bases UNIQUE (user_id, knowledge_base_id);
+    CREATE INDEX ix_user_knowledge_bases_knowledge_base_id ON user_knowledge_bases (knowledge_base_id);
+    ALTER TABLE idea_groups ADD CONSTRAINT uq_idea_groups UNIQUE (idea_id, group_id);
+    CREATE INDEX ix_idea_groups_group_id ON idea_groups (group_id);
+    ALTER TABLE connections ADD CONSTRAINT uq_connections UNIQUE (idea_id_1, idea_id_2);
+    CREATE INDEX ix_connections_idea_id_2 ON connections (idea_id_2);
+    ALTER TABLE knowledge_source_knowledge_domains ADD CONSTRAINT uq_knowledge_source_knowledge_domains UNIQUE (knowledge_source_id, knowledge_domain_id);
+    CREATE INDEX ix_knowledge_source_knowledge_domains_knowledge_domain_id ON knowledge_source_knowledge_domains (knowledge_domain_id);
+    ALTER TABLE knowledge_base_groups ADD CONSTRAINT uq_knowledge_base_groups UNIQUE (knowledge_base_id, idea_group_id);
+    CREATE INDEX ix_knowledge_base_groups_idea_group_id ON knowledge_base_groups (idea_group_id);
+    ALTER TABLE knowledge_base_knowledge_domains ADD CONSTRAINT uq_knowledge_base_knowledge_domains UNIQUE (knowledge_base_id, knowledge_domain_id);
+    CREATE INDEX ix_knowledge_base_knowledge_domains_knowledge_domain_id ON knowledge_base_knowledge_domains (knowledge_domain_id);
+    ALTER TABLE knowledge_base_ideas ADD CONSTRAINT uq_knowledge_base_ideas UNIQUE (knowledge_base_id, idea_id);
+    CREATE INDEX ix_knowledge_base_ideas_idea_id ON knowledge_base_ideas (idea_id);
+    ALTER TABLE knowledge_base_knowledge_sources ADD CONSTRAINT uq_knowledge_base_knowledge_sources UNIQUE (knowledge_base_id, knowledge_source_id);
+    CREATE INDEX ix_knowledge_base_knowledge_sources_knowledge_source_id ON knowledge_base_knowledge_sources (knowledge_source_id);
+    ALTER TABLE idea_tags ADD CONSTRAINT uq_idea_tags UNIQUE (idea_id, tag_id);
+    CREATE INDEX ix_idea_tags_tag_id ON idea_tags (tag_id);
+
     INSERT INTO users (email, username, image_url, password, user_type)
     VALUES
     ('admin@test.com','admin','images/default_profile_pic.jpg','mypass','admin');
@@ -0,0 +1,286 @@
+import gzip
+import json
+import pytest
+from sqlalchemy import event
+from idealog.models import db, KnowledgeBase
+from idealog.kb_views import build_graph_views
+
+KB_JSON = json.dumps({"entities": {"Paris": {"url": "", "summary": ""}}, "relations": [], "sources": {}}, indent=4)
+
+GRAPH_JSON = json.dumps({
+    "entities": {name: {"url": f"https://en.wikipedia.org/wiki/{name}", "summary": f"About {name}"} for name in ["A", "B", "C", "D"]},
+    "relations": [
+        {"head": "A", "type": "part of", "tail": "B", "meta": {"https://example.com": {"spans": [[0, 128]]}}},
+        {"head": "B", "type": "part of", "tail": "C", "meta": {"https://example.com": {"spans": [[0, 128]]}}},
+        {"head": "C", "type": "country", "tail": "D", "meta": {"https://example.com": {"spans": [[100, 228]]}}},
+    ],
+    "sources": {"https://example.com": {"article_title": "Example", "article_publish_date": None}},
+})
+
+# Fifty small communities of six entities each: more entities than one view may show.
+LARGE_GRAPH_JSON = json.dumps({
+    "entities": {f"E{i}": {} for i in range(300)},
+    "relations": [{"head": f"E{i}", "type": "related to", "tail": f"E{i - i % 6 + (i + 1) % 6}"} for i in range(300)],
+})
+
+@pytest.fixture
+def knowledge_base_id(app):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Test KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object(KB_JSON)
+        db.session.add(knowledge_base)
+        db.session.commit()
+        return knowledge_base.id
+
+@pytest.fixture
+def graph_knowledge_base_id(app):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Graph KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object(GRAPH_JSON)
+        build_graph_views(knowledge_base)
+        db.session.add(knowledge_base)
+        db.session.commit()
+        return knowledge_base.id
+
+@pytest.fixture
+def large_knowledge_base_id(app):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Large KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object(LARGE_GRAPH_JSON)
+        build_graph_views(knowledge_base)
+        db.session.add(knowledge_base)
+        db.session.commit()
+        return knowledge_base.id
+
+def test_knowledge_base_etag(client, knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{knowledge_base_id}')
+    assert response.status_code == 200
+    assert response.json == json.loads(KB_JSON)
+    assert response.headers['Cache-Control'].startswith('public')
+
+    etag = response.headers['ETag']
+    response = client.get(f'/api/knowledge-bases/{knowledge_base_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_knowledge_base_precompressed(client, knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{knowledge_base_id}', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data)) == json.loads(KB_JSON)
+
+def test_pages_are_not_cached(client):
+    response = client.get('/')
+    assert response.headers['Pragma'] == 'no-cache'
+
+def test_knowledge_base_projection(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?fields=')
+    assert response.status_code == 200
+    assert response.json['entities'] == {"A": {}, "B": {}, "C": {}, "D": {}}
+    assert response.json['relations'][0] == {"head": "A", "type": "part of", "tail": "B"}
+    assert 'sources' not in response.json
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?fields=summary')
+    assert response.json['entities']['A'] == {"summary": "About A"}
+
+def test_knowledge_base_neighborhood(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?entity=A&depth=1&fields=')
+    assert set(response.json['entities']) == {"A", "B"}
+    assert len(response.json['relations']) == 1
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?entity=A&depth=2&fields=meta')
+    assert set(response.json['entities']) == {"A", "B", "C"}
+    assert all('meta' in relation for relation in response.json['relations'])
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?entity=Z')
+    assert response.status_code == 404
+
+def test_knowledge_base_relation_paging(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?offset=2&limit=2&fields=')
+    assert response.json['page'] == {"offset": 2, "limit": 2, "total": 3}
+    assert response.json['relations'] == [{"head": "C", "type": "country", "tail": "D"}]
+    assert set(response.json['entities']) == {"C", "D"}
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?limit=0')
+    assert response.status_code == 400
+
+def test_knowledge_base_layout(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}?fields=layout')
+    assert response.status_code == 200
+    entities = response.json['entities']
+    assert set(entities) == {"A", "B", "C", "D"}
+    assert all(set(entity) == {"x", "y"} for entity in entities.values())
+    # Connected entities are placed apart from each other.
+    assert (entities["A"]["x"], entities["A"]["y"]) != (entities["B"]["x"], entities["B"]["y"])
+
+def test_graph_views_are_not_built_by_requests(client, app):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Unlaid KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object(GRAPH_JSON)
+        db.session.add(knowledge_base)
+        db.session.commit()
+        knowledge_base_id = knowledge_base.id
+
+    # The graph is served without positions and the analytics aren't ready...
+    response = client.get(f'/api/knowledge-bases/{knowledge_base_id}?fields=layout')
+    assert response.json['entities']["A"] == {}
+    etag = response.headers['ETag']
+    assert client.get(f'/api/knowledge-bases/{knowledge_base_id}/analytics').status_code == 404
+    assert client.get(f'/api/knowledge-bases/{knowledge_base_id}/clusters').status_code == 404
+    with app.app_context():
+        assert db.session.get(KnowledgeBase, knowledge_base_id).graph_clusters is None
+
+    # ...until the views are built outside the request.
+    with app.app_context():
+        assert "1 knowledge base(s)" in app.test_cli_runner().invoke(args=['build-graph-views']).output
+    response = client.get(f'/api/knowledge-bases/{knowledge_base_id}?fields=layout', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert set(response.json['entities']["A"]) == {"x", "y"}
+    assert client.get(f'/api/knowledge-bases/{knowledge_base_id}/analytics').status_code == 200
+    assert client.get(f'/api/knowledge-bases/{knowledge_base_id}/clusters').status_code == 200
+
+def test_knowledge_base_clusters(client, graph_knowledge_base_id, large_knowledge_base_id):
+    # Small KBs fit in one view, so the coarsest level is the entities themselves.
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/clusters')
+    assert response.json['level'] == 0
+    assert {node['id'] for node in response.json['nodes']} == {"A", "B", "C", "D"}
+    assert len(response.json['links']) == 3
+
+    response = client.get(f'/api/knowledge-bases/{large_knowledge_base_id}/clusters')
+    assert response.json['level'] == 1
+    clusters = response.json['nodes']
+    assert len(clusters) <= 200
+    assert sum(cluster['size'] for cluster in clusters) == 300
+
+    response = client.get(f'/api/knowledge-bases/{large_knowledge_base_id}/clusters?cluster={clusters[0]["id"]}')
+    assert response.json['level'] == 0
+    assert len(response.json['nodes']) == clusters[0]['size']
+
+    response = client.get(f'/api/knowledge-bases/{large_knowledge_base_id}/clusters?level=0')
+    assert response.status_code == 400
+
+def test_knowledge_base_analytics(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/analytics?rank=degree&limit=2')
+    assert response.status_code == 200
+    assert response.json['entities'] == 4
+    assert response.json['components'] == 1
+    assert response.json['relation_types'] == [{"type": "part of", "count": 2}, {"type": "country", "count": 1}]
+    assert [entity['entity'] for entity in response.json['top_entities']] == ["B", "C"]
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/analytics')
+    assert response.json['top_entities'][0]['entity'] == "D"
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/analytics?rank=betweenness')
+    assert response.status_code == 400
+
+def test_knowledge_base_component(client, large_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{large_knowledge_base_id}?component=3&fields=')
+    assert len(response.json['entities']) == 6
+    assert len(response.json['relations']) == 6
+
+    response = client.get(f'/api/knowledge-bases/{large_knowledge_base_id}?component=50')
+    assert response.status_code == 404
+
+def test_knowledge_base_paths(client, graph_knowledge_base_id):
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/paths?source=D&target=A')
+    assert response.status_code == 200
+    path = response.json['paths'][0]
+    assert path['entities'] == ["D", "C", "B", "A"]
+    assert path['relations'][0] == {
+        "head": "C", "type": "country", "tail": "D",
+        "meta": {"https://example.com": {"spans": [[100, 228]]}},
+    }
+    assert response.json['sources'] == {"https://example.com": {"article_title": "Example", "article_publish_date": None}}
+
+    response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/paths?source=A&target=Z')
+    assert response.status_code == 404
+
+def test_knowledge_base_paths_do_not_load_the_payload(app, client, graph_knowledge_base_id):
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/paths?source=A&target=D')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+    assert response.json['sources'] == {"https://example.com": {"article_title": "Example", "article_publish_date": None}}
+    assert statements and not any('json_object' in statement for statement in statements)
+
+def test_cached_graphs_are_removed_with_their_knowledge_base(app, client, graph_knowledge_base_id, tmp_path):
+    app.config['KB_GRAPH_CACHE_DIR'] = str(tmp_path)
+    client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/paths?source=D&target=A')
+    entries = [entry.name for entry in tmp_path.iterdir()]
+    assert len(entries) == 1 and entries[0].startswith(f"{graph_knowledge_base_id}-")
+
+    with app.app_context():
+        knowledge_base = db.session.get(KnowledgeBase, graph_knowledge_base_id)
+        knowledge_base.set_json_object(KB_JSON)
+        db.session.commit()
+    assert list(tmp_path.iterdir()) == []
+
+    with app.app_context():
+        knowledge_base = db.session.get(KnowledgeBase, graph_knowledge_base_id)
+        knowledge_base.set_json_object(GRAPH_JSON)
+        build_graph_views(knowledge_base)
+        db.session.commit()
+    client.get(f'/api/knowledge-bases/{graph_knowledge_base_id}/paths?source=D&target=A')
+    assert len(list(tmp_path.iterdir())) == 1
+
+    with app.app_context():
+        db.session.delete(db.session.get(KnowledgeBase, graph_knowledge_base_id))
+        db.session.commit()
+    assert list(tmp_path.iterdir()) == []
+
+def test_entity_lookup_across_knowledge_bases(client, graph_knowledge_base_id, knowledge_base_id):
+    response = client.get('/api/entities?name=B')
+    assert response.get_json()['knowledge_bases'] == [
+        {"id": graph_knowledge_base_id, "name": "Graph KB", "url": "https://en.wikipedia.org/wiki/B", "relations": 2}
+    ]
+    assert client.get('/api/entities?name=Nowhere').get_json()['knowledge_bases'] == []
+    assert client.get('/api/entities').status_code == 400
+
+def test_relation_lookup_across_knowledge_bases(client, graph_knowledge_base_id):
+    relations = client.get('/api/relations?entity=C').get_json()['relations']
+    assert [(r['head'], r['type'], r['tail']) for r in relations] == [("B", "part of", "C"), ("C", "country", "D")]
+    assert relations[1]['sources'] == {"https://example.com": [[100, 228]]}
+
+    relations = client.get('/api/relations?type=part of&provenance=false').get_json()['relations']
+    assert [r['relation_id'] for r in relations] == [0, 1]
+    assert 'sources' not in relations[0]
+    assert client.get('/api/relations').status_code == 400
+
+def test_large_knowledge_base_is_streamed(app, client, large_knowledge_base_id):
+    app.config['KB_STREAM_THRESHOLD'] = 1
+    app.config['KB_STREAM_CHUNK_SIZE'] = 64
+    url = f'/api/knowledge-bases/{large_knowledge_base_id}'
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert json.loads(gzip.decompress(response.data)) == json.loads(LARGE_GRAPH_JSON)
+
+    # Without gzip or br, the stored gzip payload is decompressed as it is sent.
+    response = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    # Its length isn't known until it has been sent.
+    assert 'Content-Length' not in response.headers
+    assert response.get_json() == json.loads(LARGE_GRAPH_JSON)
+
+    response = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+def test_knowledge_base_tables_store_nulls(client, app):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Sparse KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object(json.dumps({
+            "entities": {"Spanless": {}, "Linked": {"url": "https://en.wikipedia.org/wiki/Linked"}},
+            "relations": [{"head": "Spanless", "type": "next to", "tail": "Linked", "meta": {"https://example.com": {}}}],
+        }))
+        db.session.add(knowledge_base)
+        db.session.commit()
+
+    response = client.get('/api/entities?name=Spanless')
+    assert response.get_json()['knowledge_bases'][0]['url'] is None
+    relations = client.get('/api/relations?type=next to').get_json()['relations']
+    assert relations[0]['sources'] == {"https://example.com": []}
@@ -0,0 +1,125 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from idealog.article_cache import ArticleCache
+from idealog.article_fetcher import ArticleFetcher
+from idealog.models import KnowledgeSource
+from idealog import tasks
+
+PARAGRAPH = "<p>Paris is the capital and most populous city of France. It is located on the Seine.</p>"
+
+class ArticleHandler(BaseHTTPRequestHandler):
+    """Serves /article/<n> pages with an ETag; /missing is a 404 and /flaky/<n> fails once with a 503."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(0.02)
+            if self.path.startswith('/missing'):
+                self.send_error(404)
+                return
+            if self.path.startswith('/flaky') and self.path not in server.failed:
+                server.failed.add(self.path)
+                self.send_error(503)
+                return
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = f"<html><head><title>Article {self.path.rsplit('/', 1)[-1]}</title></head><body><article>{PARAGRAPH * 8}</article></body></html>"
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def article_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArticleHandler)
+    server.lock = threading.Lock()
+    server.requests = server.active = server.max_active = 0
+    server.failed = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def server_url(server, path):
+    return f"http://127.0.0.1:{server.server_port}{path}"
+
+def test_fetcher_downloads_and_parses_concurrently(article_server):
+    urls = [server_url(article_server, f"/article/{i}") for i in range(20)]
+    urls += [server_url(article_server, "/missing"), server_url(article_server, "/flaky/1")]
+
+    results = {result.url: result for result in ArticleFetcher(per_host=3, parse_workers=2).fetch(urls)}
+
+    assert set(results) == set(urls)
+    article = results[urls[0]].article
+    assert article["name"] == "Article 0"
+    assert "capital and most populous city" in article["text"]
+    assert "404" in results[urls[20]].error
+    # Retried after the 503.
+    assert results[urls[21]].article is not None
+    assert 1 < article_server.max_active <= 3
+
+def count_parses(parsed):
+    def parse(url, content, encoding):
+        parsed.append(url)
+        return {"url": url, "name": "Article", "text": content.decode(encoding), "publish_date": None}
+    return parse
+
+def test_fetcher_cache(article_server, tmp_path):
+    urls = [server_url(article_server, f"/article/{i}") for i in range(5)]
+    cache = ArticleCache(str(tmp_path), max_bytes=1024 * 1024, max_age=3600)
+    parsed = []
+
+    first = {result.url: result.article for result in ArticleFetcher(parse_workers=0, parse=count_parses(parsed), cache=cache).fetch(urls)}
+    assert (article_server.requests, len(parsed)) == (5, 5)
+
+    # Fresh entries: no requests and no parsing.
+    second = {result.url: result.article for result in ArticleFetcher(parse_workers=0, parse=count_parses(parsed), cache=cache).fetch(urls)}
+    assert second == first
+    assert (article_server.requests, len(parsed)) == (5, 5)
+
+    # Stale entries are revalidated; the server answers 304 and nothing is parsed.
+    cache.max_age = 0
+    third = {result.url: result.article for result in ArticleFetcher(parse_workers=0, parse=count_parses(parsed), cache=cache).fetch(urls)}
+    assert third == first
+    assert (article_server.requests, len(parsed)) == (10, 5)
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ArticleCache(str(tmp_path), max_bytes=4000, max_age=3600)
+    page = bytes(range(256)) * 4  # Doesn't compress.
+    for i in range(10):
+        cache.put(f"https://example.com/{i}", page, None, None, {"name": str(i)})
+        time.sleep(0.01)
+    cache.get("https://example.com/0")
+
+    assert cache.evict() > 0
+    assert cache.get("https://example.com/0") is not None
+    assert cache.get("https://example.com/1") is None
+    assert cache.get("https://example.com/9") is not None
+
+def test_fetch_knowledge_sources(app, article_server):
+    urls = [server_url(article_server, f"/article/{i}") for i in range(5)] + [server_url(article_server, "/missing")]
+
+    assert tasks.fetch_knowledge_sources(urls, 1, 'public', []) == 5
+    # Urls that already have a knowledge source aren't fetched again.
+    assert tasks.fetch_knowledge_sources(urls, 1, 'public', []) == 0
+    with app.app_context():
+        knowledge_sources = KnowledgeSource.query.filter(KnowledgeSource.url.in_(urls)).all()
+        assert sorted(knowledge_source.url for knowledge_source in knowledge_sources) == sorted(urls[:5])
+        assert all(knowledge_source.creation_mode == 'automated' for knowledge_source in knowledge_sources)
@@ -0,0 +1,96 @@
+import gzip
+import json
+
+import fakeredis
+from sqlalchemy import text
+from idealog import bulk_load
+from idealog.bulk_load import load_directory
+from idealog.fragment_cache import GUEST_KB_LIST_KEY
+from idealog.kb_refresh import REFRESH_PENDING_KEY
+from idealog.models import db, User, Idea, Group
+
+def write_data(directory):
+    (directory / "users.csv").write_text(
+        "email,username,image_url,password,user_type\n"
+        "ada@example.com,ada,,secret1,admin\n"
+        "bob@example.com,bob,,secret2,registered\n")
+    # Shards; privacy and creation_mode are missing and get the model defaults.
+    (directory / "ideas-1.csv").write_text(
+        "name,text,publish_date,url,user_id\n"
+        "Engine,\"Computes, then prints\",2024-01-01T00:00:00,,1\n")
+    (directory / "ideas-2.csv").write_text(
+        "name,text,publish_date,url,user_id\n"
+        "Telegraph,Sends messages,2024-01-02T00:00:00,https://example.com,2\n")
+    (directory / "groups.ndjson").write_text(
+        json.dumps({"id": 7, "name": "Machines", "user_id": 1, "privacy": "public"}) + "\n")
+    with gzip.open(directory / "idea_groups.csv.gz", 'wt') as f:
+        f.write("idea_id,group_id\n1,7\n2,7\n")
+
+def test_load_directory(app, tmp_path):
+    write_data(tmp_path)
+
+    with app.app_context():
+        loaded = load_directory(db.engine, str(tmp_path), replace=True)
+        assert loaded == {"users": 2, "groups": 1, "ideas": 2, "idea_groups": 2}
+
+        assert User.authenticate("ada", "secret1")
+        engine = Idea.query.filter_by(name="Engine").one()
+        assert (engine.privacy, engine.creation_mode, engine.url) == ("private", "automated", "")
+        assert sorted(idea.name for idea in db.session.get(Group, 7).ideas) == ["Engine", "Telegraph"]
+
+        # Indexes are rebuilt and the id sequence continues after the loaded ids.
+        indexes = {row[0] for row in db.session.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = 'ideas'"))}
+        assert "ix_ideas_user_id" in indexes
+        group = Group(name="Instruments")
+        db.session.add(group)
+        db.session.commit()
+        assert group.id == 8
+
+def test_load_directory_replaces(app, tmp_path):
+    write_data(tmp_path)
+
+    with app.app_context():
+        load_directory(db.engine, str(tmp_path), replace=True)
+        load_directory(db.engine, str(tmp_path), replace=True)
+        assert User.query.count() == 2
+        assert Idea.query.count() == 2
+
+def test_load_directory_skips_files_without_a_header(app, tmp_path):
+    write_data(tmp_path)
+    (tmp_path / "ideas-3.csv").write_text("")
+    (tmp_path / "ideas-4.ndjson").write_text("\n")
+
+    with app.app_context():
+        loaded = load_directory(db.engine, str(tmp_path), replace=True)
+        assert loaded["ideas"] == 2
+
+def test_load_data_refreshes_derived_data(app, tmp_path, monkeypatch):
+    write_data(tmp_path)
+    app.extensions['redis'] = redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(app.extensions['celery'], 'send_task', lambda name, countdown: None)
+    redis.set(GUEST_KB_LIST_KEY, "stale")
+
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=['load-data', str(tmp_path), '--replace'])
+    assert result.exit_code == 0, result.output
+    assert redis.get(GUEST_KB_LIST_KEY) is None
+    assert redis.smembers(REFRESH_PENDING_KEY) == {b"idea:1", b"idea:2"}
+    assert "Queued 2 document(s)" in result.output
+
+def test_load_data_queues_documents_in_chunks(app, tmp_path, monkeypatch):
+    write_data(tmp_path)
+    app.extensions['redis'] = redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(app.extensions['celery'], 'send_task', lambda name, countdown: None)
+    monkeypatch.setattr(bulk_load, 'REFRESH_CHUNK_KEYS', 1)
+    chunks = []
+    monkeypatch.setattr(bulk_load, 'enqueue_documents', lambda keys: chunks.append(keys) or True)
+
+    with app.app_context():
+        app.test_cli_runner().invoke(args=['load-data', str(tmp_path), '--replace'])
+    assert chunks == [["idea:1"], ["idea:2"]]
+
+    chunks.clear()
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=['load-data', str(tmp_path), '--replace', '--no-refresh'])
+    assert result.exit_code == 0, result.output
+    assert chunks == []
@@ -0,0 +1,85 @@
+import io
+import os
+import tarfile
+import zipfile
+from types import SimpleNamespace
+
+from idealog import file_ingest, tasks
+from idealog.file_ingest import file_documents
+from idealog.uploads import remove_finished_batches
+from idealog.models import KnowledgeSource
+
+MARKDOWN = "# Paris\nParis is the capital of France.\n\n# Berlin\nBerlin is the capital of Germany.\n"
+PLAINTEXT = "Rome\nRome is the capital of Italy.\fMadrid\nMadrid is the capital of Spain.\n"
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content.encode('utf-8'))
+    return str(path)
+
+def test_markdown_and_plaintext_are_split_into_documents(tmp_path):
+    documents = list(file_documents(write(tmp_path / "capitals.md", MARKDOWN), "capitals.md"))
+    assert [document["name"] for document in documents] == ["Paris", "Berlin"]
+    assert documents[1]["text"] == "# Berlin\nBerlin is the capital of Germany."
+    assert documents[1]["url"] == "file:capitals.md#2"
+
+    documents = list(file_documents(write(tmp_path / "capitals.txt", PLAINTEXT), "capitals.txt"))
+    assert [document["name"] for document in documents] == ["Rome", "Madrid"]
+
+def test_long_documents_are_cut_at_line_breaks(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_ingest, 'MAX_DOCUMENT_BYTES', 100)
+    lines = "".join(f"Line {i} of a long document.\n" for i in range(20))
+    documents = list(file_documents(write(tmp_path / "long.txt", lines), "long.txt"))
+
+    assert len(documents) > 1
+    assert all(document["text"].endswith("document.") for document in documents)
+    assert documents[1]["name"] == "Line 0 of a long document. (part 2)"
+    assert "\n".join(document["text"] for document in documents) == lines.strip()
+
+def test_archives_are_read_member_by_member(tmp_path):
+    zip_path = str(tmp_path / "notes.zip")
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        archive.writestr("notes/capitals.md", MARKDOWN)
+        archive.writestr("notes/image.png", b"\x89PNG")
+        archive.writestr("__MACOSX/notes/._capitals.md", "")
+
+    tar_path = str(tmp_path / "notes.tar.gz")
+    with tarfile.open(tar_path, 'w:gz') as archive:
+        data = PLAINTEXT.encode('utf-8')
+        info = tarfile.TarInfo("capitals.txt")
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+
+    zip_documents = list(file_documents(zip_path, "notes.zip"))
+    assert [document["url"] for document in zip_documents] == ["file:notes.zip/notes/capitals.md#1", "file:notes.zip/notes/capitals.md#2"]
+    assert [document["name"] for document in file_documents(tar_path, "notes.tar.gz")] == ["Rome", "Madrid"]
+    # Scratch copies of the members are removed.
+    assert sorted(os.listdir(tmp_path)) == ["notes.tar.gz", "notes.zip"]
+
+def test_ingest_task(app, tmp_path):
+    app.config['UPLOAD_DIR'] = str(tmp_path)
+    batch_dir = tmp_path / "batch"
+    batch_dir.mkdir()
+    write(batch_dir / "0-capitals.md", MARKDOWN)
+    write(batch_dir / "1-capitals.txt", PLAINTEXT)
+    files = [["0-capitals.md", "capitals.md"], ["1-capitals.txt", "capitals.txt"]]
+
+    with app.app_context():
+        assert tasks.ingest_knowledge_source_files("batch", files, 1, 'private', []) == 4
+        assert "is not in" in tasks.ingest_knowledge_source_files("missing", files, 1, 'private', [])
+        names = [knowledge_source.name for knowledge_source in KnowledgeSource.query.filter(KnowledgeSource.url.like('file:capitals%'))]
+        assert sorted(names) == ["Berlin", "Madrid", "Paris", "Rome"]
+    # The web app wrote the files, and removes them.
+    assert batch_dir.exists()
+
+def test_finished_uploads_are_removed(app, tmp_path):
+    app.config['UPLOAD_DIR'] = str(tmp_path)
+    for batch in ["finished", "running", "stale"]:
+        (tmp_path / batch).mkdir()
+    os.utime(tmp_path / "stale", (0, 0))
+
+    with app.test_request_context():
+        # Only the task of batch "finished" is done.
+        task = SimpleNamespace(AsyncResult=lambda task_id: SimpleNamespace(ready=lambda: task_id == "finished"))
+        remove_finished_batches(task)
+    assert os.listdir(tmp_path) == ["running"]
@@ -0,0 +1,66 @@
+import fakeredis
+from sqlalchemy import text
+from idealog.models import db, KnowledgeBase
+
+def test_guest_homepage_lists_public_knowledge_bases(app, client):
+    with app.app_context():
+        db.session.add(KnowledgeBase(name='Public KB', privacy='public', status='ready', user_id=1))
+        db.session.add(KnowledgeBase(name='Private KB', privacy='private', status='ready', user_id=1))
+        db.session.commit()
+
+    response = client.get('/')
+    assert b'Public KB' in response.data
+    assert b'Private KB' not in response.data
+
+def test_guest_latest_is_public(app, client):
+    with app.app_context():
+        public = KnowledgeBase(name='Public KB', privacy='public', status='ready', user_id=1)
+        public.set_json_object('{"entities": {"Public": {}}, "relations": [], "sources": {}}')
+        private = KnowledgeBase(name='Private KB', privacy='private', status='ready', user_id=1)
+        private.set_json_object('{"entities": {"Private": {}}, "relations": [], "sources": {}}')
+        db.session.add_all([public, private])
+        db.session.commit()
+
+    response = client.get('/api/knowledge-bases?content=latest')
+    assert response.status_code == 200
+    assert list(response.json['entities']) == ['Public']
+
+def test_guest_latest_serves_stored_representations(app, client):
+    with app.app_context():
+        knowledge_base = KnowledgeBase(name='Public KB', privacy='public', status='ready', user_id=1)
+        knowledge_base.set_json_object('{"entities": {"Public": {}}, "relations": [], "sources": {}}')
+        # Stand-ins that compressing the payload again could not produce.
+        knowledge_base.json_gzip = b'stored gzip'
+        knowledge_base.json_br = b'stored br'
+        unbuilt = KnowledgeBase(name='Unbuilt KB', privacy='public', status='ready', user_id=1,
+                                json_object='{"entities": {"Unbuilt": {}}, "relations": [], "sources": {}}')
+        db.session.add_all([knowledge_base, unbuilt])
+        db.session.commit()
+        etag = knowledge_base.json_etag
+
+    response = client.get('/api/knowledge-bases?content=latest', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.data == b'stored gzip'
+    assert response.headers['ETag'] == f'"{etag}-gzip"'
+
+def test_guest_latest_outlives_a_stale_stream_entry(app, client):
+    app.extensions['redis'] = fakeredis.FakeRedis()
+    app.config['KB_STREAM_THRESHOLD'] = 1
+    with app.app_context():
+        older = KnowledgeBase(name='Older KB', privacy='public', status='ready', user_id=1)
+        older.set_json_object('{"entities": {"Older": {}}, "relations": [], "sources": {}}')
+        latest = KnowledgeBase(name='Latest KB', privacy='public', status='ready', user_id=1)
+        latest.set_json_object('{"entities": {"Latest": {}}, "relations": [], "sources": {}}')
+        db.session.add_all([older, latest])
+        db.session.commit()
+        latest_id = latest.id
+
+    assert list(client.get('/api/knowledge-bases?content=latest').json['entities']) == ['Latest']
+
+    # Deleted without the ORM events that drop the cached entry.
+    with app.app_context():
+        db.session.execute(text("DELETE FROM knowledge_bases WHERE id = :id"), {"id": latest_id})
+        db.session.commit()
+    response = client.get('/api/knowledge-bases?content=latest')
+    assert response.status_code == 200
+    assert list(response.json['entities']) == ['Older']
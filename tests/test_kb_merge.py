@@ -0,0 +1,50 @@
+import json
+from idealog.models import db, KnowledgeBase
+from idealog.kb_merge import merge_knowledge_base_payloads
+from idealog import tasks
+
+FIRST = {
+    "entities": {"Paris": {"url": "https://en.wikipedia.org/wiki/Paris", "summary": "Capital of France"}, "France": {}},
+    "relations": [{"head": "Paris", "type": "country", "tail": "France", "meta": {"https://a.com": {"spans": [[0, 128]]}}}],
+    "sources": {"https://a.com": {"article_title": "A", "article_publish_date": None}},
+}
+SECOND = {
+    "entities": {"France": {"url": "https://en.wikipedia.org/wiki/France"}, "Europe": {}},
+    "relations": [
+        {"head": "Paris", "type": "country", "tail": "France", "meta": {
+            "https://a.com": {"spans": [[0, 128], [128, 256]]},
+            "https://b.com": {"spans": [[0, 128]]},
+        }},
+        {"head": "France", "type": "continent", "tail": "Europe", "meta": {"https://b.com": {"spans": [[0, 128]]}}},
+    ],
+    "sources": {"https://b.com": {"article_title": "B", "article_publish_date": None}},
+}
+
+def test_merge_deduplicates_relations_and_unions_provenance():
+    merged = json.loads(merge_knowledge_base_payloads([json.dumps(FIRST), SECOND]))
+
+    assert list(merged['entities']) == ["Paris", "France", "Europe"]
+    assert merged['entities']['France'] == {"url": "https://en.wikipedia.org/wiki/France"}
+    assert len(merged['relations']) == 2
+    assert merged['relations'][0]['meta'] == {
+        "https://a.com": {"spans": [[0, 128], [128, 256]]},
+        "https://b.com": {"spans": [[0, 128]]},
+    }
+    assert set(merged['sources']) == {"https://a.com", "https://b.com"}
+
+def test_merge_task(app):
+    with app.app_context():
+        sources = []
+        for name, payload in [('First', FIRST), ('Second', SECOND)]:
+            knowledge_base = KnowledgeBase(name=name, status='ready', user_id=1)
+            knowledge_base.set_json_object(json.dumps(payload))
+            sources.append(knowledge_base)
+        merged = KnowledgeBase(name='Merged', status='pending', user_id=1)
+        db.session.add_all(sources + [merged])
+        db.session.commit()
+
+        assert tasks.merge_kbs(merged.id, [source.id for source in sources]) == merged.id
+        # The task runs in its own app context, so reload what it committed.
+        db.session.refresh(merged)
+        assert merged.status == 'ready'
+        assert len(json.loads(merged.json_object)['relations']) == 2
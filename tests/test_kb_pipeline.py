@@ -0,0 +1,83 @@
+import json
+import threading
+
+import pytest
+from idealog.kb_pipeline import build_kb
+from idealog.news_search import LocalNewsSearch, search_news_links
+from tests.test_article_fetcher import article_server, server_url
+
+class RecordingKB():
+    def __init__(self):
+        self.relations = []
+
+    def add_linked_relation(self, r, entities, article_title, article_publish_date):
+        self.relations.append((article_title, [entity["title"] for entity in entities]))
+
+def extract_mentions(article):
+    return [{"head": article["name"], "type": "mentions", "tail": "Paris", "meta": {article["url"]: {"spans": [[0, 128]]}}}]
+
+class DictRedis():
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+class CountingSearch(LocalNewsSearch):
+    def __init__(self, path):
+        super().__init__(path)
+        self.calls = 0
+
+    def page_links(self, query, page):
+        self.calls += 1
+        return super().page_links(query, page)
+
+def test_stages_overlap(article_server):
+    urls = [server_url(article_server, f"/article/{i}") for i in range(10)]
+    extracting = threading.Event()
+    looked_up = []
+
+    def links():
+        yield from urls[:5]
+        # Only reached if extraction starts while links are still being discovered.
+        assert extracting.wait(5)
+        yield from urls[5:]
+
+    def extract(article):
+        extracting.set()
+        return extract_mentions(article)
+
+    def lookup(name):
+        looked_up.append(name)
+        return {"title": name}
+
+    kb = build_kb(RecordingKB(), links(), extract, lookup, fetch_options=dict(parse_workers=0, per_host=2))
+
+    assert sorted(title for title, _ in kb.relations) == sorted(f"Article {i}" for i in range(10))
+    # Each entity is looked up once for the whole KB.
+    assert looked_up.count("Paris") == 1
+
+def test_stage_errors_are_raised(article_server):
+    def extract(article):
+        raise ValueError("model failed")
+
+    urls = [server_url(article_server, f"/article/{i}") for i in range(3)]
+    with pytest.raises(ValueError, match="model failed"):
+        build_kb(RecordingKB(), urls, extract, lambda name: {"title": name}, fetch_options=dict(parse_workers=0))
+
+def test_search_results_are_cached_per_query(app, tmp_path):
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps({"paris": [["https://a.com/1", "https://a.com/2"], ["https://a.com/2", "https://a.com/3"]]}))
+    search = CountingSearch(str(path))
+    app.extensions['redis'] = DictRedis()
+
+    with app.app_context():
+        assert list(search_news_links("paris", pages=3, search=search)) == ["https://a.com/1", "https://a.com/2", "https://a.com/3"]
+        assert search.calls == 3
+        assert list(search_news_links("paris", pages=3, max_links=2, search=search)) == ["https://a.com/1", "https://a.com/2"]
+        assert search.calls == 3
+        list(search_news_links("london", search=search))
+        assert search.calls == 4
@@ -0,0 +1,93 @@
+import json
+import fakeredis
+from idealog import tasks
+from idealog.models import db, Idea
+from idealog.kb_refresh import REFRESH_URLS_KEY, global_knowledge_base, patch_payload
+from idealog.ml_functions import class_kb
+
+PAYLOAD = {
+    "entities": {"Paris": {}, "France": {}, "Europe": {}},
+    "relations": [
+        {"head": "Paris", "type": "country", "tail": "France", "meta": {
+            "https://a.com": {"spans": [[0, 128]]},
+            "https://b.com": {"spans": [[0, 128]]},
+        }},
+        {"head": "France", "type": "continent", "tail": "Europe", "meta": {"https://b.com": {"spans": [[0, 128]]}}},
+    ],
+    "sources": {"https://a.com": {"article_title": "A"}, "https://b.com": {"article_title": "B"}},
+}
+EXTRACT = {
+    "entities": {"Paris": {}, "Seine": {}},
+    "relations": [{"head": "Seine", "type": "located in", "tail": "Paris", "meta": {"https://b.com": {"spans": [[0, 64]]}}}],
+    "sources": {"https://b.com": {"article_title": "B, edited"}},
+}
+
+def test_patch_payload_replaces_what_a_url_contributed():
+    patched = json.loads(patch_payload(json.dumps(PAYLOAD), {"https://b.com"}, [json.dumps(EXTRACT)]))
+
+    assert sorted(patched['entities']) == ["France", "Paris", "Seine"]
+    assert patched['relations'][0]['meta'] == {"https://a.com": {"spans": [[0, 128]]}}
+    assert patched['relations'][1]['head'] == "Seine"
+    assert patched['sources']['https://b.com'] == {"article_title": "B, edited"}
+
+def test_patch_payload_removes_deleted_documents():
+    patched = json.loads(patch_payload(json.dumps(PAYLOAD), {"https://a.com", "https://b.com"}, []))
+    assert patched == {"entities": {}, "relations": [], "sources": {}}
+
+def test_document_changes_are_captured(app):
+    with app.app_context():
+        idea = Idea(name='Idea', text='Some text', url='https://c.com', user_id=1)
+        db.session.add(idea)
+        db.session.flush()
+        assert db.session.info['kb_refresh_changes'] == {f"idea:{idea.id}"}
+
+        db.session.rollback()
+        assert 'kb_refresh_changes' not in db.session.info
+
+class TextKB:
+    """Stands in for the model: one relation per document, named after its text."""
+    def __init__(self, document):
+        self.document = document
+
+    def to_json(self):
+        return json.dumps({
+            "entities": {self.document.text: {}, self.document.name: {}},
+            "relations": [{"head": self.document.name, "type": "says", "tail": self.document.text,
+                           "meta": {self.document.url: {"spans": [[0, 128]]}}}],
+            "sources": {self.document.url: {"article_title": self.document.name}},
+        })
+
+def test_global_knowledge_base_is_patched_once_changes_are_extracted(app, monkeypatch):
+    app.extensions['redis'] = fakeredis.FakeRedis()
+    app.config['KB_REFRESH_BATCH_SIZE'] = 1
+    scheduled = []
+    monkeypatch.setattr(app.extensions['celery'], 'send_task', lambda name, countdown: scheduled.append(countdown))
+    monkeypatch.setattr(class_kb, 'from_idea_to_kb', TextKB)
+
+    with app.app_context():
+        ideas = [Idea(name=f'Idea {i}', text=f'Text {i}', url=f'https://{i}.com', user_id=1) for i in range(2)]
+        db.session.add_all(ideas)
+        db.session.commit()
+        idea_id = ideas[0].id
+        # Both changes are handled by the run the first one scheduled.
+        assert scheduled == [app.config['KB_REFRESH_DEBOUNCE']]
+
+    # One document per run: the first run extracts one and schedules the next...
+    assert tasks.refresh_global_kb() == 1
+    assert scheduled[-1] == 0
+    with app.app_context():
+        assert global_knowledge_base().json_object is None
+    # ...which finds none left after its own, and patches the KB with both.
+    assert tasks.refresh_global_kb() == 1
+    with app.app_context():
+        relations = json.loads(global_knowledge_base().json_object)['relations']
+        assert sorted(relation['tail'] for relation in relations) == ['Text 0', 'Text 1']
+
+        idea = db.session.get(Idea, idea_id)
+        idea.text = 'Edited'
+        db.session.commit()
+    assert tasks.refresh_global_kb() == 1
+    with app.app_context():
+        relations = json.loads(global_knowledge_base().json_object)['relations']
+        assert sorted(relation['tail'] for relation in relations) == ['Edited', 'Text 1']
+        assert app.extensions['redis'].scard(REFRESH_URLS_KEY) == 0
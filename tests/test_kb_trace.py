@@ -0,0 +1,88 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from idealog.helpers import CURR_USER_KEY
+from idealog.kb_trace import trace_job, finish_trace, stage, count
+from idealog.ml_functions import class_kb
+from idealog.models import db, KnowledgeBase
+from idealog.request_metrics import render_metrics
+
+def test_job_stages_and_counts_are_traced(app):
+    app.extensions['redis'] = None
+    with app.app_context():
+        with trace_job('create_kb') as trace:
+            # One job per process is traced.
+            with trace_job('merge_kbs') as other:
+                assert other is None
+            for _ in range(3):
+                with stage('tokenization'):
+                    count('tokens', 100)
+            count('entity_lookups', 1)
+            count('entity_cache_hits', 3)
+            result = finish_trace(trace)
+
+        # Outside a job, stages and counts do nothing.
+        with stage('tokenization'):
+            count('tokens', 100)
+
+        assert result["status"] == "ok"
+        assert result["stages"][0]["name"] == "tokenization"
+        assert result["stages"][0]["calls"] == 3
+        assert result["counters"] == {"tokens": 300, "entity_lookups": 1, "entity_cache_hits": 3}
+        assert result["entity_cache_hit_rate"] == 0.75
+
+        text = render_metrics()
+        assert 'idealog_kb_jobs_total{task="create_kb",status="ok"} 1' in text
+        assert 'idealog_kb_job_stage_calls_total{task="create_kb",stage="tokenization"} 3' in text
+        assert 'idealog_kb_job_counts_total{task="create_kb",count="tokens"} 300' in text
+        assert 'idealog_kb_job_duration_seconds_count{task="create_kb"} 1' in text
+
+def test_build_trace_is_shown(app, client):
+    app.extensions['redis'] = None
+    with app.app_context():
+        with trace_job('create_kb') as trace:
+            with stage('generation'):
+                pass
+            result = finish_trace(trace, TimeoutError("soft time limit"))
+        knowledge_base = KnowledgeBase(name="Traced", user_id=1, build_trace=result)
+        db.session.add(knowledge_base)
+        db.session.commit()
+        knowledge_base_id = knowledge_base.id
+
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+    response = client.get(f'/knowledge-bases/{knowledge_base_id}')
+    assert response.status_code == 200
+    assert b"create_kb failed" in response.data
+    assert b"TimeoutError: soft time limit" in response.data
+    assert b"<td>generation</td>" in response.data
+
+def test_knowledge_base_of_ideas_counts_each_lookup_once(app, monkeypatch):
+    app.extensions['redis'] = None
+    # The model finds "head type tail" triples, one per line; Wikipedia titles are capitalized.
+    def extract_text_relations(text, article_url, **kwargs):
+        for line in text.splitlines():
+            head, type_, tail = line.split()
+            yield {"head": head, "type": type_, "tail": tail, "meta": {article_url: {"spans": [[0, 128]]}}}
+    monkeypatch.setattr(class_kb, 'extract_text_relations', extract_text_relations)
+    monkeypatch.setattr(class_kb.KB, 'get_wikipedia_data',
+                        lambda self, entity: {"title": entity.title(), "url": "", "summary": ""})
+    ideas = [
+        SimpleNamespace(name="Capitals", text="paris capital france\nberlin capital germany",
+                        url="https://a.com", publish_date=datetime(2024, 1, 1)),
+        SimpleNamespace(name="Continents", text="paris located europe",
+                        url="https://b.com", publish_date=datetime(2024, 1, 2)),
+    ]
+
+    with app.app_context():
+        with trace_job('create_kb') as trace:
+            kb = class_kb.from_ideas_to_kb(ideas)
+            result = finish_trace(trace)
+
+    assert len(kb.relations) == 3
+    # paris is looked up once and found in the cache once; merging looks nothing up.
+    assert result["counters"] == {"entity_lookups": 5, "entity_cache_hits": 1}
+    stages = {stage["name"]: stage["calls"] for stage in result["stages"]}
+    # One call per relation linked in an idea, and one per idea merged into the KB.
+    assert stages["merge"] == 5
+    assert stages["entity_resolution"] == 5
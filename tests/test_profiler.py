@@ -0,0 +1,36 @@
+import threading
+from collections import Counter
+
+from idealog.helpers import CURR_USER_KEY
+from idealog.profiler import take_sample, collapsed_stacks
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_samples_are_collapsed_stacks():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop,), name="busy")
+    thread.start()
+    try:
+        counts = Counter()
+        for _ in range(5):
+            take_sample(counts, skip={threading.get_ident()})
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = collapsed_stacks(counts).splitlines()
+    busy = [line for line in lines if line.startswith("busy;")]
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in busy) == 5
+    assert all("busy_loop (" in line for line in busy)
+    # The sampling thread itself is skipped.
+    assert not any("test_samples_are_collapsed_stacks" in line for line in lines)
+
+def test_admin_page_without_redis(app, client):
+    app.extensions['redis'] = None
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+    response = client.get('/users_bp/admin')
+    assert response.status_code == 200
+    assert b"No worker has checked in yet" in response.data
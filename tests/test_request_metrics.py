@@ -0,0 +1,37 @@
+from idealog.helpers import CURR_USER_KEY
+
+def metrics_text(client):
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+    response = client.get('/users_bp/admin/metrics')
+    assert response.status_code == 200
+    return response.data.decode('utf-8')
+
+def test_requests_are_measured(app, client):
+    # Without Redis the metrics stay in the process.
+    app.extensions['redis'] = None
+    # Requests are recorded when their response is closed, after it has been sent.
+    client.get('/').close()
+    client.get('/').close()
+
+    text = metrics_text(client)
+    assert 'idealog_requests_total{endpoint="views.homepage",method="GET",status="200"} 2' in text
+    assert 'idealog_request_duration_seconds_count{endpoint="views.homepage",method="GET"} 2' in text
+    assert 'idealog_request_duration_seconds_bucket{endpoint="views.homepage",method="GET",le="+Inf"} 2' in text
+    # The guest homepage lists the public KBs.
+    assert 'idealog_request_sql_statements_bucket{endpoint="views.homepage",method="GET",le="1"} 2' in text
+    assert 'idealog_response_size_bytes_count{endpoint="views.homepage",method="GET"} 2' in text
+
+def test_metrics_require_admin_or_token(app, client):
+    app.config['METRICS_TOKEN'] = 'scraper-token'
+    assert client.get('/users_bp/admin/metrics').status_code == 403
+    response = client.get('/users_bp/admin/metrics', headers={'Authorization': 'Bearer scraper-token'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+def test_slow_requests_are_logged_with_their_statements(app, client, caplog):
+    app.extensions['redis'] = None
+    app.config['SLOW_REQUEST_SECONDS'] = 0
+    client.get('/').close()
+    assert "Slow request: GET views.homepage 200" in caplog.text
+    assert "FROM knowledge_bases" in caplog.text
@@ -0,0 +1,72 @@
+import fakeredis
+from sqlalchemy import event
+from idealog.helpers import CURR_USER_KEY
+from idealog.models import db, User
+from idealog.user_cache import CachedUser, get_cached_user, USER_CACHE_COLUMNS, _cache_key
+
+def test_cached_user_snapshot(app):
+    with app.app_context():
+        user = User.query.filter_by(username='admin').first()
+        cached = get_cached_user(user.id)
+        assert isinstance(cached, CachedUser)
+        assert {column: getattr(cached, column) for column in USER_CACHE_COLUMNS} == {column: getattr(user, column) for column in USER_CACHE_COLUMNS}
+        assert cached.is_admin
+        # Relationships are not cached and come from the full row.
+        assert [idea.name for idea in cached.ideas] == ['Test Idea']
+
+def test_cached_user_missing(app):
+    with app.app_context():
+        assert get_cached_user(12345) is None
+
+def redis_cache(app):
+    app.extensions['redis'] = fakeredis.FakeRedis()
+    return app.extensions['redis']
+
+def test_cached_user_hit_skips_database(app):
+    redis = redis_cache(app)
+    with app.app_context():
+        get_cached_user(1)
+        assert redis.exists(_cache_key(1))
+
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            cached = get_cached_user(1)
+            assert (cached.username, cached.is_admin) == ('admin', True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert statements == []
+
+def test_cached_user_invalidated_on_edit(app, client):
+    redis = redis_cache(app)
+    app.config['WTF_CSRF_ENABLED'] = False
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+    client.get('/users_bp/admin')
+    assert redis.exists(_cache_key(1))
+
+    response = client.post('/users_bp/users/1/edit', data={
+        'username': 'root', 'email': 'root@test.com', 'password': 'secret', 'image_url': '', 'user_type': 'admin'})
+    assert response.status_code == 302
+    assert not redis.exists(_cache_key(1))
+    with app.app_context():
+        assert get_cached_user(1).username == 'root'
+
+def test_cached_user_invalidated_on_delete(app, client):
+    redis = redis_cache(app)
+    with app.app_context():
+        user = User(username='other', email='other@test.com', password='secret', user_type='registered')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        get_cached_user(user_id)
+    assert redis.exists(_cache_key(user_id))
+
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = 1
+    response = client.post(f'/users_bp/users/{user_id}/delete')
+    assert response.status_code == 302
+    assert not redis.exists(_cache_key(user_id))
+    with app.app_context():
+        assert get_cached_user(user_id) is None